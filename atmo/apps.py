@@ -4,6 +4,7 @@
 import logging
 
 import session_csrf
+from celery.signals import before_task_publish, task_postrun, task_prerun, worker_ready
 from django.apps import AppConfig
 from django.db.models.signals import post_save, pre_delete
 
@@ -39,6 +40,32 @@ class AtmoAppConfig(AppConfig):
             dispatch_uid="sparkjob_pre_delete_remove_perm",
         )
 
+        # Record the task telemetry.
+        from atmo.telemetry import task_postrun_handler, task_prerun_handler
+
+        task_prerun.connect(task_prerun_handler, dispatch_uid="telemetry_task_prerun")
+        task_postrun.connect(
+            task_postrun_handler, dispatch_uid="telemetry_task_postrun"
+        )
+
+        # Collect the Prometheus metrics.
+        from atmo import monitoring
+
+        monitoring.install_round_trip_counters()
+        before_task_publish.connect(
+            monitoring.before_task_publish_handler,
+            dispatch_uid="monitoring_before_task_publish",
+        )
+        task_prerun.connect(
+            monitoring.task_prerun_handler, dispatch_uid="monitoring_task_prerun"
+        )
+        task_postrun.connect(
+            monitoring.task_postrun_handler, dispatch_uid="monitoring_task_postrun"
+        )
+        worker_ready.connect(
+            monitoring.worker_ready_handler, dispatch_uid="monitoring_worker_ready"
+        )
+
 
 class KeysAppConfig(AppConfig):
     name = "atmo.keys"
@@ -74,6 +74,18 @@ class AtmoCelery(Celery):
         """
         return ExpoBackoffFullJitter(base=1, cap=cap).backoff(n)
 
+    def retry_countdown(self, exc, n, cap=60 * 60):
+        """
+        Return the countdown of the retry of a task that failed with the
+        given exception for the given number, the seconds after which the
+        failing API may be called again if known (e.g. when its circuit
+        breaker is open) or a fully jittered backoff value otherwise.
+        """
+        retry_after = getattr(exc, "retry_after", None)
+        if retry_after is not None:
+            return min(cap, retry_after)
+        return self.backoff(n, cap=cap)
+
 
 #: The Celery app instance used by ATMO, which auto-detects Celery
 #: config values from Django settings prefixed with "CELERY\_"
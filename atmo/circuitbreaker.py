@@ -0,0 +1,206 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+A circuit breaker for AWS API calls that is shared by all web and Celery
+worker processes, with its state stored in Redis.
+
+The circuit is ``closed`` as long as the API is healthy. When the number of
+failed calls (server errors, throttling errors and connection errors)
+within the ``EMR_CIRCUIT_FAILURE_WINDOW`` AWS config value (in seconds)
+reaches the ``EMR_CIRCUIT_FAILURE_THRESHOLD`` AWS config value, the
+circuit is ``open`` for ``EMR_CIRCUIT_RESET_TIMEOUT`` seconds, during
+which all calls fail fast with a :class:`CircuitOpenError` instead of
+waiting for the unhealthy API.
+
+Afterwards the circuit is ``half-open`` and lets a single probing call
+through every ``EMR_CIRCUIT_PROBE_TIMEOUT`` seconds. A successful probe
+closes the circuit again, a failed one opens it again.
+
+Since :class:`CircuitOpenError` is a Boto3 ``ClientError``, code that
+handles API errors already handles it. Views render a degraded response
+with the :class:`~atmo.middleware.CircuitBreakerMiddleware` middleware
+and tasks defer their retries until the circuit may be closed again with
+:meth:`~atmo.celery.AtmoCelery.retry_countdown`.
+"""
+
+import logging
+import threading
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .stats.models import Metric
+
+logger = logging.getLogger(__name__)
+
+#: The state of a healthy API, all calls are made.
+CLOSED = "closed"
+#: The state of an unhealthy API, all calls fail fast.
+OPEN = "open"
+#: The state after the reset timeout, single probing calls are made.
+HALF_OPEN = "half-open"
+
+#: The error codes of failed calls in addition to server errors.
+FAILURE_ERROR_CODES = {
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "ServiceUnavailable",
+    "InternalFailure",
+}
+
+
+class CircuitOpenError(ClientError):
+    """
+    Raised instead of making an API call while the circuit is open, with
+    the seconds after which the call may be made again as ``retry_after``.
+    """
+
+    def __init__(self, service_name, operation_name, retry_after):
+        self.retry_after = retry_after
+        super().__init__(
+            {
+                "Error": {
+                    "Code": "CircuitOpen",
+                    "Message": "The %s API is unavailable, retry in %s seconds"
+                    % (service_name, retry_after),
+                }
+            },
+            operation_name,
+        )
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker for the operations of a Boto3 client, see
+    :meth:`install`.
+    """
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.local = threading.local()
+
+    @property
+    def config(self):
+        return settings.AWS_CONFIG
+
+    def key(self, name):
+        return "circuit-breaker:%s:%s" % (self.service_name, name)
+
+    def install(self, client):
+        """
+        Guard all API calls of the given Boto3 client, including the ones
+        made by its paginators.
+        """
+        events = client.meta.events
+        events.register("before-call.%s" % self.service_name, self.before_call)
+        events.register("after-call.%s" % self.service_name, self.after_call)
+        events.register(
+            "after-call-error.%s" % self.service_name, self.after_call_error
+        )
+        return client
+
+    def state(self):
+        """Return the current state of the circuit."""
+        return self.status()[0]
+
+    def status(self):
+        """
+        Return the current state of the circuit and the seconds until
+        it's half-open if it's open.
+        """
+        pipeline = get_redis_connection().pipeline(transaction=False)
+        pipeline.ttl(self.key("open"))
+        pipeline.exists(self.key("tripped"))
+        open_ttl, tripped = pipeline.execute()
+        if open_ttl is not None and open_ttl > 0:
+            return OPEN, open_ttl
+        if tripped:
+            return HALF_OPEN, 0
+        return CLOSED, 0
+
+    def before_call(self, model, **kwargs):
+        self.local.probing = False
+        try:
+            state, retry_after = self.status()
+            if state == HALF_OPEN:
+                probe_timeout = self.config["EMR_CIRCUIT_PROBE_TIMEOUT"]
+                if get_redis_connection().set(
+                    self.key("probe"), 1, ex=probe_timeout, nx=True
+                ):
+                    self.local.probing = True
+                    return
+                state, retry_after = OPEN, probe_timeout
+        except RedisError:
+            # don't stop talking to AWS just because Redis is gone
+            logger.exception("Checking the %s circuit failed", self.service_name)
+            return
+        if state == OPEN:
+            raise CircuitOpenError(self.service_name, model.name, retry_after)
+
+    def after_call(self, http_response, parsed, **kwargs):
+        error_code = parsed.get("Error", {}).get("Code")
+        if http_response.status_code >= 500 or error_code in FAILURE_ERROR_CODES:
+            self.record_failure()
+        elif getattr(self.local, "probing", False):
+            self.close()
+
+    def after_call_error(self, **kwargs):
+        # e.g. connection errors and timeouts
+        self.record_failure()
+
+    def record_failure(self):
+        """
+        Count a failed call and open the circuit if the failure threshold
+        was reached or the failed call was the probing call.
+        """
+        try:
+            if getattr(self.local, "probing", False):
+                self.trip()
+                return
+            pipeline = get_redis_connection().pipeline()
+            pipeline.incr(self.key("failures"))
+            pipeline.expire(
+                self.key("failures"), self.config["EMR_CIRCUIT_FAILURE_WINDOW"]
+            )
+            failures = pipeline.execute()[0]
+            if failures >= self.config["EMR_CIRCUIT_FAILURE_THRESHOLD"]:
+                self.trip()
+        except RedisError:
+            logger.exception("Recording a %s failure failed", self.service_name)
+        finally:
+            self.local.probing = False
+
+    def trip(self):
+        """Open the circuit."""
+        pipeline = get_redis_connection().pipeline()
+        pipeline.set(self.key("open"), 1, ex=self.config["EMR_CIRCUIT_RESET_TIMEOUT"])
+        pipeline.set(self.key("tripped"), 1)
+        pipeline.delete(self.key("failures"), self.key("probe"))
+        pipeline.execute()
+        logger.warning("Opened the %s circuit", self.service_name)
+        Metric.record("%s-circuit-opened" % self.service_name)
+
+    def close(self):
+        """Close the circuit."""
+        try:
+            get_redis_connection().delete(
+                self.key("open"),
+                self.key("tripped"),
+                self.key("failures"),
+                self.key("probe"),
+            )
+        except RedisError:
+            logger.exception("Closing the %s circuit failed", self.service_name)
+        else:
+            logger.info("Closed the %s circuit", self.service_name)
+            Metric.record("%s-circuit-closed" % self.service_name)
+        finally:
+            self.local.probing = False
+
+
+#: The circuit breaker of the EMR clients, installed by the client registry.
+emr_circuit_breaker = CircuitBreaker("emr")
@@ -8,8 +8,7 @@ from .models import Cluster, EMRRelease
 
 
 def deactivate(modeladmin, request, queryset):
-    for cluster in queryset:
-        cluster.deactivate()
+    Cluster.bulk_deactivate(queryset)
 
 
 @admin.register(Cluster)
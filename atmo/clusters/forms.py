@@ -8,6 +8,7 @@ from django.core.urlresolvers import reverse
 from django.utils.safestring import mark_safe
 
 from . import models
+from .. import quotas
 from ..forms.mixins import AutoClassFormMixin, CreatedByModelFormMixin
 from ..keys.models import SSHKey
 
@@ -134,6 +135,38 @@ class NewClusterForm(AutoClassFormMixin, CreatedByModelFormMixin, forms.ModelFor
                 choices=self.fields["ssh_key"].choices, attrs={"class": "radioset"}
             )
 
+    def clean(self):
+        """
+        Only allow launching clusters within the quotas of the user and
+        their groups, see :mod:`atmo.quotas`.
+        """
+        super().clean()
+        size = self.cleaned_data.get("size")
+        if size is not None:
+            exceeded = quotas.exceeded(self.created_by, clusters=1, instances=size)
+            if exceeded:
+                raise forms.ValidationError(exceeded)
+        return self.cleaned_data
+
+    def reserve_quota(self):
+        """
+        Reserve the quota of the new cluster of the valid form right before
+        it's saved and launched, see :func:`atmo.quotas.reserve`. Returns
+        whether it was reserved, adding an error to the form otherwise.
+        """
+        size = self.cleaned_data["size"]
+        reservation = quotas.reserve(quotas.CLUSTERS, self.created_by, size)
+        if reservation is None:
+            # another cluster took the rest of the quota since it was checked
+            self.add_error(
+                None,
+                quotas.exceeded(self.created_by, clusters=1, instances=size)
+                or "This would exceed your quotas, please try again.",
+            )
+            return False
+        self.instance.quota_reservation = reservation
+        return True
+
 
 class ExtendClusterForm(AutoClassFormMixin, forms.Form):
     prefix = "extend"
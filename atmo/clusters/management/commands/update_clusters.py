@@ -3,7 +3,7 @@
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 from django.core.management.base import BaseCommand
 
-from ...tasks import update_clusters
+from ....tasks import update_emr_statuses
 
 
 class Command(BaseCommand):
@@ -11,5 +11,5 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         self.stdout.write("Updating cluster info...", ending="")
-        update_clusters()
+        update_emr_statuses()
         self.stdout.write("done.")
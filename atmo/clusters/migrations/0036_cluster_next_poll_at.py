@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("clusters", "0035_auto_20180814_1710")]
+
+    operations = [
+        migrations.AddField(
+            model_name="cluster",
+            name="next_poll_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                help_text="Date/time when the AWS status of the cluster is due to be polled.",
+                null=True,
+            ),
+        )
+    ]
@@ -2,13 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 import math
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from autorepr import autorepr, autostr
+from django.conf import settings
 from django.db import models, transaction
 from django.utils import timezone
 
-from ..models import CreatedByModel, EditedAtModel, URLActionModel
+from .. import quotas
+from ..deadlines import DeadlineIndex
+from ..models import CreatedByModel, EditedAtModel, URLActionModel, bulk_update_changes
 from .provisioners import ClusterProvisioner
 from .queries import ClusterQuerySet, EMRReleaseQuerySet
 from atmo.stats.models import Metric
@@ -69,6 +72,12 @@ class EMRReleaseModel(models.Model):
         abstract = True
 
 
+#: The index of the cluster expiration deadlines.
+expiration_deadlines = DeadlineIndex(
+    "cluster-expiration", "atmo.clusters.tasks.deactivate_clusters"
+)
+
+
 class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
     STATUS_STARTING = "STARTING"
     STATUS_BOOTSTRAPPING = "BOOTSTRAPPING"
@@ -174,9 +183,19 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
     expiration_mail_sent = models.BooleanField(
         default=False, help_text="Whether the expiration mail were sent."
     )
+    next_poll_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="Date/time when the AWS status of the cluster is due to be polled.",
+    )
 
     objects = ClusterQuerySet.as_manager()
 
+    #: The quota reserved for the cluster before it's launched, see
+    #: :func:`atmo.quotas.reserve`.
+    quota_reservation = None
+
     class Meta:
         permissions = [
             ("view_cluster", "Can view cluster"),
@@ -241,97 +260,167 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
         """Returns the provisioning information for the cluster."""
         return self.provisioner.info(self.jobflow_id)
 
-    def sync(self, info=None):
-        """Should be called to update latest cluster status in `self.most_recent_status`."""
-        if info is None:
-            info = self.info
+    #: Map AWS API fields to Cluster model fields.
+    SYNC_FIELD_MAP = (
+        ("state", "most_recent_status"),
+        ("public_dns", "master_address"),
+        ("creation_datetime", "started_at"),
+        ("ready_datetime", "ready_at"),
+        ("end_datetime", "finished_at"),
+    )
 
-        # Map AWS API fields to Cluster model fields.
-        model_field_map = (
-            ("state", "most_recent_status"),
-            ("public_dns", "master_address"),
-            ("creation_datetime", "started_at"),
-            ("ready_datetime", "ready_at"),
-            ("end_datetime", "finished_at"),
-        )
-        save_needed = False
+    def apply_info(self, info):
+        """
+        Set the model fields to the values of the given cluster info
+        without saving and return the names of the changed fields and the
+        keyword arguments of the metrics to record for the changes.
+        """
+        changed_fields = []
         date_fields_updated = False
 
         # set the various model fields to the value the API returned
-        for api_field, model_field in model_field_map:
+        for api_field, model_field in self.SYNC_FIELD_MAP:
             field_value = info.get(api_field)
             # Only update the field if the value for a field is not set or it
             # hasn't changed.
             if field_value is None or field_value == getattr(self, model_field):
                 continue
             setattr(self, model_field, field_value)
-            save_needed = True
+            changed_fields.append(model_field)
 
             if model_field in ("started_at", "ready_at", "finished_at"):
                 date_fields_updated = True
 
-        if save_needed:
+        metrics = []
+        if date_fields_updated:
+            data = {
+                "identifier": self.identifier,
+                "size": self.size,
+                "jobflow_id": self.jobflow_id,
+            }
+
+            if self.finished_at:
+                # When cluster is finished, record normalized instance
+                # hours.
+                hours = math.ceil(
+                    (self.finished_at - self.started_at).seconds / 60 / 60
+                )
+                normalized_hours = hours * self.size
+                metrics.append(
+                    {
+                        "key": "cluster-normalized-instance-hours",
+                        "value": normalized_hours,
+                        "data": data,
+                    }
+                )
+
+            # When cluster is ready, record a count and time to ready.
+            if self.ready_at and not self.finished_at:
+                # A simple count to track number of clusters spun up
+                # successfully.
+                metrics.append({"key": "cluster-ready", "data": data})
+                # Time in seconds it took the cluster to be ready.
+                time_to_ready = (self.ready_at - self.started_at).seconds
+                metrics.append(
+                    {
+                        "key": "cluster-time-to-ready",
+                        "value": time_to_ready,
+                        "data": data,
+                    }
+                )
+        return changed_fields, metrics
+
+    def poll_interval(self, now):
+        """
+        Return the time to wait before polling the status of the cluster
+        again, based on the ``CLUSTER_POLL_INTERVALS`` AWS config value.
+
+        Clusters in transitional states like ``BOOTSTRAPPING`` are polled
+        at their configured interval. Clusters in stable states like
+        ``WAITING`` are polled half as often for every hour they have been
+        in it, up to the ``CLUSTER_POLL_MAX_INTERVAL`` AWS config value,
+        but more often again when they are about to expire.
+
+        When the state changes are ingested from EMR events, see
+        :mod:`atmo.events`, clusters are polled at least every
+        ``EMR_EVENTS_RECONCILE_INTERVAL`` seconds (an AWS config value).
+        """
+        config = settings.AWS_CONFIG
+        intervals = config["CLUSTER_POLL_INTERVALS"]
+        min_interval = timedelta(seconds=min(intervals.values()))
+        interval = min_interval
+        if self.most_recent_status in intervals:
+            interval = timedelta(seconds=intervals[self.most_recent_status])
+        if self.most_recent_status in self.READY_STATUS_LIST:
+            stable_since = self.ready_at or self.started_at or self.created_at
+            hours = max(0, int((now - stable_since).total_seconds() // 3600))
+            # the exponent is capped to not overflow for very old clusters
+            interval = min(
+                interval * 2 ** min(hours, 16),
+                timedelta(seconds=config["CLUSTER_POLL_MAX_INTERVAL"]),
+            )
+        if settings.EMR_EVENTS_QUEUE:
+            # the state changes are ingested from events, polling only
+            # reconciles the statuses in case an event got lost
+            interval = max(
+                interval, timedelta(seconds=config["EMR_EVENTS_RECONCILE_INTERVAL"])
+            )
+        if self.expires_at is not None:
+            # approach the expiration in halving steps
+            interval = min(interval, max(min_interval, (self.expires_at - now) / 2))
+        return interval
+
+    def schedule_poll(self, now=None):
+        """
+        Set the date/time the status of the cluster is due to be polled
+        without saving, see :meth:`poll_interval`.
+        """
+        if now is None:
+            now = timezone.now()
+        if self.is_active:
+            self.next_poll_at = now + self.poll_interval(now)
+        else:
+            self.next_poll_at = None
+
+    def sync(self, info=None):
+        """Should be called to update latest cluster status in `self.most_recent_status`."""
+        if info is None:
+            info = self.info
+
+        changed_fields, metrics = self.apply_info(info)
+
+        if changed_fields:
+            self.schedule_poll()
             with transaction.atomic():
                 self.save()
 
         with transaction.atomic():
-            if date_fields_updated:
-
-                if self.finished_at:
-                    # When cluster is finished, record normalized instance
-                    # hours.
-                    hours = math.ceil(
-                        (self.finished_at - self.started_at).seconds / 60 / 60
-                    )
-                    normalized_hours = hours * self.size
-                    Metric.record(
-                        "cluster-normalized-instance-hours",
-                        normalized_hours,
-                        data={
-                            "identifier": self.identifier,
-                            "size": self.size,
-                            "jobflow_id": self.jobflow_id,
-                        },
-                    )
-
-                # When cluster is ready, record a count and time to ready.
-                if self.ready_at and not self.finished_at:
-                    # A simple count to track number of clusters spun up
-                    # successfully.
-                    Metric.record(
-                        "cluster-ready",
-                        data={
-                            "identifier": self.identifier,
-                            "size": self.size,
-                            "jobflow_id": self.jobflow_id,
-                        },
-                    )
-                    # Time in seconds it took the cluster to be ready.
-                    time_to_ready = (self.ready_at - self.started_at).seconds
-                    Metric.record(
-                        "cluster-time-to-ready",
-                        time_to_ready,
-                        data={
-                            "identifier": self.identifier,
-                            "size": self.size,
-                            "jobflow_id": self.jobflow_id,
-                        },
-                    )
+            for metric in metrics:
+                Metric.record(**metric)
+
+        if self.most_recent_status in self.FINAL_STATUS_LIST:
+            quotas.release(quotas.CLUSTERS, [self.pk])
 
     def save(self, *args, **kwargs):
         """Insert the cluster into the database or update it if already
         present, spawning the cluster if it's not already spawned.
         """
         # actually start the cluster
-        if self.jobflow_id is None:
-            self.jobflow_id = self.provisioner.start(
-                user_username=self.created_by.username,
-                user_email=self.created_by.email,
-                identifier=self.identifier,
-                emr_release=self.emr_release.version,
-                size=self.size,
-                public_key=self.ssh_key.key,
-            )
+        launched = self.jobflow_id is None
+        if launched:
+            try:
+                self.jobflow_id = self.provisioner.start(
+                    user_username=self.created_by.username,
+                    user_email=self.created_by.email,
+                    identifier=self.identifier,
+                    emr_release=self.emr_release.version,
+                    size=self.size,
+                    public_key=self.ssh_key.key,
+                )
+            except Exception:
+                if self.quota_reservation is not None:
+                    quotas.release(quotas.CLUSTERS, [self.quota_reservation])
+                raise
             # once we've stored the jobflow id we can fetch the status for the first time
             transaction.on_commit(self.sync)
 
@@ -347,12 +436,39 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
 
         super().save(*args, **kwargs)
 
+        if launched:
+            quotas.claim(
+                quotas.CLUSTERS,
+                self.quota_reservation,
+                self.pk,
+                self.created_by,
+                self.size,
+            )
+            self.quota_reservation = None
+
+        # unless it's an expression, e.g. when extending the lifetime
+        if isinstance(self.expires_at, datetime):
+            self.index_expiration(self.expires_at)
+
+    def index_expiration(self, expires_at):
+        """
+        Add the given expiration date/time of the cluster to the index of
+        expiration deadlines, see :mod:`atmo.deadlines`.
+        """
+        if self.most_recent_status in self.FINAL_STATUS_LIST:
+            expiration_deadlines.remove(self.pk)
+        else:
+            expiration_deadlines.add(self.pk, expires_at)
+
     def extend(self, hours):
         """Extend the cluster lifetime by the given number of hours."""
         self.expires_at = models.F("expires_at") + timedelta(hours=hours)
         self.lifetime_extension_count = models.F("lifetime_extension_count") + 1
         self.expiration_mail_sent = False
         self.save()
+        self.index_expiration(
+            Cluster.objects.values_list("expires_at", flat=True).get(pk=self.pk)
+        )
 
         with transaction.atomic():
             Metric.record(
@@ -365,6 +481,93 @@ class Cluster(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
             )
 
     def deactivate(self):
-        """Shutdown the cluster and update its status accordingly"""
+        """
+        Shutdown the cluster and update its status accordingly. See
+        :meth:`bulk_deactivate` to shutdown many clusters at once.
+        """
         self.provisioner.stop(self.jobflow_id)
         self.sync()
+
+    @classmethod
+    def bulk_deactivate(cls, clusters):
+        """
+        Shutdown the given clusters with as few API calls as possible, see
+        :meth:`~atmo.clusters.provisioners.ClusterProvisioner.bulk_stop`,
+        and update their status afterwards with :meth:`bulk_sync`.
+
+        The new states are fetched by listing the terminating and terminated
+        clusters created since the oldest of the given clusters, and only
+        the clusters that aren't listed are described individually.
+
+        Returns the list of clusters that were found and updated.
+        """
+        clusters = list(clusters)
+        if not clusters:
+            return []
+        provisioner = ClusterProvisioner()
+        jobflow_ids = {cluster.jobflow_id for cluster in clusters}
+        provisioner.bulk_stop(cluster.jobflow_id for cluster in clusters)
+        # leave some room in case AWS treats CreatedAfter as exclusive
+        created_after = min(cluster.created_at for cluster in clusters) - timedelta(
+            minutes=1
+        )
+        infos = {
+            info["jobflow_id"]: info
+            for info in provisioner.list(
+                created_after=created_after,
+                states=(cls.STATUS_TERMINATING,) + cls.FINAL_STATUS_LIST,
+            )
+            if info["jobflow_id"] in jobflow_ids
+        }
+        infos.update(provisioner.bulk_info(sorted(jobflow_ids - set(infos))))
+        return cls.bulk_sync(clusters, infos)
+
+    @classmethod
+    def bulk_sync(cls, clusters, infos=None):
+        """
+        Update the status of the given clusters with the given mapping
+        between jobflow IDs and cluster infos, or by describing them
+        concurrently with
+        :meth:`~atmo.clusters.provisioners.ClusterProvisioner.bulk_info`
+        if no mapping is given.
+
+        Other than :meth:`sync` the changed fields of all clusters are
+        written with a single ``UPDATE`` query and the metrics with a
+        single ``INSERT`` query. The next poll of every updated cluster
+        is scheduled with :meth:`schedule_poll`.
+
+        Returns the list of clusters that were found and updated.
+        """
+        if infos is None:
+            infos = ClusterProvisioner().bulk_info(
+                cluster.jobflow_id for cluster in clusters
+            )
+        now = timezone.now()
+        synced_clusters = []
+        changes = []
+        metrics = []
+        for cluster in clusters:
+            info = infos.get(cluster.jobflow_id)
+            if info is None:
+                continue
+            changed_fields, cluster_metrics = cluster.apply_info(info)
+            cluster.schedule_poll(now)
+            if changed_fields:
+                cluster.modified_at = now
+                changed_fields.append("modified_at")
+            changes.append((cluster, changed_fields + ["next_poll_at"]))
+            metrics.extend(cluster_metrics)
+            synced_clusters.append(cluster)
+
+        with transaction.atomic():
+            bulk_update_changes(cls, changes)
+            if metrics:
+                Metric.bulk_record(metrics)
+        final_pks = [
+            cluster.pk
+            for cluster in synced_clusters
+            if cluster.most_recent_status in cls.FINAL_STATUS_LIST
+        ]
+        quotas.release(quotas.CLUSTERS, final_pks)
+        expiration_deadlines.remove(*final_pks)
+        return synced_clusters
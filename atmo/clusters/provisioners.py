@@ -1,9 +1,24 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import constance
+from botocore.exceptions import BotoCoreError, ClientError
+from django.db import connection
 
 from ..provisioners import Provisioner
+from ..circuitbreaker import CircuitOpenError
+from ..ratelimits import current_lane, lane
+
+logger = logging.getLogger(__name__)
+
+
+def is_validation_error(exc):
+    """Return whether the given ``ClientError`` is due to invalid parameters."""
+    return exc.response.get("Error", {}).get("Code") == "ValidationException"
 
 
 class ClusterProvisioner(Provisioner):
@@ -14,6 +29,8 @@ class ClusterProvisioner(Provisioner):
 
     def __init__(self):
         super().__init__()
+        #: The number of ListClusters result pages fetched by this provisioner.
+        self.list_pages_fetched = 0
 
     def job_flow_params(self, *args, **kwargs):
         """
@@ -81,6 +98,64 @@ class ClusterProvisioner(Provisioner):
         cluster = self.emr.describe_cluster(ClusterId=jobflow_id)["Cluster"]
         return self.format_info(cluster)
 
+    def bulk_info(self, jobflow_ids):
+        """
+        Returns a mapping between the given Jobflow IDs and the cluster
+        infos as returned by :meth:`info`, describing the clusters
+        concurrently on a thread pool with a size of the
+        ``DESCRIBE_CLUSTER_WORKERS`` AWS config value.
+
+        Clusters that can't be described due to an API error or within
+        the ``DESCRIBE_CLUSTER_TIMEOUT`` AWS config value (in seconds) for
+        all calls together are logged and left out of the mapping. A
+        :class:`~atmo.circuitbreaker.CircuitOpenError` is raised though.
+        """
+        # remove duplicates while keeping the order
+        jobflow_ids = list(OrderedDict.fromkeys(jobflow_ids))
+        infos = OrderedDict()
+        if not jobflow_ids:
+            return infos
+        executor = ThreadPoolExecutor(
+            max_workers=min(self.config["DESCRIBE_CLUSTER_WORKERS"], len(jobflow_ids))
+        )
+        try:
+            # describe in the rate limiting lane of the calling thread
+            info = lane(current_lane())(self.info)
+
+            def describe(jobflow_id):
+                try:
+                    return info(jobflow_id)
+                finally:
+                    # the calls may record metrics, e.g. when they are rate
+                    # limited, so don't leak the connection of the thread
+                    connection.close()
+
+            futures = [
+                (jobflow_id, executor.submit(describe, jobflow_id))
+                for jobflow_id in jobflow_ids
+            ]
+            wait(
+                [future for _, future in futures],
+                timeout=self.config["DESCRIBE_CLUSTER_TIMEOUT"],
+            )
+            for jobflow_id, future in futures:
+                if not future.done():
+                    # don't start the calls that are still queued
+                    future.cancel()
+                    logger.error("Timed out describing cluster %s", jobflow_id)
+                    continue
+                try:
+                    infos[jobflow_id] = future.result()
+                except CircuitOpenError:
+                    # the remaining calls would fail fast as well
+                    raise
+                except (BotoCoreError, ClientError):
+                    logger.exception("Failed describing cluster %s", jobflow_id)
+        finally:
+            # don't wait for calls that timed out
+            executor.shutdown(wait=False)
+        return infos
+
     def format_info(self, cluster):
         """
         Formats the data returned by the EMR API for internal ATMO use.
@@ -98,24 +173,30 @@ class ClusterProvisioner(Provisioner):
             "public_dns": cluster.get("MasterPublicDnsName"),
         }
 
-    def list(self, created_after, created_before=None):
+    def list(self, created_after, created_before=None, states=None):
         """
-        Returns a list of cluster infos in the given time frame with the fields:
+        Yields the cluster infos in the given time frame, page by page,
+        with the fields:
         - Jobflow ID
         - state
         - start time
+
+        If given, only clusters in one of the given cluster states
+        (e.g. :attr:`~atmo.clusters.models.Cluster.ACTIVE_STATUS_LIST`)
+        are returned.
         """
         # set some parameters so we don't get *all* clusters ever
         params = {"CreatedAfter": created_after}
         if created_before is not None:
             params["CreatedBefore"] = created_before
+        if states:
+            params["ClusterStates"] = list(states)
 
-        clusters = []
         list_cluster_paginator = self.emr.get_paginator("list_clusters")
         for page in list_cluster_paginator.paginate(**params):
+            self.list_pages_fetched += 1
             for cluster in page.get("Clusters", []):
-                clusters.append(self.format_list(cluster))
-        return clusters
+                yield self.format_list(cluster)
 
     def format_list(self, cluster):
         """
@@ -139,3 +220,35 @@ class ClusterProvisioner(Provisioner):
         Stops the cluster with the given JobFlow ID.
         """
         self.emr.terminate_job_flows(JobFlowIds=[jobflow_id])
+
+    def bulk_stop(self, jobflow_ids):
+        """
+        Stops the clusters with the given JobFlow IDs, sending a single
+        API call for each chunk of the ``TERMINATE_JOB_FLOWS_BATCH_SIZE``
+        AWS config value of IDs.
+
+        Since a single invalid ID fails the whole call, the clusters of a
+        chunk that fails validation are stopped one by one instead, and the
+        invalid IDs are logged and skipped.
+        """
+        # remove duplicates while keeping the order
+        jobflow_ids = list(OrderedDict.fromkeys(jobflow_ids))
+        batch_size = self.config["TERMINATE_JOB_FLOWS_BATCH_SIZE"]
+        for start in range(0, len(jobflow_ids), batch_size):
+            end = start + batch_size
+            chunk = jobflow_ids[start:end]
+            try:
+                self.emr.terminate_job_flows(JobFlowIds=chunk)
+            except ClientError as exc:
+                if not is_validation_error(exc):
+                    raise
+                if len(chunk) == 1:
+                    logger.exception("Failed stopping cluster %s", chunk[0])
+                    continue
+                for jobflow_id in chunk:
+                    try:
+                        self.stop(jobflow_id)
+                    except ClientError as exc:
+                        if not is_validation_error(exc):
+                            raise
+                        logger.exception("Failed stopping cluster %s", jobflow_id)
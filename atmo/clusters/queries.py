@@ -51,6 +51,15 @@ class ClusterQuerySet(models.QuerySet):
         """
         return self.filter(most_recent_status__in=self.model.ACTIVE_STATUS_LIST)
 
+    def due(self, now):
+        """
+        The clusters whose status is due to be polled at the given
+        date/time or that were never polled.
+        """
+        return self.filter(
+            models.Q(next_poll_at__isnull=True) | models.Q(next_poll_at__lte=now)
+        )
+
     def terminated(self):
         """
         The clusters that have an terminated status.
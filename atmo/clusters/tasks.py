@@ -1,41 +1,160 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+import uuid
+import zlib
 from datetime import timedelta
 
 import mail_builder
 from botocore.exceptions import ClientError
+from celery import chord
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 from django.utils import timezone
 
 from ..celery import celery
-from .models import Cluster
+from ..locks import singleton
+from ..ratelimits import BACKGROUND, lane
+from ..stats.models import Metric
+from .models import Cluster, expiration_deadlines
 from .provisioners import ClusterProvisioner
 
 logger = get_task_logger(__name__)
 
+#: The cache key of the persisted ListClusters high-water marks.
+HIGH_WATER_MARK_KEY = "list-clusters-high-water-mark:%s"
+#: The cache key of the clusters and infos of a shard of a sharded sync.
+SHARD_KEY = "cluster-sync-shard:%s:%s"
 
-@celery.task
-def deactivate_clusters():
-    """Deactivate clusters that have been expired."""
+
+def list_active_clusters(name, *querysets, tracked=None):
+    """
+    Return a mapping between jobflow IDs and cluster infos for the given
+    querysets of active records, e.g. :class:`~atmo.clusters.models.Cluster`
+    and :class:`~atmo.jobs.models.SparkJobRun` objects.
+
+    Records created within the ``LIST_CLUSTERS_HORIZON`` AWS config value
+    (in hours) are resolved by listing the clusters in one of the active
+    states, created after the high-water mark that the previous poll with
+    the given name persisted: the creation datetime of the oldest recent
+    cluster that was still active back then. Clusters that have left the
+    active states since, and the stragglers that were created before the
+    horizon, are described individually instead, so a single long running
+    cluster doesn't widen the listed time frame.
+
+    The clusters of all querysets are resolved with the same list call.
+    When only some of the active records are polled, e.g. the ones that
+    are due, the querysets of all of them can be passed as ``tracked``, so
+    the high-water mark also covers the records that aren't polled this
+    time and they don't have to be described individually later.
+
+    The number of fetched pages and formatted clusters are recorded as
+    metrics for every poll.
+    """
+    provisioner = ClusterProvisioner()
+    polled_at = timezone.now()
+    horizon = polled_at - timedelta(hours=settings.AWS_CONFIG["LIST_CLUSTERS_HORIZON"])
+    jobflow_ids = set()
+    recent_jobflow_ids = set()
+    recent_days = []
+    for records in querysets:
+        records = records.filter(jobflow_id__isnull=False)
+        recent_records = records.filter(created_at__gte=horizon)
+        jobflow_ids.update(records.values_list("jobflow_id", flat=True))
+        recent_jobflow_ids.update(recent_records.values_list("jobflow_id", flat=True))
+        recent_days.extend(recent_records.datetimes("created_at", "day")[:1])
+    # the recent records the high-water mark covers
+    tracked_jobflow_ids = set(recent_jobflow_ids)
+    for records in tracked or []:
+        recent_records = records.filter(
+            jobflow_id__isnull=False, created_at__gte=horizon
+        )
+        tracked_jobflow_ids.update(recent_records.values_list("jobflow_id", flat=True))
+        recent_days.extend(recent_records.datetimes("created_at", "day")[:1])
+    cluster_mapping = {}
+    listed_count = 0
+
+    if recent_jobflow_ids:
+        cache_key = HIGH_WATER_MARK_KEY % name
+        created_after = cache.get(cache_key)
+        if created_after is None:
+            # get the created dates of the records, set to the start of the day
+            # to counteract time differences between atmo and AWS and use the
+            # oldest date to limit the ListCluster API call to AWS
+            created_after = min(recent_days)
+        created_after = max(created_after, horizon)
+        logger.debug("Fetching active clusters since %s", created_after)
+
+        creation_datetimes = []
+        for info in provisioner.list(
+            created_after=created_after, states=Cluster.ACTIVE_STATUS_LIST
+        ):
+            listed_count += 1
+            # filter out the clusters that don't relate to the records
+            if info["jobflow_id"] in tracked_jobflow_ids:
+                creation_datetimes.append(info["creation_datetime"])
+            if info["jobflow_id"] in recent_jobflow_ids:
+                cluster_mapping[info["jobflow_id"]] = info
+
+        # leave some room in case AWS treats CreatedAfter as exclusive
+        high_water_mark = min(creation_datetimes, default=polled_at) - timedelta(
+            minutes=1
+        )
+        cache.set(cache_key, high_water_mark, timeout=None)
+
+    # the stragglers and the clusters that aren't active anymore, ignoring
+    # the ones that failed for some reason, e.g. the cluster was deleted
+    # in AWS but it wasn't deleted here yet
+    described_jobflow_ids = jobflow_ids - set(cluster_mapping)
+    cluster_mapping.update(provisioner.bulk_info(sorted(described_jobflow_ids)))
+
+    Metric.record(
+        "cluster-poll-pages", provisioner.list_pages_fetched, data={"task": name}
+    )
+    Metric.record(
+        "cluster-poll-formatted",
+        listed_count + len(described_jobflow_ids),
+        data={"task": name, "described": len(described_jobflow_ids)},
+    )
+    return cluster_mapping
+
+
+@celery.task(bind=True, ignore_result=True)
+@lane(BACKGROUND)
+@singleton(eta_countdown=30)
+def deactivate_clusters(self):
+    """
+    Deactivate clusters that have been expired.
+
+    Runs when the next cluster expires and periodically as a sweep, see
+    :mod:`atmo.deadlines`.
+    """
     now = timezone.now()
     deactivated_clusters = []
-    for cluster in Cluster.objects.active().filter(expires_at__lte=now):
-        with transaction.atomic():
-            deactivated_clusters.append([cluster.identifier, cluster.pk])
-            # The cluster is expired
-            logger.info(
-                "Cluster %s (%s) is expired, deactivating.",
-                cluster.pk,
-                cluster.identifier,
-            )
-            cluster.deactivate()
+    expired_clusters = list(Cluster.objects.active().filter(expires_at__lte=now))
+    for cluster in expired_clusters:
+        deactivated_clusters.append([cluster.identifier, cluster.pk])
+        # The cluster is expired
+        logger.info(
+            "Cluster %s (%s) is expired, deactivating.", cluster.pk, cluster.identifier
+        )
+    # terminate and update the status of all expired clusters at once
+    Cluster.bulk_deactivate(expired_clusters)
+    # run again when the next clusters expire
+    expiration_deadlines.sweep(
+        now,
+        rebuild=lambda: Cluster.objects.active()
+        .exclude(expires_at=None)
+        .values_list("pk", "expires_at"),
+    )
     return deactivated_clusters
 
 
-@celery.task
+@celery.task(ignore_result=True)
+@singleton()
 def send_expiration_mails():
     """Send expiration emails an hour before the cluster expires."""
     deadline = timezone.now() + timedelta(hours=1)
@@ -57,6 +176,7 @@ def send_expiration_mails():
 
 
 @celery.task(max_retries=3, bind=True)
+@lane(BACKGROUND)
 def update_master_address(self, cluster_id, force=False):
     """Update the public IP address for the cluster with the given cluster ID"""
     try:
@@ -73,63 +193,159 @@ def update_master_address(self, cluster_id, force=False):
             cluster.save()
             return master_address
     except ClientError as exc:
-        self.retry(exc=exc, countdown=celery.backoff(self.request.retries))
+        self.retry(exc=exc, countdown=celery.retry_countdown(exc, self.request.retries))
+
+
+def sync_clusters(active_clusters, cluster_mapping):
+    """
+    Update the given active clusters with the cluster infos of the given
+    mapping between jobflow IDs and cluster infos, see
+    :func:`~atmo.clusters.tasks.list_active_clusters`.
+
+    Will queue updating the Cluster's public IP address if needed.
+    """
+    # update the state of the pending clusters in bulk if needed, ignoring
+    # the ones without info, e.g. the cluster was deleted in AWS but it
+    # wasn't deleted here yet
+    with transaction.atomic():
+        synced_clusters = Cluster.bulk_sync(list(active_clusters), cluster_mapping)
+
+        updated_clusters = []
+        for cluster in synced_clusters:
+            updated_clusters.append(cluster.identifier)
+
+            # if not given enqueue a job to update the public IP address
+            # but only if the cluster is running or waiting, so the
+            # API call isn't wasted
+            if (
+                not cluster.master_address
+                and cluster.most_recent_status in cluster.READY_STATUS_LIST
+            ):
+                transaction.on_commit(
+                    lambda cluster=cluster: update_master_address.delay(cluster.id)
+                )
+    return updated_clusters
 
 
-# This task runs every 5 minutes (300 seconds),
-# which fits nicely in the backoff decay of 8 tries total
-@celery.task(max_retries=7, bind=True)
-def update_clusters(self):
+def shard_clusters(active_clusters, cluster_mapping, shard_count):
     """
-    Update the cluster metadata from AWS for the pending clusters.
+    Partition the given active clusters by the hash of their jobflow IDs
+    into the given number of shards, each a dict with the primary keys of
+    its clusters and the infos of the given mapping that belong to them.
+    """
+    shards = [{"cluster_ids": [], "infos": {}} for shard in range(shard_count)]
+    for pk, jobflow_id in active_clusters.values_list("pk", "jobflow_id"):
+        if jobflow_id not in cluster_mapping:
+            continue
+        shard = shards[zlib.crc32(jobflow_id.encode("utf-8")) % shard_count]
+        shard["cluster_ids"].append(pk)
+        shard["infos"][jobflow_id] = cluster_mapping[jobflow_id]
+    return [shard for shard in shards if shard["cluster_ids"]]
+
 
-    - To be used periodically.
-    - Won't update state if not needed.
-    - Will queue updating the Cluster's public IP address if needed.
+def fan_out_sync_clusters(name, active_clusters, cluster_mapping, started_at):
     """
-    # only update the cluster info for clusters that are pending
-    active_clusters = Cluster.objects.active()
+    Update the given active clusters with the cluster infos of the given
+    mapping like :func:`sync_clusters`, but in parallel on the Celery
+    workers if there are more clusters than the
+    ``CLUSTER_SYNC_FAN_OUT_THRESHOLD`` AWS config value.
 
-    # Short-circuit for no active clusters (e.g. on weekends)
-    if not active_clusters.exists():
-        return []
+    The clusters are partitioned into ``CLUSTER_SYNC_SHARDS`` shards (an
+    AWS config value) that are synced by a group of
+    :func:`sync_cluster_shard` tasks, followed by the
+    :func:`report_cluster_sync` task that records their aggregated timings.
+    The shards are passed through the cache to keep the task messages small.
 
-    # get the start dates of the active clusters, set to the start of the day
-    # to counteract time differences between atmo and AWS and use the oldest
-    # start date to limit the ListCluster API call to AWS
-    oldest_created_at = active_clusters.datetimes("created_at", "day")
+    Returns the identifiers of the updated clusters if they were synced
+    right away, or the ID of the sync otherwise.
+    """
+    config = settings.AWS_CONFIG
+    if len(cluster_mapping) <= config["CLUSTER_SYNC_FAN_OUT_THRESHOLD"]:
+        return sync_clusters(active_clusters, cluster_mapping)
 
+    sync_id = uuid.uuid4().hex
+    shards = shard_clusters(
+        active_clusters, cluster_mapping, config["CLUSTER_SYNC_SHARDS"]
+    )
+    cache.set_many(
+        {SHARD_KEY % (sync_id, number): shard for number, shard in enumerate(shards)},
+        timeout=config["CLUSTER_SYNC_SHARD_TIMEOUT"],
+    )
+    chord(sync_cluster_shard.si(sync_id, number) for number in range(len(shards)))(
+        report_cluster_sync.s(name, sync_id, started_at, time.time())
+    )
+    logger.info("Syncing %s shards of clusters as %s", len(shards), sync_id)
+    return sync_id
+
+
+# keeps its results for the chord, see the CELERY_RESULT_BACKEND setting
+@celery.task(max_retries=3, bind=True)
+@lane(BACKGROUND)
+def sync_cluster_shard(self, sync_id, number):
+    """
+    Update the clusters of the shard with the given number of the sharded
+    sync with the given ID, see :func:`fan_out_sync_clusters`.
+
+    Returns the identifiers of the updated clusters and timings.
+    """
+    started_at = time.time()
+    cache_key = SHARD_KEY % (sync_id, number)
+    shard = cache.get(cache_key)
+    if shard is None:
+        # the shard expired, the next poll will catch up
+        logger.warning("Shard %s of cluster sync %s is gone", number, sync_id)
+        return {"shard": number, "clusters": [], "duration": 0}
+    clusters = Cluster.objects.filter(pk__in=shard["cluster_ids"])
     try:
-        # build a mapping between jobflow ID and cluster info
-        cluster_mapping = {}
-        provisioner = ClusterProvisioner()
-        cluster_list = provisioner.list(created_after=oldest_created_at[0])
-        for cluster_info in cluster_list:
-            cluster_mapping[cluster_info["jobflow_id"]] = cluster_info
-
-        # go through pending clusters and update the state if needed
-        updated_clusters = []
-        for cluster in active_clusters:
-            with transaction.atomic():
-                info = cluster_mapping.get(cluster.jobflow_id)
-                # ignore if no info was found for some reason,
-                # the cluster was deleted in AWS but it wasn't deleted here yet
-                if info is None:
-                    continue
-                # update cluster status
-                cluster.sync(info)
-                updated_clusters.append(cluster.identifier)
-
-                # if not given enqueue a job to update the public IP address
-                # but only if the cluster is running or waiting, so the
-                # API call isn't wasted
-                if (
-                    not cluster.master_address
-                    and cluster.most_recent_status in cluster.READY_STATUS_LIST
-                ):
-                    transaction.on_commit(
-                        lambda: update_master_address.delay(cluster.id)
-                    )
-        return updated_clusters
+        updated_clusters = sync_clusters(clusters, shard["infos"])
     except ClientError as exc:
-        self.retry(exc=exc, countdown=celery.backoff(self.request.retries))
+        self.retry(exc=exc, countdown=celery.retry_countdown(exc, self.request.retries))
+    cache.delete(cache_key)
+    return {
+        "shard": number,
+        "clusters": updated_clusters,
+        "duration": time.time() - started_at,
+    }
+
+
+@celery.task(ignore_result=True)
+def report_cluster_sync(results, name, sync_id, started_at, dispatched_at):
+    """
+    Record the aggregated timings of the shards of the sharded sync with
+    the given ID as metrics, see :func:`fan_out_sync_clusters`.
+
+    Returns the identifiers of all updated clusters.
+    """
+    now = time.time()
+    updated_clusters = []
+    for result in results:
+        updated_clusters.extend(result["clusters"])
+    Metric.record(
+        "cluster-sync-duration",
+        int((now - started_at) * 1000),
+        data={
+            "task": name,
+            "sync_id": sync_id,
+            "shards": len(results),
+            "clusters": len(updated_clusters),
+            # the time it took to list the clusters before dispatching
+            "listing": int((dispatched_at - started_at) * 1000),
+            "slowest_shard": int(
+                max((result["duration"] for result in results), default=0) * 1000
+            ),
+        },
+    )
+    return updated_clusters
+
+
+@celery.task(ignore_result=True)
+def update_clusters():
+    """
+    Kept so that already queued messages still resolve, the clusters are
+    updated by the :func:`~atmo.tasks.update_emr_statuses` task.
+    """
+    from ..tasks import update_emr_statuses
+
+    result = update_emr_statuses()
+    # skipped while another worker is updating the statuses already
+    return result and result["clusters"]
@@ -53,7 +53,7 @@ def new_cluster(request):
         form = NewClusterForm(
             request.user, data=request.POST, files=request.FILES, initial=initial
         )
-        if form.is_valid():
+        if form.is_valid() and form.reserve_quota():
             cluster = form.save()  # this will also magically spawn the cluster for us
             return redirect(cluster)
     context = {"form": form}
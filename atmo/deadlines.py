@@ -0,0 +1,142 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Deadline indexes stored as Redis sorted sets, to run the tasks that act on
+deadlines (e.g. deactivating expired clusters) right when a deadline
+passes instead of scanning the database for due records every minute.
+
+The database stays the source of truth. The tasks still query it for
+the due records and the indexes only decide when that happens:
+
+- The deadlines are added to an index when the records are saved.
+- When a deadline is within the ``DEADLINE_TIMER_WINDOW`` setting (in
+  seconds) its task is sent with an ETA of the deadline, once per
+  distinct deadline. Since the tasks are singletons, these runs are
+  retried shortly instead of skipped while another run holds the lease,
+  see :func:`~atmo.locks.singleton`.
+- The task is also run periodically as a low-frequency sweep, e.g. every
+  15 minutes, which removes the passed deadlines from the index, sends the
+  tasks of the deadlines that have come within the window since and
+  rebuilds the index in case it got lost.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .celery import celery
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineIndex:
+    """
+    A Redis sorted set of the deadlines of records with the given name,
+    with the name of the task to send when a deadline passes.
+    """
+
+    def __init__(self, name, task_name):
+        self.name = name
+        self.task_name = task_name
+        self.key = "deadlines:%s" % name
+
+    @property
+    def window(self):
+        return timedelta(seconds=settings.DEADLINE_TIMER_WINDOW)
+
+    def add(self, member, deadline):
+        """
+        Add or update the deadline of the given member and send the task
+        if the deadline is within the timer window. Removes the member if
+        the deadline is ``None``.
+        """
+        if deadline is None:
+            self.remove(member)
+            return
+        try:
+            get_redis_connection().execute_command(
+                "ZADD", self.key, deadline.timestamp(), member
+            )
+            self.arm([deadline], timezone.now())
+        except RedisError:
+            # the sweep will catch up
+            logger.exception("Adding the %s deadline of %s failed", self.name, member)
+
+    def remove(self, *members):
+        """Remove the deadlines of the given members."""
+        if not members:
+            return
+        try:
+            get_redis_connection().zrem(self.key, *members)
+        except RedisError:
+            logger.exception(
+                "Removing the %s deadlines of %s failed", self.name, list(members)
+            )
+
+    def rebuild(self, deadlines):
+        """
+        Replace the index with the given iterable of members and their
+        deadlines, e.g. from a ``values_list`` query.
+        """
+        args = []
+        for member, deadline in deadlines:
+            args.extend([deadline.timestamp(), member])
+        pipeline = get_redis_connection().pipeline()
+        pipeline.delete(self.key)
+        if args:
+            pipeline.execute_command("ZADD", self.key, *args)
+        pipeline.execute()
+
+    def upcoming(self, until):
+        """
+        Return the list of members and their deadlines up to the given
+        date/time, ordered by deadline.
+        """
+        return [
+            (member.decode("utf-8"), datetime.fromtimestamp(score, timezone.utc))
+            for member, score in get_redis_connection().zrangebyscore(
+                self.key, "-inf", until.timestamp(), withscores=True
+            )
+        ]
+
+    def arm(self, deadlines, now):
+        """
+        Send the task with an ETA of each of the given deadlines that are
+        within the timer window, unless it was sent for a deadline already.
+        Returns the number of sent tasks.
+        """
+        redis = get_redis_connection()
+        armed = 0
+        for deadline in sorted(set(deadlines)):
+            if not now < deadline <= now + self.window:
+                continue
+            timer_key = "deadline-timer:%s:%s" % (self.name, int(deadline.timestamp()))
+            timeout = int(self.window.total_seconds()) * 2
+            if redis.set(timer_key, 1, ex=timeout, nx=True):
+                # a second later to not race the deadline itself
+                celery.send_task(self.task_name, eta=deadline + timedelta(seconds=1))
+                armed += 1
+        return armed
+
+    def sweep(self, now, rebuild):
+        """
+        Remove the deadlines that have passed by the given date/time and
+        send the tasks of the ones within the timer window, rebuilding the
+        index from the deadlines returned by the given callable first if
+        the index doesn't exist. Returns the number of sent tasks.
+        """
+        redis = get_redis_connection()
+        try:
+            if not redis.exists(self.key):
+                self.rebuild(rebuild())
+            redis.zremrangebyscore(self.key, "-inf", now.timestamp())
+            upcoming = self.upcoming(now + self.window)
+            return self.arm([deadline for member, deadline in upcoming], now)
+        except RedisError:
+            logger.exception("Sweeping the %s deadlines failed", self.name)
+            return 0
@@ -0,0 +1,178 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Queues of EMR "Cluster State Change" events, as sent by CloudWatch Events
+(EventBridge) for every state change of an EMR cluster, e.g.::
+
+    {
+        "source": "aws.emr",
+        "detail-type": "EMR Cluster State Change",
+        "time": "2017-01-01T12:00:00Z",
+        "detail": {
+            "clusterId": "j-1234567890ABC",
+            "state": "TERMINATED",
+            "stateChangeReason": "{\\"code\\": \\"USER_REQUEST\\"}",
+            ...
+        }
+    }
+
+The queue is selected with the ``EMR_EVENTS_QUEUE`` setting:
+
+- ``"sqs"`` -- the SQS queue with the URL of the ``EMR_EVENTS_QUEUE_URL``
+  setting that a CloudWatch Events rule sends the events to.
+- ``"redis"`` -- a Redis list, e.g. for local development and testing.
+- ``"memory"`` -- a list in the memory of the current process for testing.
+
+The events are ingested by the :func:`~atmo.tasks.ingest_emr_events` task.
+"""
+
+import json
+import threading
+from collections import deque
+
+import dateutil.parser
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from .provisioners import clients
+
+#: The detail type of the ingested events.
+CLUSTER_STATE_CHANGE = "EMR Cluster State Change"
+
+
+def parse_event(event):
+    """
+    Return a partial cluster info like the ones returned by
+    :meth:`~atmo.clusters.provisioners.ClusterProvisioner.info` for the
+    given event, or ``None`` if it's not a cluster state change event.
+    """
+    if event.get("detail-type") != CLUSTER_STATE_CHANGE:
+        return None
+    detail = event.get("detail") or {}
+    if not detail.get("clusterId") or not detail.get("state"):
+        return None
+    try:
+        reason = json.loads(detail.get("stateChangeReason") or "{}")
+    except ValueError:
+        reason = {}
+    info = {
+        "jobflow_id": detail["clusterId"],
+        "state": detail["state"],
+        "state_change_reason_code": reason.get("code"),
+        "state_change_reason_message": reason.get("message"),
+    }
+    if event.get("time"):
+        info["event_datetime"] = dateutil.parser.parse(event["time"])
+    return info
+
+
+class MemoryQueue:
+    """An event queue in the memory of the current process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = deque()
+
+    def put(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def receive(self, max_count):
+        """
+        Return a list of up to the given number of received events with
+        the handles to acknowledge them with.
+        """
+        received = []
+        with self.lock:
+            while self.events and len(received) < max_count:
+                received.append((None, self.events.popleft()))
+        return received
+
+    def ack(self, handles):
+        """Delete the received events with the given handles."""
+
+
+class RedisListQueue:
+    """An event queue in a Redis list with the given key."""
+
+    def __init__(self, key="emr-events"):
+        self.key = key
+
+    def put(self, event):
+        get_redis_connection().rpush(self.key, json.dumps(event))
+
+    def receive(self, max_count):
+        pipeline = get_redis_connection().pipeline()
+        pipeline.lrange(self.key, 0, max_count - 1)
+        pipeline.ltrim(self.key, max_count, -1)
+        messages = pipeline.execute()[0]
+        return [(None, json.loads(message)) for message in messages]
+
+    def ack(self, handles):
+        pass
+
+
+class SQSQueue:
+    """An SQS queue with the given URL."""
+
+    #: The max number of messages per SQS API call.
+    batch_size = 10
+
+    def __init__(self, url):
+        self.url = url
+        self.sqs = clients.client("sqs", region_name=settings.AWS_CONFIG["AWS_REGION"])
+
+    def put(self, event):
+        self.sqs.send_message(QueueUrl=self.url, MessageBody=json.dumps(event))
+
+    def receive(self, max_count):
+        received = []
+        while len(received) < max_count:
+            response = self.sqs.receive_message(
+                QueueUrl=self.url,
+                MaxNumberOfMessages=min(self.batch_size, max_count - len(received)),
+                WaitTimeSeconds=0,
+            )
+            messages = response.get("Messages", [])
+            if not messages:
+                break
+            for message in messages:
+                try:
+                    event = json.loads(message["Body"])
+                except ValueError:
+                    event = {}
+                received.append((message["ReceiptHandle"], event))
+        return received
+
+    def ack(self, handles):
+        handles = list(handles)
+        batch_size = self.batch_size
+        for start in range(0, len(handles), batch_size):
+            end = start + batch_size
+            batch = handles[start:end]
+            self.sqs.delete_message_batch(
+                QueueUrl=self.url,
+                Entries=[
+                    {"Id": str(index), "ReceiptHandle": handle}
+                    for index, handle in enumerate(batch)
+                ],
+            )
+
+
+_memory_queue = MemoryQueue()
+
+
+def get_queue():
+    """
+    Return the event queue configured with the ``EMR_EVENTS_QUEUE``
+    setting or ``None`` if the events aren't ingested.
+    """
+    backend = settings.EMR_EVENTS_QUEUE
+    if backend == "sqs":
+        return SQSQueue(settings.EMR_EVENTS_QUEUE_URL)
+    elif backend == "redis":
+        return RedisListQueue()
+    elif backend == "memory":
+        return _memory_queue
+    return None
@@ -0,0 +1,287 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+An admission controller for the runs of scheduled Spark jobs, so that the
+jobs scheduled at the same time (e.g. at midnight UTC) don't all launch
+their EMR clusters at once.
+
+A run is admitted when the number of clusters currently launching and the
+total number of instances of the active clusters and Spark job runs stay
+within the ``PROVISIONING_MAX_LAUNCHES`` and ``PROVISIONING_MAX_INSTANCES``
+AWS config values, and a launch token is available. Launch tokens are
+refilled so that at most ``PROVISIONING_WINDOW_LAUNCHES`` runs are launched
+per ``PROVISIONING_WINDOW`` seconds, after an initial burst of
+``PROVISIONING_BURST`` runs.
+
+Runs that aren't admitted are queued in a Redis sorted set ordered by
+priority class and then by the time they were queued, and admitted by the
+:func:`~atmo.jobs.tasks.admit_queued_runs` task as capacity frees up. The
+task is sent with a countdown when a run is queued and again after every
+drain that left runs in the queue, see :meth:`AdmissionController.arm`,
+and only runs periodically as a slow safety net otherwise. The
+queue depth and the time runs waited in it are recorded with the
+``provisioning-queue-depth`` and ``provisioning-queue-wait`` metrics.
+
+Runs of Spark jobs whose owners are over their quotas (see
+:mod:`atmo.quotas`) are queued as well, until their other runs finished.
+
+Runs started by users with the "Run now" button are launched right away,
+but count against the limits, unless their owner is over quota, in which
+case they are queued as well.
+"""
+
+import json
+import logging
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Sum
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .. import quotas
+from ..celery import celery
+from ..clusters.models import Cluster
+from ..ratelimits import RateLimiter
+from ..stats.models import Metric
+from .models import DEFAULT_STATUS, SparkJob, SparkJobRun
+
+logger = logging.getLogger(__name__)
+
+#: The priority class of the first runs of new Spark jobs.
+PRIORITY_FIRST_RUN = 0
+#: The priority class of the runs of daily Spark jobs.
+PRIORITY_DAILY = 1
+#: The priority class of the runs of weekly Spark jobs.
+PRIORITY_WEEKLY = 2
+#: The priority class of the runs of monthly Spark jobs.
+PRIORITY_MONTHLY = 3
+
+#: The key of the sorted set of the queued Spark jobs by primary key.
+QUEUE_KEY = "provisioning-queue"
+#: The key of the hash of the queued runs by Spark job primary key.
+RUNS_KEY = "provisioning-queue:runs"
+#: The key that exists while the drain of the queue is armed.
+TIMER_KEY = "provisioning-queue:timer"
+#: The seconds after which the queue is drained while runs are queued.
+DRAIN_INTERVAL = 15
+
+LAUNCHING_STATUS_LIST = [Cluster.STATUS_STARTING, Cluster.STATUS_BOOTSTRAPPING]
+
+
+def priority(spark_job, first_run=False):
+    """
+    Return the priority class of the run of the given Spark job. First runs
+    have a user waiting for them and jobs with shorter intervals have less
+    time to catch up with a delay.
+    """
+    if first_run:
+        return PRIORITY_FIRST_RUN
+    if spark_job.interval_in_hours <= SparkJob.INTERVAL_DAILY:
+        return PRIORITY_DAILY
+    if spark_job.interval_in_hours <= SparkJob.INTERVAL_WEEKLY:
+        return PRIORITY_WEEKLY
+    return PRIORITY_MONTHLY
+
+
+class AdmissionController:
+    """
+    Admits the runs of Spark jobs within the global provisioning limits or
+    queues them, see :meth:`admit` and :meth:`drain`.
+    """
+
+    task = "atmo.jobs.tasks.run_job"
+    drain_task = "atmo.jobs.tasks.admit_queued_runs"
+
+    def __init__(self):
+        self.launch_limiter = RateLimiter("provisioning")
+
+    @property
+    def config(self):
+        return settings.AWS_CONFIG
+
+    def usage(self):
+        """
+        Return the number of launching clusters and the total number of
+        instances of the active clusters, including the ones of Spark job
+        runs that haven't been synced with EMR yet.
+        """
+        runs = SparkJobRun.objects.running()
+        clusters = Cluster.objects.active()
+        launching = (
+            runs.filter(status__in=LAUNCHING_STATUS_LIST + [DEFAULT_STATUS]).count()
+            + clusters.filter(most_recent_status__in=LAUNCHING_STATUS_LIST).count()
+        )
+        instances = (runs.aggregate(size=Sum("size"))["size"] or 0) + (
+            clusters.aggregate(size=Sum("size"))["size"] or 0
+        )
+        return launching, instances
+
+    def fits(self, launching, instances, size):
+        """
+        Return whether another cluster of the given size may be launched
+        with the given usage. A cluster that's larger than the instance
+        limit by itself may be launched when nothing else is active.
+        """
+        if launching >= self.config["PROVISIONING_MAX_LAUNCHES"]:
+            return False
+        return not instances or (
+            instances + size <= self.config["PROVISIONING_MAX_INSTANCES"]
+        )
+
+    def take_launch_token(self):
+        """Return whether a launch token was available and taken."""
+        limit = {
+            "capacity": self.config["PROVISIONING_BURST"],
+            "rate": self.config["PROVISIONING_WINDOW_LAUNCHES"]
+            / self.config["PROVISIONING_WINDOW"],
+        }
+        return self.launch_limiter.take("launch", limit, 0) <= 0
+
+    def depth(self):
+        """Return the number of queued runs."""
+        return get_redis_connection().zcard(QUEUE_KEY)
+
+    def enqueue(self, spark_job, first_run=False):
+        """
+        Queue the run of the given Spark job unless it's queued already.
+        Returns whether it was queued.
+        """
+        now = time.time()
+        run_priority = priority(spark_job, first_run)
+        run = {"first_run": first_run, "priority": run_priority, "queued_at": now}
+        pipeline = get_redis_connection().pipeline()
+        # Unix timestamps are well below 10 ** 10 until the year 2286
+        pipeline.execute_command(
+            "ZADD", QUEUE_KEY, "NX", run_priority * 10 ** 10 + now, spark_job.pk
+        )
+        pipeline.hsetnx(RUNS_KEY, spark_job.pk, json.dumps(run))
+        added, _ = pipeline.execute()
+        if added:
+            self.arm()
+        return bool(added)
+
+    def arm(self, countdown=DRAIN_INTERVAL):
+        """
+        Send the task that drains the queue with the given countdown in
+        seconds, unless it was sent within the countdown already. Returns
+        whether it was sent.
+        """
+        if not get_redis_connection().set(TIMER_KEY, 1, ex=countdown, nx=True):
+            return False
+        celery.send_task(self.drain_task, countdown=countdown)
+        return True
+
+    def dequeue(self, pk):
+        """
+        Remove the queued run of the Spark job with the given primary key
+        and return it, or ``None`` if it wasn't queued.
+        """
+        pipeline = get_redis_connection().pipeline()
+        pipeline.zrem(QUEUE_KEY, pk)
+        pipeline.hget(RUNS_KEY, pk)
+        pipeline.hdel(RUNS_KEY, pk)
+        removed, run, _ = pipeline.execute()
+        if not removed:
+            return None
+        return json.loads(run.decode("utf-8")) if run else {}
+
+    def admit(self, spark_job, first_run=False):
+        """
+        Return whether the run of the given Spark job may be launched now,
+        or queue it and return ``False``. Runs are only admitted directly
+        if no other runs are queued, so they can't overtake them, and if
+        the owner of the Spark job is within their quotas, see
+        :mod:`atmo.quotas`.
+        """
+        try:
+            over_quota = quotas.exceeded(
+                spark_job.created_by, runs=1, instances=spark_job.size
+            )
+            if not over_quota and not self.depth():
+                launching, instances = self.usage()
+                if self.fits(launching, instances, spark_job.size):
+                    if self.take_launch_token():
+                        return True
+            if self.enqueue(spark_job, first_run):
+                logger.info(
+                    "Queued the run of Spark job %s%s",
+                    spark_job.pk,
+                    " over quota" if over_quota else "",
+                )
+            return False
+        except RedisError:
+            # don't stop running jobs just because Redis is gone
+            logger.exception("Admitting the run of Spark job %s failed", spark_job.pk)
+            return True
+
+    def drain(self, batch_size=100):
+        """
+        Send the queued runs in order while they are within the limits,
+        up to the given number. Runs of users who are over quota are
+        skipped, so they don't hold up the runs of others. Returns the
+        primary keys of the Spark jobs whose runs were sent.
+        """
+        redis = get_redis_connection()
+        pks = [int(pk) for pk in redis.zrange(QUEUE_KEY, 0, -1)]
+        spark_jobs = SparkJob.objects.prefetch_related("created_by__groups").in_bulk(
+            pks
+        )
+        launching, instances = self.usage()
+        # the runs and instances sent per user that aren't counted yet
+        sent = defaultdict(lambda: [0, 0])
+        admitted = []
+        for pk in pks:
+            if len(admitted) >= batch_size:
+                break
+            spark_job = spark_jobs.get(pk)
+            if spark_job is None:
+                self.dequeue(pk)
+                continue
+            if not self.fits(launching, instances, spark_job.size):
+                break
+            sent_runs, sent_instances = sent[spark_job.created_by_id]
+            if quotas.exceeded(
+                spark_job.created_by,
+                runs=sent_runs + 1,
+                instances=sent_instances + spark_job.size,
+            ):
+                continue
+            if not self.take_launch_token():
+                break
+            run = self.dequeue(pk)
+            if run is None:
+                continue
+            celery.send_task(
+                self.task,
+                args=(pk,),
+                kwargs={"first_run": run.get("first_run", False), "admitted": True},
+            )
+            launching += 1
+            instances += spark_job.size
+            sent[spark_job.created_by_id] = [
+                sent_runs + 1,
+                sent_instances + spark_job.size,
+            ]
+            admitted.append(pk)
+            waited = time.time() - run.get("queued_at", time.time())
+            Metric.record(
+                "provisioning-queue-wait",
+                int(round(waited * 1000)),
+                data={"priority": run.get("priority")},
+            )
+
+        depth = redis.zcard(QUEUE_KEY)
+        if depth:
+            self.arm()
+        if depth or admitted:
+            Metric.record(
+                "provisioning-queue-depth", depth, data={"admitted": len(admitted)}
+            )
+        return admitted
+
+
+#: The admission controller of the Spark job runs.
+admission = AdmissionController()
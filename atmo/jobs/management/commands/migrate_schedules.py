@@ -0,0 +1,27 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from django.core.management.base import BaseCommand
+
+from ...schedules import SCHEDULERS, DueJobSchedule
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the Spark job schedule entries to the given scheduler, "
+        "after changing the SPARK_JOB_SCHEDULER setting to it"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("scheduler", choices=sorted(SCHEDULERS))
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            "Moving Spark job schedule entries to %s..." % options["scheduler"],
+            ending="",
+        )
+        if options["scheduler"] == "due-set":
+            moved = DueJobSchedule.migrate_from_redbeat()
+        else:
+            moved = DueJobSchedule.migrate_to_redbeat()
+        self.stdout.write("done, moved %s." % moved)
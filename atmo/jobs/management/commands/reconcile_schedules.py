@@ -0,0 +1,24 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from django.core.management.base import BaseCommand
+
+from ...schedules import reconcile
+
+
+class Command(BaseCommand):
+    help = "Compare the Spark jobs with their scheduler entries and repair them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the differences without repairing them",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Reconciling Spark job schedules...", ending="")
+        drift = reconcile(repair=not options["dry_run"])
+        self.stdout.write("done.")
+        for name in ["expected", "found", "missing", "orphaned", "stale"]:
+            self.stdout.write("%s: %s" % (name, drift[name]))
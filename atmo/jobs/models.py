@@ -5,13 +5,15 @@ import math
 from datetime import timedelta
 
 from autorepr import autorepr, autostr
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.utils import timezone
 from django.utils.functional import cached_property
 
+from .. import quotas
 from ..clusters.models import Cluster, EMRReleaseModel
 from ..clusters.provisioners import ClusterProvisioner
-from ..models import CreatedByModel, EditedAtModel, URLActionModel
+from ..deadlines import DeadlineIndex
+from ..models import CreatedByModel, EditedAtModel, URLActionModel, bulk_update_changes
 from ..stats.models import Metric
 
 from .provisioners import SparkJobProvisioner
@@ -19,6 +21,9 @@ from .queries import SparkJobQuerySet, SparkJobRunQuerySet
 
 DEFAULT_STATUS = ""
 
+#: The index of the Spark job end date deadlines.
+lapse_deadlines = DeadlineIndex("spark-job-lapse", "atmo.jobs.tasks.expire_jobs")
+
 
 class SparkJob(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
     """
@@ -26,6 +31,11 @@ class SparkJob(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
     run on AWS EMR.
     """
 
+    #: The fields that the schedule entry of the job depends on.
+    SCHEDULE_FIELDS = ["interval_in_hours", "start_date", "end_date"]
+    #: The values of the schedule fields as last saved, see :meth:`save`.
+    _saved_schedule_fields = None
+
     INTERVAL_DAILY = 24
     INTERVAL_WEEKLY = INTERVAL_DAILY * 7
     INTERVAL_MONTHLY = INTERVAL_DAILY * 30
@@ -93,6 +103,28 @@ class SparkJob(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
     url_prefix = "jobs"
     url_actions = ["delete", "detail", "download", "edit", "run", "zeppelin"]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_schedule_fields = instance.schedule_fields()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        # the reloaded values of the schedule fields are the saved ones now
+        saved = list(self._saved_schedule_fields or self.schedule_fields())
+        for index, name in enumerate(self.SCHEDULE_FIELDS):
+            if fields is None or name in fields:
+                saved[index] = self.__dict__.get(name)
+        self._saved_schedule_fields = tuple(saved)
+
+    def schedule_fields(self):
+        """
+        Return the current values of the fields the schedule entry depends
+        on, without loading deferred fields.
+        """
+        return tuple(self.__dict__.get(name) for name in self.SCHEDULE_FIELDS)
+
     def get_absolute_url(self):
         return self.urls.detail
 
@@ -108,9 +140,9 @@ class SparkJob(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
 
     @property
     def schedule(self):
-        from .schedules import SparkJobSchedule
+        from .schedules import get_schedule_class
 
-        return SparkJobSchedule(self)
+        return get_schedule_class()(self)
 
     def has_future_end_date(self, now):
         # no end date means it'll always be due
@@ -225,6 +257,7 @@ class SparkJob(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
             emr_release_version=self.emr_release.version,
             size=self.size,
         )
+        quotas.acquire(quotas.RUNS, run.pk, self.created_by, self.size)
         # Remove the cached latest run to this objects will requery it.
         try:
             delattr(self, "latest_run")
@@ -277,11 +310,19 @@ class SparkJob(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
             delattr(self, "latest_run")
         except AttributeError:  # pragma: no cover
             pass  # It didn't have a `latest_run` and that's ok.
-        # first remove if it exists
-        self.schedule.delete()
-        # and then add it, but only if the end date is in the future
-        if self.has_future_end_date(timezone.now()):
-            self.schedule.add()
+        # only touch the schedule if the fields it depends on changed
+        if self.schedule_fields() != self._saved_schedule_fields:
+            # replace it, but only if the end date is in the future
+            if self.has_future_end_date(timezone.now()):
+                self.schedule.reset()
+            else:
+                self.schedule.delete()
+            self._saved_schedule_fields = self.schedule_fields()
+        # expire the job right when it lapses, see atmo.deadlines
+        if self.expired_date is None:
+            lapse_deadlines.add(self.pk, self.end_date)
+        else:
+            lapse_deadlines.remove(self.pk)
         if first_save:
             transaction.on_commit(self.first_run)
 
@@ -291,6 +332,7 @@ class SparkJob(EMRReleaseModel, CreatedByModel, EditedAtModel, URLActionModel):
         # make sure to clean up the job notebook from storage
         self.provisioner.remove(self.notebook_s3_key)
         self.schedule.delete()
+        lapse_deadlines.remove(self.pk)
         super().delete(*args, **kwargs)
 
 
@@ -356,94 +398,168 @@ class SparkJobRun(EditedAtModel):
     def info(self):
         return self.spark_job.cluster_provisioner.info(self.jobflow_id)
 
-    def sync(self, info=None):
+    #: A mapping between what the provisioner returns what the data model uses.
+    SYNC_FIELD_MAP = (
+        ("state", "status"),
+        ("creation_datetime", "started_at"),
+        ("ready_datetime", "ready_at"),
+        ("end_datetime", "finished_at"),
+    )
+
+    def apply_info(self, info):
         """
-        Updates latest status and life cycle datetimes.
+        Set the status and life cycle datetimes to the values of the given
+        cluster info without saving and return the names of the changed
+        fields and the keyword arguments of the metrics to record for the
+        changes.
         """
-        if info is None:
-            info = self.info
-        # a mapping between what the provisioner returns what the data model uses
-        model_field_map = (
-            ("state", "status"),
-            ("creation_datetime", "started_at"),
-            ("ready_datetime", "ready_at"),
-            ("end_datetime", "finished_at"),
-        )
-        save_needed = False
+        changed_fields = []
         date_fields_updated = False
 
         # set the various model fields to the value the API returned
-        for api_field, model_field in model_field_map:
+        for api_field, model_field in self.SYNC_FIELD_MAP:
             field_value = info.get(api_field)
             if field_value is None or field_value == getattr(self, model_field):
                 continue
             setattr(self, model_field, field_value)
-            save_needed = True
+            changed_fields.append(model_field)
 
             if model_field in ("started_at", "ready_at", "finished_at"):
                 date_fields_updated = True
 
+        metrics = []
+        if date_fields_updated:
+            data = {
+                "identifier": self.spark_job.identifier,
+                "size": self.size,
+                "jobflow_id": self.jobflow_id,
+            }
+
+            # When job cluster is ready, record time to ready.
+            if self.ready_at and not self.finished_at:
+                # Time in seconds it took the cluster to be ready.
+                time_to_ready = (self.ready_at - self.started_at).seconds
+                metrics.append(
+                    {
+                        "key": "sparkjob-time-to-ready",
+                        "value": time_to_ready,
+                        "data": data,
+                    }
+                )
+
+            if self.finished_at:
+                # When job is finished, record normalized instance hours.
+                hours = math.ceil(
+                    (self.finished_at - self.started_at).seconds / 60 / 60
+                )
+                normalized_hours = hours * self.size
+                metrics.append(
+                    {
+                        "key": "sparkjob-normalized-instance-hours",
+                        "value": normalized_hours,
+                        "data": data,
+                    }
+                )
+
+            if self.finished_at and self.ready_at:
+                # When job is finished, record time in seconds it took the
+                # scheduled job to run. Sometimes `ready_at` won't be
+                # available if the cluster terminated with errors.
+                run_time = (self.finished_at - self.ready_at).seconds
+                metrics.append(
+                    {"key": "sparkjob-run-time", "value": run_time, "data": data}
+                )
+        return changed_fields, metrics
+
+    def sync(self, info=None):
+        """
+        Updates latest status and life cycle datetimes.
+        """
+        if info is None:
+            info = self.info
+
+        changed_fields, metrics = self.apply_info(info)
+
         with transaction.atomic():
             # If the job cluster terminated with error raise the alarm.
             if self.status == Cluster.STATUS_TERMINATED_WITH_ERRORS:
                 transaction.on_commit(lambda: self.alert(info))
 
             # If any data changed, save it.
-            if save_needed:
+            if changed_fields:
                 self.save()
 
         with transaction.atomic():
-            if date_fields_updated:
-                # When job cluster is ready, record time to ready.
-                if self.ready_at and not self.finished_at:
-                    # Time in seconds it took the cluster to be ready.
-                    time_to_ready = (self.ready_at - self.started_at).seconds
-                    Metric.record(
-                        "sparkjob-time-to-ready",
-                        time_to_ready,
-                        data={
-                            "identifier": self.spark_job.identifier,
-                            "size": self.size,
-                            "jobflow_id": self.jobflow_id,
-                        },
-                    )
+            for metric in metrics:
+                Metric.record(**metric)
 
-                if self.finished_at:
-                    # When job is finished, record normalized instance hours.
-                    hours = math.ceil(
-                        (self.finished_at - self.started_at).seconds / 60 / 60
-                    )
-                    normalized_hours = hours * self.size
-                    Metric.record(
-                        "sparkjob-normalized-instance-hours",
-                        normalized_hours,
-                        data={
-                            "identifier": self.spark_job.identifier,
-                            "size": self.size,
-                            "jobflow_id": self.jobflow_id,
-                        },
-                    )
+        if self.status in Cluster.FINAL_STATUS_LIST:
+            quotas.release(quotas.RUNS, [self.pk])
 
-                if self.finished_at and self.ready_at:
-                    # When job is finished, record time in seconds it took the
-                    # scheduled job to run. Sometimes `ready_at` won't be
-                    # available if the cluster terminated with errors.
-                    run_time = (self.finished_at - self.ready_at).seconds
-                    Metric.record(
-                        "sparkjob-run-time",
-                        run_time,
-                        data={
-                            "identifier": self.spark_job.identifier,
-                            "size": self.size,
-                            "jobflow_id": self.jobflow_id,
-                        },
+        return self.status
+
+    @classmethod
+    def bulk_sync(cls, spark_job_runs, infos):
+        """
+        Update the latest status and life cycle datetimes of the given
+        Spark job runs with the given mapping between jobflow IDs and
+        cluster infos.
+
+        Other than :meth:`sync` the changed fields of all runs are written
+        with a single ``UPDATE`` query, the metrics with a single ``INSERT``
+        query and the alerts of the runs that terminated with errors with
+        another one once the transaction was committed. Use
+        ``prefetch_related("spark_job")`` to prevent looking up the
+        Spark job of each run for the metrics.
+
+        Returns the list of Spark job runs that were found and updated.
+        """
+        now = timezone.now()
+        synced_spark_job_runs = []
+        changes = []
+        metrics = []
+        alerts = []
+        for spark_job_run in spark_job_runs:
+            info = infos.get(spark_job_run.jobflow_id)
+            if info is None:
+                continue
+            changed_fields, run_metrics = spark_job_run.apply_info(info)
+            if changed_fields:
+                spark_job_run.modified_at = now
+                changes.append((spark_job_run, changed_fields + ["modified_at"]))
+            metrics.extend(run_metrics)
+            # If the job cluster terminated with error raise the alarm.
+            if spark_job_run.status == Cluster.STATUS_TERMINATED_WITH_ERRORS:
+                alerts.append(
+                    SparkJobRunAlert(
+                        run=spark_job_run,
+                        reason_code=info["state_change_reason_code"],
+                        reason_message=info["state_change_reason_message"],
                     )
+                )
+            synced_spark_job_runs.append(spark_job_run)
 
-        return self.status
+        with transaction.atomic():
+            bulk_update_changes(cls, changes)
+            if metrics:
+                Metric.bulk_record(metrics)
+            if alerts:
+                transaction.on_commit(
+                    lambda: SparkJobRunAlert.bulk_create_ignoring_conflicts(alerts)
+                )
+        quotas.release(
+            quotas.RUNS,
+            [
+                spark_job_run.pk
+                for spark_job_run in synced_spark_job_runs
+                if spark_job_run.status in Cluster.FINAL_STATUS_LIST
+            ],
+        )
+        return synced_spark_job_runs
 
     def alert(self, info):
         self.alerts.get_or_create(
-            reason_code=info["state_change_reason_code"],
+            reason_code=info["state_change_reason_code"] or "",
             reason_message=info["state_change_reason_message"],
         )
 
@@ -476,6 +592,52 @@ class SparkJobRunAlert(EditedAtModel):
 
     __str__ = autostr("{self.id}")
 
+    @classmethod
+    def bulk_create_ignoring_conflicts(cls, alerts):
+        """
+        Insert the given unsaved alerts with a single query, skipping the
+        ones that already exist for the same run, reason code and reason
+        message instead of failing on the unique constraint.
+
+        Django 1.11's ``bulk_create`` can't ignore conflicts, hence the
+        ``INSERT ... ON CONFLICT DO NOTHING`` query. Missing reason codes
+        are stored as empty strings since NULL values never conflict.
+        """
+        if not alerts:
+            return
+        now = timezone.now()
+        field_names = [
+            "created_at",
+            "modified_at",
+            "run",
+            "reason_code",
+            "reason_message",
+            "mail_sent_date",
+        ]
+        fields = [cls._meta.get_field(field_name) for field_name in field_names]
+        params = []
+        for alert in alerts:
+            alert.created_at = alert.modified_at = now
+            if alert.reason_code is None:
+                alert.reason_code = ""
+            params.extend(
+                field.get_db_prep_save(getattr(alert, field.attname), connection)
+                for field in fields
+            )
+        conflict_columns = [
+            cls._meta.get_field(field_name).column
+            for field_name in cls._meta.unique_together[0]
+        ]
+        row = "(%s)" % ", ".join(["%s"] * len(fields))
+        sql = "INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) DO NOTHING" % (
+            connection.ops.quote_name(cls._meta.db_table),
+            ", ".join(connection.ops.quote_name(field.column) for field in fields),
+            ", ".join([row] * len(alerts)),
+            ", ".join(connection.ops.quote_name(column) for column in conflict_columns),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
     def short_reason_message(self):
         return self.reason_message[:50]
 
@@ -1,6 +1,8 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from datetime import timedelta
+
 from django.db import models
 from django.utils import timezone
 
@@ -46,3 +48,14 @@ class SparkJobRunQuerySet(models.QuerySet):
         The Spark jobs that have an active cluster status.
         """
         return self.filter(status__in=Cluster.ACTIVE_STATUS_LIST)
+
+    def running(self):
+        """
+        The Spark job runs that have an active cluster status or that were
+        launched within the last hour but weren't synced with EMR yet.
+        """
+        # the empty status is the default status of new runs
+        return self.filter(
+            models.Q(status__in=Cluster.ACTIVE_STATUS_LIST)
+            | models.Q(status="", scheduled_at__gte=timezone.now() - timedelta(hours=1))
+        )
@@ -1,17 +1,44 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import json
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
+from itertools import islice
 
 from celery.schedules import schedule
-from redbeat.schedulers import RedBeatSchedulerEntry
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redbeat.decoder import RedBeatJSONEncoder
+from redbeat.schedulers import RedBeatSchedulerEntry, ensure_conf, get_redis
 
 from ..celery import celery
 
 logger = logging.getLogger(__name__)
 
 
+def save_entry(pipeline, entry):
+    """
+    Add the commands of :meth:`RedBeatSchedulerEntry.save` for the given
+    entry to the given pipeline instead of running them in a separate one.
+    """
+    definition = {
+        "name": entry.name,
+        "task": entry.task,
+        "args": entry.args,
+        "kwargs": entry.kwargs,
+        "options": entry.options,
+        "schedule": entry.schedule,
+        "enabled": entry.enabled,
+    }
+    pipeline.hset(
+        entry.key, "definition", json.dumps(definition, cls=RedBeatJSONEncoder)
+    )
+    pipeline.zadd(entry.app.redbeat_conf.schedule_key, entry.score, entry.key)
+
+
 class SparkJobSchedule:
     task = "atmo.jobs.tasks.run_job"
 
@@ -21,6 +48,11 @@ class SparkJobSchedule:
         self.run_every = timedelta(hours=self.spark_job.interval_in_hours)
         self.run_at = self.spark_job.start_date
 
+    @property
+    def key(self):
+        """The Redis key of the scheduler entry."""
+        return ensure_conf(celery).key_prefix + self.name
+
     def create(self):
         entry = RedBeatSchedulerEntry(
             name=self.name,
@@ -42,14 +74,14 @@ class SparkJobSchedule:
         Get the scheduler entry for the task
         """
         try:
-            entry = self.create()
-            return RedBeatSchedulerEntry.from_key(entry.key, app=celery)
+            return RedBeatSchedulerEntry.from_key(self.key, app=celery)
         except KeyError:
             return None
 
-    def add(self):
+    def add(self, pipeline=None):
         """
-        Create and save an entry to the scheduler
+        Create and save an entry to the scheduler, as part of the given
+        Redis pipeline if any
         """
         logger.info(
             "Adding running %s to schedule. "
@@ -57,21 +89,454 @@ class SparkJobSchedule:
             "Starts at: %s." % (self.name, self.run_every, self.run_at)
         )
         entry = self.create()
-        entry.save()
+        if pipeline is None:
+            entry.save()
+        else:
+            save_entry(pipeline, entry)
         return entry
 
-    def delete(self):
+    def delete(self, pipeline=None):
         """
-        If found, delete the entry from the scheduler
+        If found, delete the entry from the scheduler, as part of the
+        given Redis pipeline if any. Returns whether it was found unless
+        a pipeline is given.
         """
-        entry = self.get()
-        if entry is None:
-            return False
-        else:
+        own_pipeline = pipeline is None
+        if own_pipeline:
+            pipeline = get_redis(celery).pipeline()
+        pipeline.zrem(ensure_conf(celery).schedule_key, self.key)
+        pipeline.delete(self.key)
+        if not own_pipeline:
+            return None
+        deleted = bool(pipeline.execute()[-1])
+        if deleted:
             logger.info(
                 "Deleting running %s from schedule. "
                 "Interval: %s. "
                 "Starts at: %s." % (self.name, self.run_every, self.run_at)
             )
-            entry.delete()
-            return True
+        return deleted
+
+    def reset(self):
+        """
+        Replace the entry in the scheduler, e.g. after the interval or
+        start date changed, in a single Redis pipeline
+        """
+        pipeline = get_redis(celery).pipeline()
+        self.delete(pipeline)
+        entry = self.add(pipeline)
+        pipeline.execute()
+        return entry
+
+    @classmethod
+    def bulk_add(cls, spark_jobs):
+        """
+        Add the entries of the given Spark jobs to the scheduler in a
+        single Redis pipeline and return them
+        """
+        pipeline = get_redis(celery).pipeline()
+        entries = [cls(spark_job).add(pipeline) for spark_job in spark_jobs]
+        pipeline.execute()
+        return entries
+
+    @classmethod
+    def bulk_delete(cls, spark_jobs):
+        """
+        Delete the entries of the given Spark jobs from the scheduler in
+        a single Redis pipeline and return the number of found entries
+        """
+        pipeline = get_redis(celery).pipeline()
+        for spark_job in spark_jobs:
+            cls(spark_job).delete(pipeline)
+        # the results of the ZREM and DEL commands of each entry
+        deleted = sum(pipeline.execute()[1::2])
+        logger.info("Deleted %s Spark jobs from schedule.", deleted)
+        return deleted
+
+
+#: Claims the up to ARGV[2] members of the sorted set in KEYS[1] that are
+#: due by the timestamp ARGV[1], by moving them to the timestamp ARGV[3].
+CLAIM_DUE_SCRIPT = """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+for _, member in ipairs(due) do
+    redis.call("ZADD", KEYS[1], ARGV[3], member)
+end
+return due
+"""
+
+
+class DueJobEntry:
+    """
+    The entry of a Spark job in the sorted set of a :class:`DueJobSchedule`,
+    with the same :meth:`reschedule` method as RedBeat entries.
+    """
+
+    def __init__(self, job_schedule, due_at):
+        self.job_schedule = job_schedule
+        self.due_at = due_at
+
+    def reschedule(self, last_run_at=None):
+        """Run the Spark job next an interval after the given last run."""
+        last_run_at = last_run_at or timezone.now()
+        self.due_at = last_run_at + self.job_schedule.run_every
+        get_redis_connection().execute_command(
+            "ZADD",
+            DueJobSchedule.key,
+            self.due_at.timestamp(),
+            self.job_schedule.spark_job.pk,
+        )
+
+
+class DueJobSchedule:
+    """
+    A schedule of Spark jobs in a single Redis sorted set of the timestamps
+    of their next runs by primary key, instead of a RedBeat entry for each
+    job that Celery beat evaluates on every loop.
+
+    The due jobs are claimed in batches and their runs sent by the
+    :func:`~atmo.jobs.tasks.dispatch_due_jobs` task, see :meth:`dispatch`.
+    Selected with the ``SPARK_JOB_SCHEDULER`` setting.
+    """
+
+    task = SparkJobSchedule.task
+    #: The key of the sorted set.
+    key = "spark-job-schedule"
+
+    def __init__(self, spark_job):
+        self.spark_job = spark_job
+        self.run_every = timedelta(hours=self.spark_job.interval_in_hours)
+        self.run_at = self.spark_job.start_date
+
+    def next_run_at(self, now):
+        """
+        Return the first date/time after the given one that is a whole
+        number of intervals after the start date, since the first run at
+        the start date itself is sent by :meth:`SparkJob.first_run`.
+        """
+        intervals = max(1, (now - self.run_at) // self.run_every + 1)
+        return self.run_at + intervals * self.run_every
+
+    def get(self):
+        """Get the entry of the Spark job or ``None`` if it's not scheduled."""
+        score = get_redis_connection().zscore(self.key, self.spark_job.pk)
+        if score is None:
+            return None
+        return DueJobEntry(self, datetime.fromtimestamp(score, timezone.utc))
+
+    def add(self, pipeline=None):
+        """
+        Add or replace the entry of the Spark job, as part of the given
+        Redis pipeline if any
+        """
+        entry = DueJobEntry(self, self.next_run_at(timezone.now()))
+        (pipeline or get_redis_connection()).execute_command(
+            "ZADD", self.key, entry.due_at.timestamp(), self.spark_job.pk
+        )
+        return entry
+
+    def delete(self, pipeline=None):
+        """
+        Delete the entry of the Spark job, as part of the given Redis
+        pipeline if any. Returns whether it was found unless a pipeline is
+        given.
+        """
+        if pipeline is not None:
+            pipeline.zrem(self.key, self.spark_job.pk)
+            return None
+        return bool(get_redis_connection().zrem(self.key, self.spark_job.pk))
+
+    def reset(self):
+        """Replace the entry of the Spark job."""
+        return self.add()
+
+    @classmethod
+    def bulk_add(cls, spark_jobs):
+        """
+        Add the entries of the given Spark jobs in a single Redis pipeline
+        and return them
+        """
+        pipeline = get_redis_connection().pipeline()
+        entries = [cls(spark_job).add(pipeline) for spark_job in spark_jobs]
+        pipeline.execute()
+        return entries
+
+    @classmethod
+    def bulk_delete(cls, spark_jobs):
+        """
+        Delete the entries of the given Spark jobs in a single Redis
+        pipeline and return the number of found entries
+        """
+        pipeline = get_redis_connection().pipeline()
+        for spark_job in spark_jobs:
+            cls(spark_job).delete(pipeline)
+        return sum(pipeline.execute())
+
+    @classmethod
+    def dispatch(cls, batch_size=100, claim_timeout=5 * 60):
+        """
+        Send the runs of the due Spark jobs and schedule their next runs,
+        claiming batches of due jobs first so they are sent only once, or
+        again after the given claim timeout in seconds if sending failed.
+        The next runs of the sent jobs are scheduled even if sending the
+        others failed, which stops the dispatch until the next call.
+        Returns the primary keys of the Spark jobs that were sent.
+        """
+        from .models import SparkJob
+
+        redis = get_redis_connection()
+        claim = redis.register_script(CLAIM_DUE_SCRIPT)
+        dispatched = []
+        while True:
+            now = timezone.now()
+            pks = [
+                int(pk)
+                for pk in claim(
+                    keys=[cls.key],
+                    args=[now.timestamp(), batch_size, now.timestamp() + claim_timeout],
+                )
+            ]
+            if not pks:
+                break
+            spark_jobs = SparkJob.objects.in_bulk(pks)
+            pipeline = redis.pipeline()
+            failed = False
+            for pk in pks:
+                spark_job = spark_jobs.get(pk)
+                if spark_job is None:
+                    pipeline.zrem(cls.key, pk)
+                    continue
+                try:
+                    celery.send_task(cls.task, args=(pk,))
+                except Exception:
+                    # keeps its claim, so it's sent again after the timeout
+                    logger.exception("Sending the run of Spark job %s failed", pk)
+                    failed = True
+                    continue
+                cls(spark_job).add(pipeline)
+                dispatched.append(pk)
+            pipeline.execute()
+            if failed or len(pks) < batch_size:
+                break
+        return dispatched
+
+    @classmethod
+    def migrate_from_redbeat(cls):
+        """
+        Move the RedBeat entries of the Spark jobs that should be scheduled
+        to the sorted set, keeping the times of their next runs. Returns
+        the number of moved entries.
+        """
+        spark_jobs = list(scheduled_spark_jobs())
+        redis = get_redis(celery)
+        pipeline = redis.pipeline(transaction=False)
+        for spark_job in spark_jobs:
+            pipeline.hget(SparkJobSchedule(spark_job).key, "meta")
+        metas = pipeline.execute()
+        now = timezone.now()
+        pipeline = get_redis_connection().pipeline()
+        for spark_job, meta in zip(spark_jobs, metas):
+            job_schedule = cls(spark_job)
+            last_run_at = RedBeatSchedulerEntry.decode_meta(meta)["last_run_at"]
+            if last_run_at is None:
+                due_at = job_schedule.next_run_at(now)
+            else:
+                due_at = last_run_at + job_schedule.run_every
+            pipeline.execute_command("ZADD", cls.key, due_at.timestamp(), spark_job.pk)
+        pipeline.execute()
+        SparkJobSchedule.bulk_delete(spark_jobs)
+        return len(spark_jobs)
+
+    @classmethod
+    def migrate_to_redbeat(cls):
+        """
+        Move the entries of the Spark jobs that should be scheduled from
+        the sorted set to RedBeat entries, keeping the times of their next
+        runs. Returns the number of moved entries.
+        """
+        spark_jobs = list(scheduled_spark_jobs())
+        redis = get_redis_connection()
+        pipeline = redis.pipeline(transaction=False)
+        for spark_job in spark_jobs:
+            pipeline.zscore(cls.key, spark_job.pk)
+        scores = pipeline.execute()
+        pipeline = get_redis(celery).pipeline()
+        for spark_job, score in zip(spark_jobs, scores):
+            job_schedule = SparkJobSchedule(spark_job)
+            job_schedule.delete(pipeline)
+            entry = job_schedule.create()
+            if score is not None:
+                due_at = datetime.fromtimestamp(score, timezone.utc)
+                entry.last_run_at = due_at - job_schedule.run_every
+                meta = {"last_run_at": entry.last_run_at}
+                pipeline.hset(
+                    entry.key, "meta", json.dumps(meta, cls=RedBeatJSONEncoder)
+                )
+            save_entry(pipeline, entry)
+        pipeline.execute()
+        redis.delete(cls.key)
+        return len(spark_jobs)
+
+
+#: The schedule classes by ``SPARK_JOB_SCHEDULER`` setting.
+SCHEDULERS = {"redbeat": SparkJobSchedule, "due-set": DueJobSchedule}
+
+
+def get_schedule_class():
+    """
+    Return the schedule class selected by the ``SPARK_JOB_SCHEDULER``
+    setting.
+    """
+    return SCHEDULERS[settings.SPARK_JOB_SCHEDULER]
+
+
+def scheduled_spark_jobs(now=None):
+    """
+    Return the Spark jobs that should be scheduled, the ones that aren't
+    expired and don't have an end date in the past.
+    """
+    from .models import SparkJob
+
+    return SparkJob.objects.filter(expired_date__isnull=True).filter(
+        Q(end_date__isnull=True) | Q(end_date__gte=now or timezone.now())
+    )
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def reconcile(repair=True, batch_size=1000):
+    """
+    Compare the schedule entries of Spark jobs of the scheduler selected
+    by the ``SPARK_JOB_SCHEDULER`` setting with the Spark jobs that should
+    be scheduled, see :func:`scheduled_spark_jobs`, and repair the
+    differences unless ``repair`` is false.
+
+    Returns the number of expected and found entries and of the
+    ``missing`` ones, ``orphaned`` ones without a Spark job to be
+    scheduled and ``stale`` ones with a different interval or missing
+    from the RedBeat schedule.
+    """
+    expected = dict(scheduled_spark_jobs().values_list("pk", "interval_in_hours"))
+    if get_schedule_class() is DueJobSchedule:
+        drift = reconcile_due_set(expected, repair, batch_size)
+        # the RedBeat entries left over from before switching schedulers
+        drift["orphaned"] += reconcile_redbeat({}, repair, batch_size)["orphaned"]
+        return drift
+    return reconcile_redbeat(expected, repair, batch_size)
+
+
+def reconcile_due_set(expected, repair, batch_size):
+    """
+    Reconcile the sorted set of the :class:`DueJobSchedule` with the given
+    mapping of primary keys and intervals of the expected Spark jobs.
+    """
+    from .models import SparkJob
+
+    redis = get_redis_connection()
+    found = set()
+    orphaned = set()
+    for member, score in redis.zscan_iter(DueJobSchedule.key, count=batch_size):
+        pk = int(member)
+        if pk in expected:
+            found.add(pk)
+        else:
+            orphaned.add(pk)
+    missing = set(expected) - found
+
+    if repair:
+        for batch in batched(orphaned, batch_size):
+            redis.zrem(DueJobSchedule.key, *batch)
+        for batch in batched(sorted(missing), batch_size):
+            DueJobSchedule.bulk_add(SparkJob.objects.filter(pk__in=batch))
+
+    return {
+        "expected": len(expected),
+        "found": len(found),
+        "missing": len(missing),
+        "orphaned": len(orphaned),
+        "stale": 0,
+    }
+
+
+def reconcile_redbeat(expected, repair, batch_size):
+    """
+    Reconcile the RedBeat entries of the :class:`SparkJobSchedule` with
+    the given mapping of primary keys and intervals of the expected Spark
+    jobs, scanning the RedBeat keys in batches of the given size.
+    """
+    from .models import SparkJob
+
+    redis = get_redis(celery)
+    conf = ensure_conf(celery)
+    prefix = conf.key_prefix + SparkJobSchedule.task + ":"
+
+    def parse_pk(key):
+        try:
+            return int(key.rpartition(":")[2])
+        except ValueError:
+            return None
+
+    def run_every(definition):
+        return RedBeatSchedulerEntry.decode_definition(definition)["schedule"].run_every
+
+    found = set()
+    orphaned_keys = set()
+    stale = set()
+    keys = redis.scan_iter(match=prefix + "*", count=batch_size)
+    for batch in batched(keys, batch_size):
+        pipeline = redis.pipeline(transaction=False)
+        for key in batch:
+            pipeline.hget(key, "definition")
+            pipeline.zscore(conf.schedule_key, key)
+        results = pipeline.execute()
+        for key, definition, score in zip(batch, results[::2], results[1::2]):
+            pk = parse_pk(key)
+            if pk not in expected:
+                orphaned_keys.add(key)
+                continue
+            found.add(pk)
+            if (
+                definition is None
+                or score is None
+                or run_every(definition) != timedelta(hours=expected[pk])
+            ):
+                stale.add(pk)
+    # schedule members whose keys are gone
+    for key, score in redis.zscan_iter(
+        conf.schedule_key, match=prefix + "*", count=batch_size
+    ):
+        pk = parse_pk(key)
+        if pk not in expected:
+            orphaned_keys.add(key)
+        elif pk not in found:
+            stale.add(pk)
+    missing = set(expected) - found - stale
+
+    if repair:
+        for batch in batched(orphaned_keys, batch_size):
+            pipeline = redis.pipeline()
+            for key in batch:
+                pipeline.zrem(conf.schedule_key, key)
+                pipeline.delete(key)
+            pipeline.execute()
+        for batch in batched(sorted(missing | stale), batch_size):
+            pipeline = redis.pipeline()
+            for spark_job in SparkJob.objects.filter(pk__in=batch):
+                spark_job_schedule = SparkJobSchedule(spark_job)
+                spark_job_schedule.delete(pipeline)
+                spark_job_schedule.add(pipeline)
+            pipeline.execute()
+
+    return {
+        "expected": len(expected),
+        "found": len(found),
+        "missing": len(missing),
+        "orphaned": len(orphaned_keys),
+        "stale": len(stale),
+    }
@@ -10,10 +10,13 @@ from django.utils import timezone
 
 from atmo.celery import celery
 from atmo.clusters.models import Cluster
-from atmo.clusters.provisioners import ClusterProvisioner
+from atmo.locks import singleton
+from atmo.stats.models import Metric
 
+from . import schedules
+from .admission import DRAIN_INTERVAL, admission
 from .exceptions import SparkJobNotFound, SparkJobNotEnabled
-from .models import SparkJob, SparkJobRun, SparkJobRunAlert
+from .models import SparkJob, SparkJobRun, SparkJobRunAlert, lapse_deadlines
 
 logger = get_task_logger(__name__)
 
@@ -33,12 +36,17 @@ def send_expired_mails():
         message.send()
 
 
-@celery.task
-def expire_jobs():
+@celery.task(bind=True, ignore_result=True)
+@singleton(eta_countdown=30)
+def expire_jobs(self):
     """
     Periodic task to purge all schedule entries
     that don't have a SparkJob instance anymore
+
+    Runs when the next Spark job lapses and periodically as a sweep, see
+    :mod:`atmo.deadlines`.
     """
+    now = timezone.now()
     expired_spark_jobs = []
     for spark_job in SparkJob.objects.lapsed():
         with transaction.atomic():
@@ -53,67 +61,54 @@ def expire_jobs():
                     spark_job.pk,
                     spark_job.identifier,
                 )
-
+    # run again when the next Spark jobs lapse
+    lapse_deadlines.sweep(
+        now,
+        rebuild=lambda: SparkJob.objects.filter(expired_date__isnull=True)
+        .exclude(end_date=None)
+        .values_list("pk", "end_date"),
+    )
     return expired_spark_jobs
 
 
-@celery.task(max_retries=8, bind=True)
-def update_jobs_statuses(self):
+def sync_spark_job_runs(active_spark_job_runs, cluster_mapping):
     """
-    A Celery task that updates the status of all active
-    job runs using the AWS EMR API or retry with an exponential backoff
-    when a certain number of failures have happened.
-
-    This task runs every 15 minutes (900 seconds, see ``CELERY_BEAT_SCHEDULE``
-    setting), which fits nicely in the backoff decay of 9 tries total
+    Update the given active Spark job runs with the cluster infos of the
+    given mapping between jobflow IDs and cluster infos, see
+    :func:`~atmo.clusters.tasks.list_active_clusters`.
     """
-    spark_job_runs = SparkJobRun.objects.all()
-
-    # get the active (read: not terminated or failed) job runs
-    active_spark_job_runs = spark_job_runs.active().prefetch_related("spark_job")
-    logger.debug(
-        "Updating Spark job runs: %s",
-        list(active_spark_job_runs.values_list("pk", flat=True)),
-    )
-
     # create a map between the jobflow ids of the latest runs and the jobs
     spark_job_run_map = {}
     for spark_job_run in active_spark_job_runs:
         spark_job_run_map[spark_job_run.jobflow_id] = spark_job_run
 
-    # get the created dates of the job runs to limit the ListCluster API call
-    provisioner = ClusterProvisioner()
-    runs_created_at = active_spark_job_runs.datetimes("created_at", "day")
+    # ignore the clusters that don't belong to a Spark job run, e.g.
+    # when the mapping was built for clusters as well
+    spark_job_runs = [
+        spark_job_run_map[jobflow_id]
+        for jobflow_id in cluster_mapping
+        if jobflow_id in spark_job_run_map
+    ]
+    logger.debug("Updating job statuses of runs %s", spark_job_runs)
+    # update the Spark job run statuses in bulk
+    updated_spark_job_runs = [
+        [spark_job_run.spark_job.identifier, spark_job_run.pk]
+        for spark_job_run in SparkJobRun.bulk_sync(spark_job_runs, cluster_mapping)
+    ]
+    return updated_spark_job_runs
+
+
+@celery.task(ignore_result=True)
+def update_jobs_statuses():
+    """
+    Kept so that already queued messages still resolve, the Spark job runs
+    are updated by the :func:`~atmo.tasks.update_emr_statuses` task.
+    """
+    from ..tasks import update_emr_statuses
 
-    try:
-        # only fetch a cluster list if there are any runs at all
-        updated_spark_job_runs = []
-        if runs_created_at:
-            earliest_created_at = runs_created_at[0]
-            logger.debug("Fetching clusters since %s", earliest_created_at)
-
-            cluster_list = provisioner.list(created_after=earliest_created_at)
-            logger.debug("Clusters found: %s", cluster_list)
-
-            for cluster_info in cluster_list:
-                # filter out the clusters that don't relate to the job run ids
-                spark_job_run = spark_job_run_map.get(cluster_info["jobflow_id"])
-                if spark_job_run is None:
-                    continue
-                logger.debug(
-                    "Updating job status for %s, run %s",
-                    spark_job_run.spark_job,
-                    spark_job_run,
-                )
-                # update the Spark job run status
-                with transaction.atomic():
-                    spark_job_run.sync(cluster_info)
-                    updated_spark_job_runs.append(
-                        [spark_job_run.spark_job.identifier, spark_job_run.pk]
-                    )
-        return updated_spark_job_runs
-    except ClientError as exc:
-        self.retry(exc=exc, countdown=celery.backoff(self.request.retries))
+    result = update_emr_statuses()
+    # skipped while another worker is updating the statuses already
+    return result and result["spark_job_runs"]
 
 
 class SparkJobRunTask(celery.Task):
@@ -209,10 +204,14 @@ class SparkJobRunTask(celery.Task):
 
 
 @celery.task(bind=True, base=SparkJobRunTask)
-def run_job(self, pk, first_run=False):
+def run_job(self, pk, first_run=False, admitted=False):
     """
     Run the Spark job with the given primary key.
 
+    Unless the run was already admitted from the queue of the provisioning
+    admission controller it is queued when it's over the provisioning
+    limits, see :mod:`atmo.jobs.admission`.
+
     See :class:`~atmo.jobs.tasks.SparkJobRunTask` for more details.
     """
     try:
@@ -231,7 +230,9 @@ def run_job(self, pk, first_run=False):
             # if the latest run of the Spark job has finished
             if spark_job.is_due:
                 # if current datetime is between Spark job's start and end date
-                self.provision_run(spark_job, first_run=first_run)
+                # and the run is within the provisioning limits, or queue it
+                if admitted or admission.admit(spark_job, first_run=first_run):
+                    self.provision_run(spark_job, first_run=first_run)
             else:
                 # otherwise remove the job from the schedule and send
                 # an email to the Spark job owner
@@ -249,10 +250,11 @@ def run_job(self, pk, first_run=False):
                 self.retry(countdown=60 * 10)
 
     except ClientError as exc:
-        self.retry(exc=exc, countdown=celery.backoff(self.request.retries))
+        self.retry(exc=exc, countdown=celery.retry_countdown(exc, self.request.retries))
 
 
-@celery.task
+@celery.task(ignore_result=True)
+@singleton()
 def send_run_alert_mails():
     """
     A Celery task that sends an email to the owner when a Spark job run has
@@ -279,3 +281,48 @@ def send_run_alert_mails():
                 alert.mail_sent_date = timezone.now()
                 alert.save()
     return failed_jobs
+
+
+@celery.task(ignore_result=True)
+@singleton()
+def reconcile_schedules():
+    """
+    A Celery task that repairs the differences between the Spark jobs and
+    their scheduler entries and records them with the
+    ``spark-job-schedule-drift`` metric, see
+    :func:`~atmo.jobs.schedules.reconcile`.
+    """
+    drift = schedules.reconcile()
+    repaired = drift["missing"] + drift["orphaned"] + drift["stale"]
+    if repaired:
+        logger.warning("Repaired the Spark job schedule: %s", drift)
+    Metric.record("spark-job-schedule-drift", repaired, data=drift)
+    return drift
+
+
+@celery.task(ignore_result=True)
+@singleton()
+def dispatch_due_jobs():
+    """
+    A Celery task that sends the runs of the due Spark jobs if the
+    ``SPARK_JOB_SCHEDULER`` setting is ``"due-set"``, see
+    :class:`~atmo.jobs.schedules.DueJobSchedule`.
+    """
+    if settings.SPARK_JOB_SCHEDULER != "due-set":
+        return []
+    return schedules.DueJobSchedule.dispatch()
+
+
+@celery.task(bind=True, ignore_result=True)
+@singleton(eta_countdown=DRAIN_INTERVAL)
+def admit_queued_runs(self):
+    """
+    A Celery task that sends the queued runs of Spark jobs as far as the
+    provisioning limits allow, see
+    :meth:`~atmo.jobs.admission.AdmissionController.drain`.
+
+    Sent when runs are queued, see
+    :meth:`~atmo.jobs.admission.AdmissionController.arm`, and
+    periodically as a safety net.
+    """
+    return admission.drain()
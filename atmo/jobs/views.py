@@ -14,6 +14,7 @@ from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.text import get_valid_filename
 
+from .. import quotas
 from ..clusters.models import EMRRelease
 from ..decorators import (
     change_permission_required,
@@ -21,6 +22,7 @@ from ..decorators import (
     modified_date,
     view_permission_required,
 )
+from .admission import admission
 from .forms import EditSparkJobForm, NewSparkJobForm, SparkJobAvailableForm
 from .models import SparkJob
 
@@ -197,6 +199,22 @@ def run_spark_job(request, id):
                 )
                 return redirect(spark_job)
 
+        exceeded = quotas.exceeded(
+            spark_job.created_by, runs=1, instances=spark_job.size
+        )
+        if exceeded:
+            # run it as soon as the quotas allow, see atmo.jobs.admission
+            admission.enqueue(spark_job)
+            messages.warning(
+                request,
+                mark_safe(
+                    "<h4>Spark job run queued</h4>"
+                    "The Spark job will be run as soon as your quota allows. %s"
+                    % " ".join(exceeded)
+                ),
+            )
+            return redirect(spark_job)
+
         spark_job.run()
         latest_run = spark_job.get_latest_run()
         if latest_run:
@@ -0,0 +1,142 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Leases stored in Redis to make sure only one copy of a periodic Celery
+task runs at the same time across all worker processes, e.g. when a slow
+run overlaps with the next scheduled one or its own retries.
+"""
+
+import functools
+import logging
+import threading
+import uuid
+
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .stats.models import Metric
+
+logger = logging.getLogger(__name__)
+
+# Extends the lease in KEYS[1] if it's still held with the token ARGV[1].
+RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes the lease in KEYS[1] if it's still held with the token ARGV[1].
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class Lease:
+    """
+    A lease with the given name that expires after the given number of
+    seconds unless it's renewed, which happens automatically in a
+    background thread while it's held.
+    """
+
+    def __init__(self, name, timeout):
+        self.key = "lease:%s" % name
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+        #: Whether the lease was lost while it was held, e.g. since it
+        #: expired before it could be renewed.
+        self.lost = False
+        self.stopped = threading.Event()
+        self.renewer = None
+
+    def acquire(self):
+        """Return whether the lease could be acquired."""
+        acquired = get_redis_connection().set(
+            self.key, self.token, px=int(self.timeout * 1000), nx=True
+        )
+        if acquired:
+            self.renewer = threading.Thread(target=self.keep_renewing, daemon=True)
+            self.renewer.start()
+        return bool(acquired)
+
+    def renew(self):
+        """Extend the lease and return whether it's still held."""
+        renewed = get_redis_connection().eval(
+            RENEW_SCRIPT, 1, self.key, self.token, int(self.timeout * 1000)
+        )
+        if not renewed:
+            self.lost = True
+        return bool(renewed)
+
+    def keep_renewing(self):
+        while not self.stopped.wait(self.timeout / 3):
+            try:
+                if not self.renew():
+                    break
+            except RedisError:
+                logger.exception("Renewing the lease %s failed", self.key)
+
+    def release(self):
+        """Stop renewing and release the lease if it's still held."""
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+        if not get_redis_connection().eval(RELEASE_SCRIPT, 1, self.key, self.token):
+            self.lost = True
+
+
+def singleton(timeout=60, eta_countdown=None):
+    """
+    A decorator for Celery task functions that skips a run of the task
+    while another one is still running, using a :class:`Lease` named
+    after the task function with the given timeout in seconds.
+
+    Skipped runs return ``None`` and are counted with the
+    ``task-singleton-skipped`` metric, runs that lost their lease and
+    may therefore have overlapped with another run with the
+    ``task-singleton-overlap`` metric.
+
+    With the ``eta_countdown`` argument, runs of bound tasks that were
+    sent with an ETA (e.g. by :class:`~atmo.deadlines.DeadlineIndex`) are
+    retried after the given number of seconds instead of being skipped,
+    since there may be no other run coming soon to do their work.
+    """
+
+    def decorator(func):
+        name = "%s.%s" % (func.__module__, func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            lease = Lease(name, timeout)
+            try:
+                acquired = lease.acquire()
+            except RedisError:
+                # better run twice than not at all
+                logger.exception("Acquiring the lease of %s failed", name)
+                return func(*args, **kwargs)
+            if not acquired:
+                request = getattr(args[0], "request", None) if args else None
+                if eta_countdown is not None and getattr(request, "eta", None):
+                    logger.info("Retrying %s since it's already running", name)
+                    raise args[0].retry(countdown=eta_countdown)
+                logger.info("Skipping %s since it's already running", name)
+                Metric.record("task-singleton-skipped", data={"task": name})
+                return None
+            try:
+                return func(*args, **kwargs)
+            finally:
+                try:
+                    lease.release()
+                except RedisError:
+                    logger.exception("Releasing the lease of %s failed", name)
+                if lease.lost:
+                    logger.warning("%s lost its lease while running", name)
+                    Metric.record("task-singleton-overlap", data={"task": name})
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,34 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from django import http
+from django.template import loader
+
+from .circuitbreaker import CircuitOpenError
+
+
+class CircuitBreakerMiddleware:
+    """
+    Render a degraded "Service Unavailable" response with a ``Retry-After``
+    header if a view failed fast since the circuit of an AWS API was open,
+    see :mod:`atmo.circuitbreaker`.
+
+    :template: :file:`503.html`
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, CircuitOpenError):
+            return None
+        template = loader.get_template("503.html")
+        response = http.HttpResponse(
+            template.render(request=request, context={"exception": exception}),
+            status=503,
+        )
+        response["Retry-After"] = exception.retry_after
+        return response
@@ -7,6 +7,8 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Cast
 from django.utils import timezone
 from django.utils.functional import cached_property
 
@@ -200,3 +202,41 @@ def next_field_value(
         counter += 1
 
     return field_value
+
+
+def bulk_update_changes(model_cls, changes):
+    """
+    For the given model class update the changed fields of many model
+    instances with a single ``UPDATE`` query, given an iterable of
+    ``(instance, field names)`` pairs.
+
+    Only the given fields of each instance are written, every other column
+    keeps its current value. Returns the number of updated rows.
+    """
+    whens = OrderedDict()
+    pks = []
+    for instance, field_names in changes:
+        for field_name in field_names:
+            whens.setdefault(field_name, []).append(
+                When(
+                    pk=instance.pk,
+                    then=Value(
+                        getattr(instance, field_name),
+                        output_field=model_cls._meta.get_field(field_name),
+                    ),
+                )
+            )
+        pks.append(instance.pk)
+    if not whens:
+        return 0
+
+    updates = {}
+    for field_name, field_whens in whens.items():
+        field = model_cls._meta.get_field(field_name)
+        # cast the CASE expression so Postgres doesn't infer the type
+        # of the values from the parameters
+        updates[field_name] = Cast(
+            Case(*field_whens, default=F(field_name), output_field=field),
+            output_field=field,
+        )
+    return model_cls._default_manager.filter(pk__in=pks).update(**updates)
@@ -0,0 +1,215 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Prometheus metrics of Celery tasks, AWS API calls, views and Redis and
+database round trips, exposed in the Prometheus text format by the
+``/__metrics__`` endpoint of the web processes and, if the
+``PROMETHEUS_WORKER_PORT`` setting is set, an HTTP server started by the
+Celery worker.
+
+If the ``prometheus_multiproc_dir`` environment variable is set to a
+directory, the metrics of all processes that share it (e.g. gunicorn
+workers or Celery prefork children) are aggregated, see the
+`prometheus_client documentation`_. The directory needs to be emptied
+whenever the web server or the worker is restarted, see ``bin/run``.
+
+.. _`prometheus_client documentation`:
+   https://github.com/prometheus/client_python#multiprocess-mode-gunicorn
+"""
+
+import os
+import threading
+import time
+
+import redis
+from celery.utils.time import maybe_iso8601
+from django.conf import settings
+from django.db.backends import utils as db_utils
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    REGISTRY,
+    multiprocess,
+    start_http_server,
+)
+
+#: The runtime of Celery tasks.
+task_runtime = Histogram(
+    "atmo_task_runtime_seconds",
+    "The runtime of Celery tasks",
+    ["task", "outcome"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, float("inf")),
+)
+#: The time Celery tasks wait in the queue until they are started.
+task_queue_latency = Histogram(
+    "atmo_task_queue_latency_seconds",
+    "The time from sending (or the ETA of) Celery tasks until they start",
+    ["task"],
+    buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, float("inf")),
+)
+#: The latency of AWS API calls.
+aws_call_latency = Histogram(
+    "atmo_aws_call_seconds", "The latency of AWS API calls", ["service", "operation"]
+)
+#: The failed AWS API calls.
+aws_call_errors = Counter(
+    "atmo_aws_call_errors_total",
+    "The failed AWS API calls",
+    ["service", "operation", "code"],
+)
+#: The latency of views.
+view_latency = Histogram(
+    "atmo_view_seconds",
+    "The latency of views by URL name",
+    ["view", "method", "status"],
+)
+#: The Redis round trips, counting pipelines once.
+redis_round_trips = Counter("atmo_redis_round_trips_total", "The Redis round trips")
+#: The database queries.
+db_round_trips = Counter(
+    "atmo_db_round_trips_total", "The database round trips", ["database"]
+)
+
+#: The start times of the tasks currently running in this process by task ID.
+_started = {}
+
+#: Whether the Redis and database round trips are counted already.
+_round_trips_counted = False
+
+
+def is_multiprocess():
+    return "prometheus_multiproc_dir" in os.environ
+
+
+def registry():
+    """Return the registry of the metrics to expose."""
+    if not is_multiprocess():
+        return REGISTRY
+    multiprocess_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(multiprocess_registry)
+    return multiprocess_registry
+
+
+class CallMetrics:
+    """
+    Records the latency and errors of the API calls of Boto3 clients, see
+    :meth:`install`.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def install(self, client):
+        """Record the API calls of the given Boto3 client."""
+        events = client.meta.events
+        events.register("before-call", self.before_call)
+        events.register("after-call", self.after_call)
+        events.register("after-call-error", self.after_call_error)
+        return client
+
+    def observe(self, event_name):
+        # e.g. "after-call.emr.DescribeCluster"
+        service, operation = event_name.split(".")[1:3]
+        started_at = getattr(self.local, "started_at", None)
+        if started_at is not None:
+            aws_call_latency.labels(service, operation).observe(
+                time.time() - started_at
+            )
+            self.local.started_at = None
+        return service, operation
+
+    def before_call(self, **kwargs):
+        self.local.started_at = time.time()
+
+    def after_call(self, event_name, http_response, parsed, **kwargs):
+        service, operation = self.observe(event_name)
+        if http_response.status_code >= 300:
+            code = parsed.get("Error", {}).get("Code") or http_response.status_code
+            aws_call_errors.labels(service, operation, code).inc()
+
+    def after_call_error(self, event_name, exception, **kwargs):
+        service, operation = self.observe(event_name)
+        aws_call_errors.labels(service, operation, type(exception).__name__).inc()
+
+
+#: The call metrics of the AWS clients, installed by the client registry.
+aws_call_metrics = CallMetrics()
+
+
+class MetricsMiddleware:
+    """Records the latency of the views by URL name."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started_at = time.time()
+        response = self.get_response(request)
+        match = request.resolver_match
+        view_latency.labels(
+            (match.url_name or match.view_name) if match else "<unresolved>",
+            request.method,
+            response.status_code,
+        ).observe(time.time() - started_at)
+        return response
+
+
+def task_prerun_handler(task_id, task, **kwargs):
+    started_at = time.time()
+    _started[task_id] = started_at
+    sent_at = getattr(task.request, "sent_at", None)
+    if task.request.eta:
+        sent_at = max(sent_at or 0, maybe_iso8601(task.request.eta).timestamp())
+    if sent_at:
+        task_queue_latency.labels(task.name).observe(max(0, started_at - sent_at))
+
+
+def task_postrun_handler(task_id, task, state, **kwargs):
+    started_at = _started.pop(task_id, None)
+    if started_at is not None:
+        task_runtime.labels(task.name, state).observe(time.time() - started_at)
+
+
+def before_task_publish_handler(headers, **kwargs):
+    # read back as the sent_at attribute of the task request
+    headers["sent_at"] = time.time()
+
+
+def worker_ready_handler(**kwargs):
+    if settings.PROMETHEUS_WORKER_PORT:
+        start_http_server(settings.PROMETHEUS_WORKER_PORT, registry=registry())
+
+
+def install_round_trip_counters():
+    """
+    Count the Redis round trips and database queries by patching the
+    Redis client and the database cursor wrapper, once per process.
+    """
+    global _round_trips_counted
+    if _round_trips_counted:
+        return
+    _round_trips_counted = True
+    execute_command = redis.StrictRedis.execute_command
+    execute_pipeline = redis.client.BasePipeline.execute
+
+    def counted_execute_command(self, *args, **options):
+        redis_round_trips.inc()
+        return execute_command(self, *args, **options)
+
+    def counted_execute_pipeline(self, *args, **kwargs):
+        redis_round_trips.inc()
+        return execute_pipeline(self, *args, **kwargs)
+
+    redis.StrictRedis.execute_command = counted_execute_command
+    redis.client.BasePipeline.execute = counted_execute_pipeline
+
+    for name in ["execute", "executemany", "callproc"]:
+        method = getattr(db_utils.CursorWrapper, name)
+
+        def counted(self, *args, method=method, **kwargs):
+            db_round_trips.labels(self.db.alias).inc()
+            return method(self, *args, **kwargs)
+
+        setattr(db_utils.CursorWrapper, name, counted)
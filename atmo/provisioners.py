@@ -1,14 +1,128 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import logging
 import os
+import threading
+from datetime import timedelta
+from functools import partial
 
 import boto3
 import constance
 import requests
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 
+from .circuitbreaker import emr_circuit_breaker
+from .monitoring import aws_call_metrics
+from .ratelimits import emr_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+def install_guards(guards, factory):
+    """
+    Create a client with the given factory and install the given guards,
+    e.g. the circuit breaker and the rate limiter, in the given order.
+    """
+    client = factory()
+    for guard in guards:
+        guard.install(client)
+    return client
+
+
+class ClientRegistry:
+    """
+    A thread-safe, process-wide registry of AWS clients and HTTP sessions,
+    so that provisioners don't have to pay the client construction and
+    TLS handshake costs every time they are instantiated.
+
+    The registry resets itself when it's used in a different process than
+    the one it was populated in, e.g. after gunicorn or Celery prefork
+    workers were forked from their parent process, since boto3 clients and
+    requests sessions hold connection pools that must not be shared
+    across processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        #: The number of times a cached client was returned.
+        self.hits = 0
+        #: The number of times a client had to be created.
+        self.misses = 0
+        self.reset()
+
+    def reset(self):
+        """Throw away all cached clients and sessions."""
+        with self.lock:
+            self.pid = os.getpid()
+            self.instances = {}
+
+    def get(self, key, factory):
+        """
+        Return the instance stored under the given key or create it with
+        the given factory callable if it doesn't exist yet.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # we've been forked since the instances were created
+                self.reset()
+            try:
+                instance = self.instances[key]
+            except KeyError:
+                instance = self.instances[key] = factory()
+                self.misses += 1
+            else:
+                self.hits += 1
+            return instance
+
+    def client(self, service_name, region_name):
+        """
+        Return a Boto3 client for the given service name and region, or
+        a simulated client if the ``AWS_CLIENT_BACKEND`` setting is
+        ``"simulator"``, see :mod:`atmo.simulator`.
+        """
+        backend = settings.AWS_CLIENT_BACKEND
+        if backend == "simulator":
+            from .simulator import simulator
+
+            factory = partial(simulator.client, service_name)
+        else:
+            factory = partial(boto3.client, service_name, region_name=region_name)
+        guards = [aws_call_metrics]
+        if service_name == "emr":
+            # the EMR API calls fail fast while the API is unhealthy and
+            # are rate limited otherwise, across all processes
+            guards += [emr_circuit_breaker, emr_rate_limiter]
+        factory = partial(install_guards, guards, factory)
+        return self.get(("client", backend, service_name, region_name), factory)
+
+    def session(self):
+        """
+        Return a requests session, or a simulated session if the
+        ``AWS_CLIENT_BACKEND`` setting is ``"simulator"``.
+        """
+        backend = settings.AWS_CLIENT_BACKEND
+        if backend == "simulator":
+            from .simulator import simulator
+
+            return self.get(("session", backend), simulator.session)
+        return self.get(("session", backend), requests.session)
+
+    def stats(self):
+        """Return the hit and miss counters of the registry."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.instances),
+            }
+
+
+#: The process-wide client registry used by the provisioners.
+clients = ClientRegistry()
+
 
 class Provisioner:
     """
@@ -36,12 +150,12 @@ class Provisioner:
         self.script_uri = (
             "s3://%s/bootstrap/telemetry.sh" % constance.config.AWS_SPARK_EMR_BUCKET
         )
-        # A Boto3 EMR client instance.
-        self.emr = boto3.client("emr", region_name=self.config["AWS_REGION"])
-        # A Boto3 S3 client instance.
-        self.s3 = boto3.client("s3", region_name=self.config["AWS_REGION"])
-        # A requests session instance.
-        self.session = requests.session()
+        # A shared Boto3 EMR client instance.
+        self.emr = clients.client("emr", region_name=self.config["AWS_REGION"])
+        # A shared Boto3 S3 client instance.
+        self.s3 = clients.client("s3", region_name=self.config["AWS_REGION"])
+        # A shared requests session instance.
+        self.session = clients.session()
 
         # The S3 URI of the script-runner jar file.
         self.jar_uri = (
@@ -71,10 +185,45 @@ class Provisioner:
 
         We store this in S3 to be able to share it between various
         Telemetry services.
+
+        The document is cached in the default cache for the number of
+        seconds configured in the ``SPARK_EMR_CONFIGURATION_TTL`` AWS config
+        value. After that it's revalidated using a conditional request with
+        the ETag of the cached copy, and the stale copy is returned in case
+        fetching the document fails.
         """
-        response = self.session.get(self.spark_emr_configuration_url)
-        response.raise_for_status()
-        return response.json()
+        cache_key = "spark-emr-configuration:%s" % self.spark_emr_configuration_url
+        cached = cache.get(cache_key)
+        now = timezone.now()
+        ttl = timedelta(seconds=self.config["SPARK_EMR_CONFIGURATION_TTL"])
+        if cached is not None and cached["fetched_at"] + ttl > now:
+            return cached["data"]
+
+        kwargs = {}
+        if cached is not None and cached["etag"]:
+            kwargs["headers"] = {"If-None-Match": cached["etag"]}
+        try:
+            response = self.session.get(self.spark_emr_configuration_url, **kwargs)
+            if cached is not None and response.status_code == 304:
+                data, etag = cached["data"], cached["etag"]
+            else:
+                response.raise_for_status()
+                data, etag = response.json(), response.headers.get("ETag")
+        except (requests.RequestException, ValueError):
+            if cached is None:
+                raise
+            logger.exception(
+                "Fetching the Spark EMR configuration failed, using stale copy "
+                "from %s.",
+                cached["fetched_at"],
+            )
+            return cached["data"]
+
+        # store the document without expiration to be able to fall back to it
+        cache.set(
+            cache_key, {"data": data, "etag": etag, "fetched_at": now}, timeout=None
+        )
+        return data
 
     def job_flow_params(self, user_username, user_email, identifier, emr_release, size):
         """
@@ -0,0 +1,323 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Quotas on the number of active clusters, the total number of instances of
+the active clusters and Spark job runs and the number of concurrent Spark
+job runs per user and per group, as configured by the ``USER_QUOTA``,
+``GROUP_QUOTA`` and ``GROUP_QUOTAS`` settings.
+
+The usage of every user and group is kept in Redis counters, so checking
+a quota doesn't need to count rows in the database. The counters are
+updated when clusters and Spark job runs are launched (:func:`acquire`)
+and when they are terminated (:func:`release`), idempotently since every
+resource is recorded with the keys of the counters it was added to. In case
+they drift apart from the database, e.g. when rows are deleted, they are
+recounted periodically with :func:`rebuild`.
+
+Quotas are checked with :func:`exceeded` by the
+:class:`~atmo.clusters.forms.NewClusterForm` and before Spark job runs are
+launched, which are queued by the provisioning admission controller while
+their owner is over quota, see :mod:`atmo.jobs.admission`.
+
+Since two clusters launched at the same time could both pass that check,
+the quota of a new cluster is also reserved atomically with :func:`reserve`
+right before it's launched. The reservation is turned into the
+resource of the cluster with :func:`claim` once it's saved, or released
+if the launch failed.
+"""
+
+import json
+import logging
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError, WatchError
+
+logger = logging.getLogger(__name__)
+
+#: The kinds of resources that are counted, with the instances of both.
+CLUSTERS = "clusters"
+RUNS = "runs"
+INSTANCES = "instances"
+
+#: The key of the hash of the counted resources by resource ID.
+RESOURCES_KEY = "quota-usage"
+
+#: The number of times :func:`rebuild` tries to replace the counters while
+#: they are changed concurrently.
+REBUILD_ATTEMPTS = 5
+
+LABELS = {
+    CLUSTERS: "active clusters",
+    RUNS: "running Spark jobs",
+    INSTANCES: "active instances",
+}
+
+# Records the resource in ARGV[1] and adds it and its size to the counters
+# in KEYS[2:] unless it's recorded already. Returns whether it was added.
+ACQUIRE_SCRIPT = """
+if redis.call("HSETNX", KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call("HINCRBY", KEYS[i], ARGV[3], 1)
+    redis.call("HINCRBY", KEYS[i], "instances", ARGV[4])
+end
+return 1
+"""
+
+# Like the ACQUIRE_SCRIPT, unless that would exceed one of the limits of
+# the resource kind and of instances of the counter in KEYS[i], which are
+# passed as ARGV[2 * i + 1] and ARGV[2 * i + 2], -1 for no limit. Returns
+# whether it was added.
+RESERVE_SCRIPT = (
+    """
+for i = 2, #KEYS do
+    local used = redis.call("HMGET", KEYS[i], ARGV[3], "instances")
+    local limit = tonumber(ARGV[2 * i + 1])
+    if limit >= 0 and (tonumber(used[1]) or 0) + 1 > limit then
+        return 0
+    end
+    limit = tonumber(ARGV[2 * i + 2])
+    if limit >= 0 and (tonumber(used[2]) or 0) + tonumber(ARGV[4]) > limit then
+        return 0
+    end
+end
+"""
+    + ACQUIRE_SCRIPT
+)
+
+# Moves the resource recorded as ARGV[1] to ARGV[2], e.g. a reservation to
+# the cluster it was made for. Returns whether it was recorded.
+CLAIM_SCRIPT = """
+local resource = redis.call("HGET", KEYS[1], ARGV[1])
+if not resource then
+    return 0
+end
+redis.call("HDEL", KEYS[1], ARGV[1])
+redis.call("HSET", KEYS[1], ARGV[2], resource)
+return 1
+"""
+
+# Removes the resource in ARGV[1] and subtracts it and its size from the
+# counters it was added to. Returns whether it was recorded.
+RELEASE_SCRIPT = """
+local resource = redis.call("HGET", KEYS[1], ARGV[1])
+if not resource then
+    return 0
+end
+redis.call("HDEL", KEYS[1], ARGV[1])
+resource = cjson.decode(resource)
+for _, key in ipairs(resource["owners"]) do
+    redis.call("HINCRBY", key, resource["kind"], -1)
+    redis.call("HINCRBY", key, "instances", -resource["size"])
+end
+return 1
+"""
+
+
+def resource_id(kind, pk):
+    """Return the ID of the resource of the given kind, e.g. "clusters:1"."""
+    return "%s:%s" % (kind, pk)
+
+
+def owners(user):
+    """
+    Return a list of the keys of the counters of the given user and of
+    their groups with their quotas, the user first.
+    """
+    quotas = [("quota-usage:user:%s" % user.pk, settings.USER_QUOTA)]
+    for group in user.groups.all():
+        quotas.append(
+            (
+                "quota-usage:group:%s" % group.pk,
+                settings.GROUP_QUOTAS.get(group.name, settings.GROUP_QUOTA),
+            )
+        )
+    return quotas
+
+
+def exceeded(user, clusters=0, runs=0, instances=0):
+    """
+    Return a list of the messages of the quotas of the given user and their
+    groups that would be exceeded by the given number of additional
+    clusters, Spark job runs and instances, or an empty list.
+    """
+    requested = {CLUSTERS: clusters, RUNS: runs, INSTANCES: instances}
+    user_quotas = owners(user)
+    try:
+        pipeline = get_redis_connection().pipeline(transaction=False)
+        for key, _ in user_quotas:
+            pipeline.hmget(key, CLUSTERS, RUNS, INSTANCES)
+        usages = pipeline.execute()
+    except RedisError:
+        # don't stop launching clusters just because Redis is gone
+        logger.exception("Checking the quotas of user %s failed", user.pk)
+        return []
+
+    messages = []
+    for (key, quota), usage in zip(user_quotas, usages):
+        owner = "your" if key.startswith("quota-usage:user:") else "your group's"
+        for kind, used in zip([CLUSTERS, RUNS, INSTANCES], usage):
+            limit = quota.get(kind)
+            if not requested[kind] or limit is None:
+                continue
+            used = int(used or 0)
+            if used + requested[kind] > limit:
+                messages.append(
+                    "This would exceed %s quota of %s %s (%s in use)."
+                    % (owner, limit, LABELS[kind], used)
+                )
+    return messages
+
+
+def acquire(kind, pk, user, size):
+    """
+    Add the resource of the given kind and primary key with the given
+    number of instances to the usage of the given user and their groups.
+    """
+    keys = [key for key, _ in owners(user)]
+    resource = {"kind": kind, "size": size or 0, "owners": keys}
+    try:
+        redis = get_redis_connection()
+        redis.register_script(ACQUIRE_SCRIPT)(
+            keys=[RESOURCES_KEY] + keys,
+            args=[resource_id(kind, pk), json.dumps(resource), kind, size or 0],
+        )
+    except RedisError:
+        logger.exception("Counting %s failed", resource_id(kind, pk))
+
+
+def reserve(kind, user, size):
+    """
+    Add a reservation of a resource of the given kind with the given number
+    of instances to the usage of the given user and their groups, unless
+    that would exceed one of their quotas. Returns the reservation that can
+    be used as the primary key of the resource for :func:`claim` and
+    :func:`release`, or ``None`` if a quota would be exceeded.
+    """
+    reservation = "reservation:%s" % uuid.uuid4().hex
+    user_quotas = owners(user)
+    keys = [key for key, _ in user_quotas]
+    resource = {"kind": kind, "size": size or 0, "owners": keys}
+    limits = []
+    for _, quota in user_quotas:
+        for limited, requested in [(kind, 1), (INSTANCES, size)]:
+            limit = quota.get(limited)
+            limits.append(-1 if limit is None or not requested else limit)
+    try:
+        redis = get_redis_connection()
+        reserved = redis.register_script(RESERVE_SCRIPT)(
+            keys=[RESOURCES_KEY] + keys,
+            args=[resource_id(kind, reservation), json.dumps(resource), kind, size or 0]
+            + limits,
+        )
+    except RedisError:
+        # don't stop launching clusters just because Redis is gone
+        logger.exception("Reserving %s failed", resource_id(kind, reservation))
+        return reservation
+    return reservation if reserved else None
+
+
+def claim(kind, reservation, pk, user, size):
+    """
+    Turn the given reservation into the resource of the given kind and
+    primary key, or add the resource with :func:`acquire` if there's no
+    reservation (anymore), e.g. after a :func:`rebuild`.
+    """
+    if reservation is not None:
+        try:
+            redis = get_redis_connection()
+            if redis.register_script(CLAIM_SCRIPT)(
+                keys=[RESOURCES_KEY],
+                args=[resource_id(kind, reservation), resource_id(kind, pk)],
+            ):
+                return
+        except RedisError:
+            logger.exception("Claiming %s failed", resource_id(kind, reservation))
+    acquire(kind, pk, user, size)
+
+
+def release(kind, pks):
+    """
+    Remove the resources of the given kind and primary keys from the usage
+    of their owners, in a single Redis pipeline.
+    """
+    pks = list(pks)
+    if not pks:
+        return
+    try:
+        redis = get_redis_connection()
+        script = redis.register_script(RELEASE_SCRIPT)
+        pipeline = redis.pipeline()
+        for pk in pks:
+            script(keys=[RESOURCES_KEY], args=[resource_id(kind, pk)], client=pipeline)
+        pipeline.execute()
+    except RedisError:
+        logger.exception("Releasing %s %s failed", kind, pks)
+
+
+def count_usage():
+    """
+    Return the resources and usage counters of the active clusters and
+    Spark job runs in the database, see :func:`rebuild`.
+    """
+    from .clusters.models import Cluster
+    from .jobs.models import SparkJobRun
+
+    resources = {}
+    counters = defaultdict(lambda: defaultdict(int))
+
+    def count(kind, pk, user, size):
+        keys = [key for key, _ in owners(user)]
+        resources[resource_id(kind, pk)] = json.dumps(
+            {"kind": kind, "size": size or 0, "owners": keys}
+        )
+        for key in keys:
+            counters[key][kind] += 1
+            counters[key][INSTANCES] += size or 0
+
+    clusters = Cluster.objects.active().prefetch_related("created_by__groups")
+    for cluster in clusters:
+        count(CLUSTERS, cluster.pk, cluster.created_by, cluster.size)
+    runs = SparkJobRun.objects.running().prefetch_related(
+        "spark_job__created_by__groups"
+    )
+    for run in runs:
+        count(RUNS, run.pk, run.spark_job.created_by, run.size)
+    return resources, counters
+
+
+def rebuild():
+    """
+    Replace the usage counters with the active clusters and Spark job runs
+    in the database, unless the counters changed in the meantime, in which
+    case it's retried up to ``REBUILD_ATTEMPTS`` times. Returns the number
+    of counted resources, or ``None`` if it wasn't rebuilt.
+    """
+    redis = get_redis_connection()
+    for _ in range(REBUILD_ATTEMPTS):
+        with redis.pipeline() as pipeline:
+            try:
+                # every change of the usage changes the hash of the resources,
+                # so the counters are only replaced if it didn't change since
+                # the database was counted
+                pipeline.watch(RESOURCES_KEY)
+                resources, counters = count_usage()
+                stale_keys = list(pipeline.scan_iter(match="%s*" % RESOURCES_KEY))
+                pipeline.multi()
+                if stale_keys:
+                    pipeline.delete(*stale_keys)
+                if resources:
+                    pipeline.hmset(RESOURCES_KEY, resources)
+                for key, counter in counters.items():
+                    pipeline.hmset(key, counter)
+                pipeline.execute()
+                return len(resources)
+            except WatchError:
+                logger.info("The quota usage changed while rebuilding it, retrying")
+    logger.warning("Rebuilding the quota usage failed due to concurrent changes")
+    return None
@@ -0,0 +1,174 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+A rate limiter for AWS API calls that is shared by all web and Celery
+worker processes, using token buckets stored in Redis.
+
+Every API operation has its own bucket that is refilled at a constant
+rate up to a maximum capacity, as configured by the ``EMR_RATE_LIMITS``
+AWS config value. Calls wait until a token is available, for up to
+``EMR_RATE_LIMIT_MAX_WAIT`` seconds, after which a ``ThrottlingException``
+client error is raised, like AWS itself would.
+
+Calls are made in one of two priority lanes. By default they are made in
+the :data:`INTERACTIVE` lane, e.g. when launching clusters and jobs for
+users. Periodic background work like polling the cluster states uses
+the :data:`BACKGROUND` lane with the :func:`lane` context manager or
+decorator, which can't take the share of the bucket capacity configured
+by the ``EMR_RATE_LIMIT_RESERVE`` AWS config value, so that it can't
+starve the interactive calls.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .stats.models import Metric
+
+logger = logging.getLogger(__name__)
+
+#: The lane of user-facing calls, e.g. launching clusters and jobs.
+INTERACTIVE = "interactive"
+#: The lane of background calls, e.g. polling the cluster states.
+BACKGROUND = "background"
+
+_local = threading.local()
+
+# Refills the bucket in KEYS[1] and takes a token if the given reserve
+# remains afterwards. Returns the seconds to wait for the next token as a
+# string since Redis truncates Lua numbers to integers.
+TAKE_TOKEN_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+else
+    wait = (reserve + 1 - tokens) / rate
+end
+redis.call("HMSET", KEYS[1], "tokens", tokens, "updated_at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+def current_lane():
+    """Return the priority lane of the calls in the current thread."""
+    return getattr(_local, "lane", INTERACTIVE)
+
+
+@contextmanager
+def lane(name):
+    """
+    A context manager and decorator to make the rate limited calls
+    in the given priority lane, e.g. :data:`BACKGROUND`.
+    """
+    previous = current_lane()
+    _local.lane = name
+    try:
+        yield
+    finally:
+        _local.lane = previous
+
+
+class RateLimiter:
+    """
+    A token bucket rate limiter for the operations of a Boto3 client,
+    see :meth:`install`.
+    """
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.script = None
+
+    @property
+    def config(self):
+        return settings.AWS_CONFIG
+
+    def install(self, client):
+        """
+        Rate limit all API calls of the given Boto3 client, including the
+        ones made by its paginators.
+        """
+        client.meta.events.register(
+            "before-call.%s" % self.service_name, self.before_call
+        )
+        return client
+
+    def before_call(self, model, **kwargs):
+        self.acquire(model.name)
+
+    def take(self, operation_name, limit, reserve):
+        """
+        Try to take a token from the bucket of the given operation and
+        return the seconds to wait before trying again if there wasn't one.
+        """
+        if self.script is None:
+            self.script = get_redis_connection().register_script(TAKE_TOKEN_SCRIPT)
+        wait = self.script(
+            keys=["rate-limit:%s:%s" % (self.service_name, operation_name)],
+            args=[limit["capacity"], limit["rate"], time.time(), reserve],
+        )
+        return float(wait)
+
+    def acquire(self, operation_name):
+        """
+        Wait until the given API operation may be called and return the
+        seconds that were waited. Records the wait time as a metric.
+
+        Raises a ``ThrottlingException`` client error when the wait would
+        exceed the ``EMR_RATE_LIMIT_MAX_WAIT`` AWS config value.
+        """
+        limit = self.config["EMR_RATE_LIMITS"].get(operation_name)
+        if limit is None:
+            return 0
+        call_lane = current_lane()
+        reserve = 0
+        if call_lane != INTERACTIVE:
+            reserve = limit["capacity"] * self.config["EMR_RATE_LIMIT_RESERVE"]
+        data = {"operation": operation_name, "lane": call_lane}
+
+        waited = 0
+        while True:
+            try:
+                wait = self.take(operation_name, limit, reserve)
+            except RedisError:
+                # don't stop talking to AWS just because Redis is gone
+                logger.exception("Rate limiting %s failed", operation_name)
+                break
+            if wait <= 0:
+                break
+            if waited + wait > self.config["EMR_RATE_LIMIT_MAX_WAIT"]:
+                Metric.record("emr-rate-limit-exceeded", data=data)
+                raise ClientError(
+                    {
+                        "Error": {
+                            "Code": "ThrottlingException",
+                            "Message": "Rate limit of %s exceeded" % operation_name,
+                        }
+                    },
+                    operation_name,
+                )
+            time.sleep(wait)
+            waited += wait
+
+        if waited:
+            Metric.record("emr-rate-limit-wait", int(round(waited * 1000)), data=data)
+        return waited
+
+
+#: The rate limiter of the EMR clients, installed by the client registry.
+emr_rate_limiter = RateLimiter("emr")
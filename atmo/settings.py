@@ -40,7 +40,10 @@ class Celery:
         # http://docs.celeryproject.org/en/latest/getting-started/brokers/redis.html#id1
         "visibility_timeout": 8 * 24 * 60 * 60,
     }
-    #: Use the django_celery_results database backend.
+    #: Use the django_celery_results database backend, for the tasks that don't
+    #: ignore their results, e.g. periodic tasks, see atmo.telemetry instead.
+    #: The sync_cluster_shard tasks must keep their results, since the chord
+    #: of a sharded cluster sync polls this backend for them (chord_unlock).
     CELERY_RESULT_BACKEND = "django-db"
     #: Throw away task results after two weeks, for debugging purposes.
     CELERY_RESULT_EXPIRES = timedelta(days=14)
@@ -62,47 +65,62 @@ class Celery:
     CELERY_BEAT_MAX_LOOP_INTERVAL = 5  #: redbeat likes fast loops
     #: Unless refreshed the lock will expire after this time
     CELERY_REDBEAT_LOCK_TIMEOUT = CELERY_BEAT_MAX_LOOP_INTERVAL * 5
-    #: The default/initial schedule to use.
-    CELERY_BEAT_SCHEDULE = {
-        "expire_jobs": {
-            "schedule": crontab(minute="*"),
-            "task": "atmo.jobs.tasks.expire_jobs",
-            "options": {"soft_time_limit": 15, "expires": 40},
-        },
-        "deactivate_clusters": {
-            "schedule": crontab(minute="*"),
-            "task": "atmo.clusters.tasks.deactivate_clusters",
-            "options": {"soft_time_limit": 15, "expires": 40},
-        },
-        "send_expiration_mails": {
-            "schedule": crontab(minute="*/5"),  # every 5 minutes
-            "task": "atmo.clusters.tasks.send_expiration_mails",
-            "options": {"expires": 4 * 60},
-        },
-        "send_run_alert_mails": {
-            "schedule": crontab(minute="*"),
-            "task": "atmo.jobs.tasks.send_run_alert_mails",
-            "options": {"expires": 40},
-        },
-        "update_clusters": {
-            "schedule": crontab(
-                minute="*/5"
-            ),  # update max_retries in task when changing!
-            "task": "atmo.clusters.tasks.update_clusters",
-            "options": {"soft_time_limit": int(4.5 * 60), "expires": 3 * 60},
-        },
-        "update_jobs_statuses": {
-            "schedule": crontab(
-                minute="*/15"
-            ),  # update max_retries in task when changing!
-            "task": "atmo.jobs.tasks.update_jobs_statuses",
-            "options": {"soft_time_limit": int(14.5 * 60), "expires": 10 * 60},
-        },
-        "clean_orphan_obj_perms": {
-            "schedule": crontab(minute=30, hour=3),
-            "task": "atmo.tasks.cleanup_permissions",
-        },
-    }
+    #: The number of recent runs per task kept by atmo.telemetry.
+    TASK_TELEMETRY_SIZE = 500
+    #: The seconds before a deadline, e.g. of a cluster expiration, in which
+    #: its task is sent with an ETA. Longer than the interval of the sweeps.
+    DEADLINE_TIMER_WINDOW = 20 * 60
+
+    @property
+    def CELERY_BEAT_SCHEDULE(self):
+        """
+        The default/initial schedule to use, with the tasks of optional
+        features only when they're enabled.
+        """
+        schedule = {
+            # runs the housekeeping tasks, see atmo.tasks.TICK_STEPS
+            "tick": {
+                "schedule": crontab(minute="*"),
+                "task": "atmo.tasks.tick",
+                "options": {"soft_time_limit": 55, "expires": 40},
+            },
+            "update_emr_statuses": {
+                # only polls the clusters that are due, see CLUSTER_POLL_INTERVALS
+                # update max_retries in task when changing!
+                "schedule": crontab(minute="*"),
+                "task": "atmo.tasks.update_emr_statuses",
+                "options": {"soft_time_limit": 55, "expires": 40},
+            },
+            "admit_queued_runs": {
+                # only a safety net, the queued Spark job runs are sent while
+                # there are any, see atmo.jobs.admission
+                "schedule": crontab(minute="*/5"),
+                "task": "atmo.jobs.tasks.admit_queued_runs",
+                "options": {"soft_time_limit": 30, "expires": 60},
+            },
+            "reconcile_schedules": {
+                "schedule": crontab(minute=45),
+                "task": "atmo.jobs.tasks.reconcile_schedules",
+                "options": {"soft_time_limit": 5 * 60, "expires": 30 * 60},
+            },
+            "clean_orphan_obj_perms": {
+                "schedule": crontab(minute=30, hour=3),
+                "task": "atmo.tasks.cleanup_permissions",
+            },
+        }
+        if self.EMR_EVENTS_QUEUE or self.EMR_EVENTS_QUEUE_URL:
+            schedule["ingest_emr_events"] = {
+                "schedule": timedelta(seconds=10),
+                "task": "atmo.tasks.ingest_emr_events",
+                "options": {"soft_time_limit": 30, "expires": 10},
+            }
+        if self.SPARK_JOB_SCHEDULER == "due-set":
+            schedule["dispatch_due_jobs"] = {
+                "schedule": timedelta(seconds=30),
+                "task": "atmo.jobs.tasks.dispatch_due_jobs",
+                "options": {"soft_time_limit": 60, "expires": 25},
+            }
+        return schedule
 
 
 class Constance:
@@ -239,6 +257,90 @@ class AWS:
         "PUBLIC_DATA_BUCKET": "telemetry-public-analysis-2",
         "PRIVATE_DATA_BUCKET": "telemetry-private-analysis-2",
         "LOG_BUCKET": "telemetry-analysis-logs-2",
+        # Seconds to cache the shared Spark EMR configuration before revalidating
+        "SPARK_EMR_CONFIGURATION_TTL": 60 * 5,
+        # Hours after which active clusters are described instead of listed
+        "LIST_CLUSTERS_HORIZON": 24 * 7,
+        # Number of concurrent and timeout in seconds of DescribeCluster calls
+        "DESCRIBE_CLUSTER_WORKERS": 10,
+        "DESCRIBE_CLUSTER_TIMEOUT": 30,
+        # Seconds between polls of the cluster status per state, doubled for
+        # every hour clusters are ready, up to the max interval in seconds
+        "CLUSTER_POLL_INTERVALS": {
+            "STARTING": 60,
+            "BOOTSTRAPPING": 60,
+            "RUNNING": 60 * 5,
+            "WAITING": 60 * 5,
+            "TERMINATING": 60,
+        },
+        "CLUSTER_POLL_MAX_INTERVAL": 60 * 30,
+        # Number of polled clusters above which they are synced in parallel
+        # by the given number of shard tasks, passed on through the cache
+        # for the given number of seconds
+        "CLUSTER_SYNC_FAN_OUT_THRESHOLD": 200,
+        "CLUSTER_SYNC_SHARDS": 8,
+        "CLUSTER_SYNC_SHARD_TIMEOUT": 60 * 10,
+        # Seconds between polls of the Spark job run statuses
+        "SPARK_JOB_RUN_POLL_INTERVAL": 60 * 5,
+        # Max number of EMR events to ingest per task run and the min seconds
+        # between polls reconciling the statuses when ingesting events
+        "EMR_EVENTS_BATCH_SIZE": 100,
+        "EMR_EVENTS_RECONCILE_INTERVAL": 60 * 15,
+        # Max number of JobFlow IDs to terminate with a single API call
+        "TERMINATE_JOB_FLOWS_BATCH_SIZE": 50,
+        # Token buckets of the EMR API operations shared by all processes,
+        # refilled with the rate of tokens per second up to the capacity
+        "EMR_RATE_LIMITS": {
+            "RunJobFlow": {"rate": 0.5, "capacity": 10},
+            "DescribeCluster": {"rate": 5, "capacity": 20},
+            "ListClusters": {"rate": 1, "capacity": 5},
+            "TerminateJobFlows": {"rate": 1, "capacity": 5},
+        },
+        # Share of the bucket capacities reserved for user-facing calls
+        "EMR_RATE_LIMIT_RESERVE": 0.25,
+        # Max seconds to wait for a token before raising a ThrottlingException
+        "EMR_RATE_LIMIT_MAX_WAIT": 10,
+        # Number of failed EMR API calls within the window (in seconds) that
+        # opens the circuit breaker for the reset timeout (in seconds), after
+        # which a single probing call is made per probe timeout (in seconds)
+        "EMR_CIRCUIT_FAILURE_THRESHOLD": 5,
+        "EMR_CIRCUIT_FAILURE_WINDOW": 60,
+        "EMR_CIRCUIT_RESET_TIMEOUT": 60,
+        "EMR_CIRCUIT_PROBE_TIMEOUT": 15,
+        # Max number of launching clusters and of instances of all active
+        # clusters above which the runs of scheduled Spark jobs are queued
+        "PROVISIONING_MAX_LAUNCHES": 10,
+        "PROVISIONING_MAX_INSTANCES": 500,
+        # Max number of Spark job runs launched per window (in seconds),
+        # spread evenly over it after an initial burst
+        "PROVISIONING_WINDOW": 60 * 10,
+        "PROVISIONING_WINDOW_LAUNCHES": 30,
+        "PROVISIONING_BURST": 5,
+    }
+    #: The configuration of the simulated AWS clients, see atmo.simulator.
+    AWS_SIMULATOR_CONFIG = {
+        # Seconds clusters spend in the states before they are ready, in
+        # the RUNNING state per step and in the TERMINATING state
+        "STATE_DURATIONS": {
+            "STARTING": 60,
+            "BOOTSTRAPPING": 60 * 4,
+            "STEP": 60 * 10,
+            "TERMINATING": 60,
+        },
+        # Seconds every API call takes
+        "CALL_LATENCY": 0,
+        # Probability of API calls failing with a ThrottlingException
+        "THROTTLE_RATE": 0,
+        # Probability of API calls failing with an InternalServerError
+        "SERVER_ERROR_RATE": 0,
+        # Probability of clusters terminating with a bootstrap failure
+        "FAILURE_RATE": 0,
+        "LIST_CLUSTERS_PAGE_SIZE": 50,
+        "LIST_OBJECTS_PAGE_SIZE": 1000,
+        # The seed of the random numbers, e.g. to replay a load test
+        "SEED": None,
+        # The Spark EMR configuration returned instead of fetching it
+        "SPARK_EMR_CONFIGURATION": [],
     }
     #: The URL of the S3 bucket with public job results.
     PUBLIC_DATA_URL = "https://s3-%s.amazonaws.com/%s/" % (
@@ -334,6 +436,7 @@ class Core(AWS, Celery, Constance, CSP, Configuration):
     ]
 
     MIDDLEWARE = (
+        "atmo.monitoring.MetricsMiddleware",
         "django_cookies_samesite.middleware.CookiesSameSite",
         "django.middleware.security.SecurityMiddleware",
         "dockerflow.django.middleware.DockerflowMiddleware",
@@ -346,6 +449,7 @@ class Core(AWS, Celery, Constance, CSP, Configuration):
         "django.contrib.messages.middleware.MessageMiddleware",
         "django.middleware.clickjacking.XFrameOptionsMiddleware",
         "csp.middleware.CSPMiddleware",
+        "atmo.middleware.CircuitBreakerMiddleware",
     )
 
     ROOT_URLCONF = "atmo.urls"
@@ -385,6 +489,14 @@ class Core(AWS, Celery, Constance, CSP, Configuration):
 
     MESSAGE_TAGS = {messages.ERROR: "danger"}
 
+    #: The max number of active clusters, of running Spark jobs and of
+    #: instances of both per user and per group, see atmo.quotas.
+    #: None for no limit.
+    USER_QUOTA = {"clusters": 5, "runs": 10, "instances": 100}
+    GROUP_QUOTA = {"clusters": 20, "runs": 40, "instances": 400}
+    #: The quotas of groups by group name, instead of the GROUP_QUOTA.
+    GROUP_QUOTAS = {}
+
     # Raise PermissionDenied in get_40x_or_None which is used
     # by permission_required decorator
     GUARDIAN_RAISE_403 = True
@@ -495,6 +607,28 @@ class Base(Core):
     #: The URL under which this instance is running
     SITE_URL = values.URLValue("http://localhost:8000")
 
+    #: The backend of the AWS clients used by the provisioners, "boto3" or
+    #: "simulator" to simulate EMR and S3 in-process for load testing.
+    AWS_CLIENT_BACKEND = values.Value("boto3")
+
+    #: The queue of EMR cluster state change events to ingest, "sqs", "redis"
+    #: or "memory", see atmo.events. Empty to only poll the EMR API.
+    EMR_EVENTS_QUEUE = values.Value("")
+    #: The URL of the SQS queue of EMR cluster state change events.
+    EMR_EVENTS_QUEUE_URL = values.Value("")
+
+    #: The scheduler of the Spark job runs, "redbeat" for a RedBeat entry per
+    #: job or "due-set" for a single Redis sorted set, see atmo.jobs.schedules.
+    #: Switch with the migrate_schedules management command.
+    SPARK_JOB_SCHEDULER = values.Value("redbeat")
+
+    #: The port of the HTTP server of the Prometheus metrics started by the
+    #: Celery worker, see atmo.monitoring. Empty to not start it.
+    PROMETHEUS_WORKER_PORT = values.IntegerValue(None)
+    #: The bearer token the Prometheus scraper has to send to get the metrics
+    #: at /__metrics__, which are only shown to staff users otherwise.
+    PROMETHEUS_METRICS_TOKEN = values.Value("")
+
     # Database
     # https://docs.djangoproject.com/en/1.9/ref/settings/#databases
     DATABASES = values.DatabaseURLValue("postgres://postgres@db/postgres")
@@ -0,0 +1,437 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+An in-process simulation of the parts of the AWS EMR and S3 APIs that ATMO
+uses, to load-test the provisioning, polling and views without network
+access, e.g. with thousands of clusters on a laptop.
+
+It's enabled by setting the ``AWS_CLIENT_BACKEND`` setting to
+``"simulator"`` (e.g. with the ``DJANGO_AWS_CLIENT_BACKEND`` environment
+variable), which makes the :data:`~atmo.provisioners.clients` registry
+return the clients of this module instead of Boto3 clients. The behavior
+is configured with the ``AWS_SIMULATOR_CONFIG`` setting.
+
+Simulated clusters go through the states of real EMR clusters based on
+their age: ``STARTING``, ``BOOTSTRAPPING``, then ``RUNNING`` while their
+steps run and either ``WAITING`` if they are kept alive or ``TERMINATING``
+and ``TERMINATED`` afterwards. The state is only kept in the memory of the
+current process.
+"""
+
+import functools
+import io
+import itertools
+import random
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.utils import timezone
+
+
+class Paginator:
+    """
+    A paginator for the simulated clients with the same interface as
+    the Boto3 paginators.
+    """
+
+    def __init__(self, method, input_token, output_token):
+        self.method = method
+        self.input_token = input_token
+        self.output_token = output_token
+
+    def paginate(self, **params):
+        while True:
+            page = self.method(**params)
+            yield page
+            token = page.get(self.output_token)
+            if not token:
+                break
+            params = dict(params, **{self.input_token: token})
+
+
+class Events:
+    """
+    A minimal event system for the simulated clients with the same
+    interface as the one of Boto3 clients to register handlers for the
+    ``before-call`` and ``after-call`` events, e.g. ``before-call.emr``.
+    """
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for prefix, handler in self.handlers:
+            if event_name == prefix or event_name.startswith(prefix + "."):
+                handler(event_name=event_name, **kwargs)
+
+
+def operation(operation_name):
+    """
+    Decorate a method of a simulated client to be the simulated API call
+    with the given operation name, e.g. "DescribeCluster".
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, **params):
+            return self.call(operation_name, method, params)
+
+        return wrapper
+
+    return decorator
+
+
+class SimulatedClient:
+    """
+    The base class of the simulated clients that adds the configured
+    call latency, throttling errors and server errors to the API calls.
+    """
+
+    #: The name of the simulated AWS service, e.g. "emr".
+    service_name = None
+    #: A mapping between the names of the paginated operations and their
+    #: input and output tokens.
+    paginators = {}
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.meta = SimpleNamespace(events=Events())
+
+    def call(self, operation_name, method, params):
+        """
+        Make the simulated API call with the given operation name by
+        calling the given method with the given parameters, emitting the
+        same ``before-call`` and ``after-call`` events as Boto3 clients.
+        """
+        event_suffix = "%s.%s" % (self.service_name, operation_name)
+        model = SimpleNamespace(name=operation_name)
+        self.meta.events.emit("before-call.%s" % event_suffix, model=model)
+        config = self.simulator.config
+        if config["CALL_LATENCY"]:
+            time.sleep(config["CALL_LATENCY"])
+        try:
+            if self.simulator.random() < config["THROTTLE_RATE"]:
+                raise self.error(operation_name, "ThrottlingException", "Rate exceeded")
+            if self.simulator.random() < config["SERVER_ERROR_RATE"]:
+                raise self.error(
+                    operation_name, "InternalServerError", "Simulated error", 500
+                )
+            parsed, status_code = method(self, **params), 200
+        except ClientError as exc:
+            parsed = exc.response
+            status_code = parsed["ResponseMetadata"]["HTTPStatusCode"]
+        self.meta.events.emit(
+            "after-call.%s" % event_suffix,
+            http_response=SimpleNamespace(status_code=status_code),
+            parsed=parsed,
+            model=model,
+        )
+        if status_code >= 300:
+            raise ClientError(parsed, operation_name)
+        return parsed
+
+    def error(self, operation_name, code, message, status_code=400):
+        return ClientError(
+            {
+                "Error": {"Code": code, "Message": message},
+                "ResponseMetadata": {"HTTPStatusCode": status_code},
+            },
+            operation_name,
+        )
+
+    def get_paginator(self, operation_name):
+        input_token, output_token = self.paginators[operation_name]
+        return Paginator(getattr(self, operation_name), input_token, output_token)
+
+
+class SimulatedEMR(SimulatedClient):
+    """A simulated Boto3 EMR client."""
+
+    service_name = "emr"
+    paginators = {"list_clusters": ("Marker", "Marker")}
+
+    @operation("RunJobFlow")
+    def run_job_flow(self, **params):
+        return {"JobFlowId": self.simulator.add_cluster(params)}
+
+    @operation("DescribeCluster")
+    def describe_cluster(self, ClusterId):
+        cluster = self.simulator.clusters.get(ClusterId)
+        if cluster is None:
+            raise self.error(
+                "DescribeCluster",
+                "InvalidRequestException",
+                "Cluster id '%s' is not valid." % ClusterId,
+            )
+        return {"Cluster": self.simulator.describe(cluster)}
+
+    @operation("ListClusters")
+    def list_clusters(
+        self, CreatedAfter=None, CreatedBefore=None, ClusterStates=None, Marker=None
+    ):
+        with self.simulator.lock:
+            clusters = list(self.simulator.clusters.values())
+        summaries = []
+        # the newest clusters are listed first
+        for cluster in sorted(
+            clusters, key=lambda cluster: cluster["created_at"], reverse=True
+        ):
+            if CreatedAfter is not None and cluster["created_at"] < CreatedAfter:
+                continue
+            if CreatedBefore is not None and cluster["created_at"] > CreatedBefore:
+                continue
+            description = self.simulator.describe(cluster)
+            if ClusterStates and description["Status"]["State"] not in ClusterStates:
+                continue
+            summaries.append(
+                {
+                    "Id": description["Id"],
+                    "Name": description["Name"],
+                    "Status": description["Status"],
+                    "NormalizedInstanceHours": 0,
+                }
+            )
+        start = int(Marker or 0)
+        end = start + self.simulator.config["LIST_CLUSTERS_PAGE_SIZE"]
+        page = {"Clusters": summaries[start:end]}
+        if end < len(summaries):
+            page["Marker"] = str(end)
+        return page
+
+    @operation("TerminateJobFlows")
+    def terminate_job_flows(self, JobFlowIds):
+        for jobflow_id in JobFlowIds:
+            self.simulator.terminate_cluster(jobflow_id)
+        return {}
+
+
+class SimulatedS3(SimulatedClient):
+    """A simulated Boto3 S3 client."""
+
+    service_name = "s3"
+    paginators = {"list_objects_v2": ("ContinuationToken", "NextContinuationToken")}
+
+    @operation("PutObject")
+    def put_object(self, Bucket, Key, Body=b""):
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        with self.simulator.lock:
+            self.simulator.objects[(Bucket, Key)] = (Body, timezone.now())
+        return {}
+
+    @operation("GetObject")
+    def get_object(self, Bucket, Key):
+        try:
+            body, last_modified = self.simulator.objects[(Bucket, Key)]
+        except KeyError:
+            raise self.error(
+                "GetObject", "NoSuchKey", "The specified key does not exist."
+            )
+        return {
+            "Body": io.BytesIO(body),
+            "ContentLength": len(body),
+            "LastModified": last_modified,
+        }
+
+    @operation("DeleteObject")
+    def delete_object(self, Bucket, Key):
+        with self.simulator.lock:
+            self.simulator.objects.pop((Bucket, Key), None)
+        return {}
+
+    @operation("ListObjectsV2")
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None):
+        with self.simulator.lock:
+            keys = sorted(
+                key
+                for bucket, key in self.simulator.objects
+                if bucket == Bucket and key.startswith(Prefix)
+            )
+        start = int(ContinuationToken or 0)
+        end = start + self.simulator.config["LIST_OBJECTS_PAGE_SIZE"]
+        contents = []
+        for key in keys[start:end]:
+            body, last_modified = self.simulator.objects[(Bucket, key)]
+            contents.append(
+                {"Key": key, "Size": len(body), "LastModified": last_modified}
+            )
+        page = {"KeyCount": len(contents), "IsTruncated": end < len(keys)}
+        if contents:
+            page["Contents"] = contents
+        if page["IsTruncated"]:
+            page["NextContinuationToken"] = str(end)
+        return page
+
+
+class SimulatedResponse:
+    """A simulated requests response with a JSON document."""
+
+    def __init__(self, data):
+        self.data = data
+        self.status_code = 200
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class SimulatedSession:
+    """
+    A simulated requests session that returns the configured Spark EMR
+    configuration for every URL.
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def get(self, url, **kwargs):
+        return SimulatedResponse(self.simulator.config["SPARK_EMR_CONFIGURATION"])
+
+
+class Simulator:
+    """
+    The state of the simulated clusters and S3 objects that is shared
+    between all simulated clients of the process.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Remove all simulated clusters and objects."""
+        with self.lock:
+            self.clusters = {}
+            self.objects = {}
+            self.counter = itertools.count(1)
+            # seeded lazily to not access the settings when imported
+            self.rng = None
+
+    @property
+    def config(self):
+        return settings.AWS_SIMULATOR_CONFIG
+
+    def random(self):
+        """Return the next random number of the seeded generator."""
+        with self.lock:
+            if self.rng is None:
+                self.rng = random.Random(self.config["SEED"])
+            return self.rng.random()
+
+    def client(self, service_name):
+        """Return a simulated client for the given AWS service name."""
+        return {"emr": SimulatedEMR, "s3": SimulatedS3}[service_name](self)
+
+    def session(self):
+        """Return a simulated requests session."""
+        return SimulatedSession(self)
+
+    def add_cluster(self, params):
+        """Add a cluster for the given RunJobFlow parameters."""
+        with self.lock:
+            jobflow_id = "j-SIM%010d" % next(self.counter)
+            self.clusters[jobflow_id] = {
+                "id": jobflow_id,
+                "name": params.get("Name", jobflow_id),
+                "created_at": timezone.now(),
+                "keep_alive": params.get("Instances", {}).get(
+                    "KeepJobFlowAliveWhenNoSteps", True
+                ),
+                "steps": len(params.get("Steps", [])),
+                "fails": self.random() < self.config["FAILURE_RATE"],
+                "terminated_at": None,
+            }
+        return jobflow_id
+
+    def terminate_cluster(self, jobflow_id):
+        """Request the termination of the cluster with the given ID."""
+        with self.lock:
+            cluster = self.clusters.get(jobflow_id)
+            if cluster is not None and cluster["terminated_at"] is None:
+                cluster["terminated_at"] = timezone.now()
+
+    def describe(self, cluster):
+        """
+        Return the description of the given cluster as returned by the
+        DescribeCluster API, with the state it's in right now.
+        """
+        durations = {
+            state: timedelta(seconds=seconds)
+            for state, seconds in self.config["STATE_DURATIONS"].items()
+        }
+        now = timezone.now()
+        created_at = cluster["created_at"]
+        bootstrapping_at = created_at + durations["STARTING"]
+        ready_at = bootstrapping_at + durations["BOOTSTRAPPING"]
+        steps_done_at = ready_at + durations["STEP"] * cluster["steps"]
+
+        # the point in time the cluster started terminating and why
+        terminating_at, reason, state_after = None, None, "TERMINATED"
+        if cluster["fails"]:
+            # fail at the end of the bootstrapping
+            terminating_at, reason = ready_at, "BOOTSTRAP_FAILURE"
+            state_after = "TERMINATED_WITH_ERRORS"
+        elif not cluster["keep_alive"]:
+            terminating_at, reason = steps_done_at, "ALL_STEPS_COMPLETED"
+        requested_at = cluster["terminated_at"]
+        if requested_at is not None and (
+            terminating_at is None or requested_at < terminating_at
+        ):
+            terminating_at, reason = requested_at, "USER_REQUEST"
+            state_after = "TERMINATED"
+        if terminating_at is not None and (
+            terminating_at <= ready_at or state_after == "TERMINATED_WITH_ERRORS"
+        ):
+            # the cluster never became ready
+            ready_at = None
+
+        end_at = None
+        if terminating_at is not None and now >= terminating_at:
+            if now >= terminating_at + durations["TERMINATING"]:
+                state = state_after
+                end_at = terminating_at + durations["TERMINATING"]
+            else:
+                state = "TERMINATING"
+        elif now < bootstrapping_at:
+            state = "STARTING"
+        elif ready_at is None or now < ready_at:
+            state = "BOOTSTRAPPING"
+        elif now < steps_done_at:
+            state = "RUNNING"
+        else:
+            state = "WAITING"
+
+        timeline = {"CreationDateTime": created_at}
+        if ready_at is not None and now >= ready_at:
+            timeline["ReadyDateTime"] = ready_at
+        if end_at is not None:
+            timeline["EndDateTime"] = end_at
+        status = {"State": state, "Timeline": timeline}
+        if state in ("TERMINATING", "TERMINATED", "TERMINATED_WITH_ERRORS"):
+            status["StateChangeReason"] = {
+                "Code": reason,
+                "Message": "Simulated state change: %s" % reason,
+            }
+        description = {"Id": cluster["id"], "Name": cluster["name"], "Status": status}
+        if "ReadyDateTime" in timeline:
+            description["MasterPublicDnsName"] = (
+                "ec2-%s.compute.simulator.invalid" % cluster["id"].lower()
+            )
+        return description
+
+
+#: The process-wide simulator used by the simulated clients.
+simulator = Simulator()
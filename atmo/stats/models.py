@@ -41,3 +41,23 @@ class Metric(models.Model):
         data = kwargs.pop("data", None)
 
         cls.objects.create(created_at=created_at, key=key, value=value, data=data)
+
+    @classmethod
+    def bulk_record(cls, records):
+        """
+        Create many new entries in the ``Metric`` table with a single
+        query, given an iterable of dictionaries with the keyword arguments
+        of :meth:`~atmo.stats.models.Metric.record`.
+        """
+        now = timezone.now()
+        return cls.objects.bulk_create(
+            [
+                cls(
+                    created_at=record.get("created_at") or now,
+                    key=record["key"],
+                    value=record.get("value", 1),
+                    data=record.get("data"),
+                )
+                for record in records
+            ]
+        )
@@ -1,15 +1,236 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from guardian.utils import clean_orphan_obj_perms
 
+from . import events, quotas
 from .celery import celery
+from .clusters.models import Cluster
+from .clusters.provisioners import ClusterProvisioner
+from .clusters.tasks import fan_out_sync_clusters, list_active_clusters, sync_clusters
+from .jobs.models import SparkJobRun
+from .jobs.tasks import sync_spark_job_runs
+from .locks import singleton
+from .ratelimits import BACKGROUND, lane
+from .stats.models import Metric
 
 logger = get_task_logger(__name__)
 
+#: The cache key that exists while the Spark job runs were polled recently.
+SPARK_JOB_RUNS_POLLED_KEY = "spark-job-runs-polled"
+
+#: The names of the tasks run by the :func:`tick` task with the minutes
+#: between their runs, in the order they are run.
+TICK_STEPS = OrderedDict(
+    [
+        ("atmo.jobs.tasks.expire_jobs", 15),
+        ("atmo.clusters.tasks.deactivate_clusters", 15),
+        ("atmo.clusters.tasks.send_expiration_mails", 5),
+        ("atmo.jobs.tasks.send_run_alert_mails", 1),
+        ("atmo.tasks.rebuild_quota_usage", 15),
+    ]
+)
+
 
-@celery.task()
+@celery.task(ignore_result=True)
 def cleanup_permissions():
     "A Celery task that cleans up old django-guardian object permissions."
     clean_orphan_obj_perms()
+
+
+@celery.task(ignore_result=True)
+@singleton()
+def rebuild_quota_usage():
+    """
+    A Celery task that recounts the usage of the user and group quotas
+    from the database, see :func:`atmo.quotas.rebuild`.
+    """
+    return quotas.rebuild()
+
+
+# This task runs every minute, so it's retried only a few times
+# with short backoff values before the next run takes over
+@celery.task(max_retries=3, bind=True, ignore_result=True)
+@lane(BACKGROUND)
+@singleton()
+def update_emr_statuses(self):
+    """
+    A Celery task that updates the status of the active clusters and
+    Spark job runs from a single list of EMR clusters, instead of listing
+    them once for each.
+
+    Only the clusters that are due to be polled are updated, see
+    :meth:`~atmo.clusters.models.Cluster.poll_interval`, and the Spark job
+    runs every ``SPARK_JOB_RUN_POLL_INTERVAL`` seconds (an AWS config value).
+
+    Returns the identifiers of the updated clusters (or the ID of the sync
+    if they are synced in parallel, see
+    :func:`~atmo.clusters.tasks.fan_out_sync_clusters`) and Spark job runs.
+    """
+    due_clusters = Cluster.objects.active().due(timezone.now())
+    active_spark_job_runs = SparkJobRun.objects.active().prefetch_related("spark_job")
+    spark_job_run_poll_interval = settings.AWS_CONFIG["SPARK_JOB_RUN_POLL_INTERVAL"]
+    if settings.EMR_EVENTS_QUEUE:
+        # only reconcile the statuses ingested from EMR events
+        spark_job_run_poll_interval = max(
+            spark_job_run_poll_interval,
+            settings.AWS_CONFIG["EMR_EVENTS_RECONCILE_INTERVAL"],
+        )
+    # the cache key expires when the Spark job runs are due again
+    spark_job_runs_due = cache.add(
+        SPARK_JOB_RUNS_POLLED_KEY, True, timeout=spark_job_run_poll_interval
+    )
+    if not spark_job_runs_due:
+        active_spark_job_runs = active_spark_job_runs.none()
+
+    # Short-circuit for no due clusters and runs (e.g. on weekends)
+    if not due_clusters.exists() and not active_spark_job_runs.exists():
+        return {"clusters": [], "spark_job_runs": []}
+
+    try:
+        started_at = time.time()
+        # build a mapping between jobflow ID and cluster info for both
+        cluster_mapping = list_active_clusters(
+            "update_emr_statuses",
+            due_clusters,
+            active_spark_job_runs,
+            tracked=[Cluster.objects.active(), SparkJobRun.objects.active()],
+        )
+        return {
+            "clusters": fan_out_sync_clusters(
+                "update_emr_statuses", due_clusters, cluster_mapping, started_at
+            ),
+            "spark_job_runs": sync_spark_job_runs(
+                active_spark_job_runs, cluster_mapping
+            ),
+        }
+    except ClientError as exc:
+        if spark_job_runs_due:
+            # poll the Spark job runs again when retrying
+            cache.delete(SPARK_JOB_RUNS_POLLED_KEY)
+        self.retry(exc=exc, countdown=celery.retry_countdown(exc, self.request.retries))
+
+
+@celery.task(ignore_result=True)
+@lane(BACKGROUND)
+@singleton()
+def ingest_emr_events():
+    """
+    A Celery task that updates the status of the clusters and Spark job
+    runs with the EMR cluster state change events received from the queue
+    configured with the ``EMR_EVENTS_QUEUE`` setting, see
+    :mod:`atmo.events`.
+
+    The clusters the events refer to are described to get their complete
+    info, falling back to the state in the events if that fails and the
+    state isn't final. Periodic polling with :func:`update_emr_statuses`
+    only reconciles the statuses in case events got lost.
+
+    Returns the identifiers of the updated clusters and Spark job runs.
+    """
+    queue = events.get_queue()
+    if queue is None:
+        return None
+    received = queue.receive(settings.AWS_CONFIG["EMR_EVENTS_BATCH_SIZE"])
+    if not received:
+        return {"clusters": [], "spark_job_runs": []}
+
+    # only the latest event of every cluster matters
+    event_mapping = OrderedDict()
+    for handle, event in received:
+        info = events.parse_event(event)
+        if info is not None:
+            event_mapping.pop(info["jobflow_id"], None)
+            event_mapping[info["jobflow_id"]] = info
+
+    # ignore the events of clusters that weren't launched by ATMO
+    # or that have finished already
+    clusters = list(
+        Cluster.objects.filter(jobflow_id__in=list(event_mapping)).exclude(
+            most_recent_status__in=Cluster.FINAL_STATUS_LIST
+        )
+    )
+    spark_job_runs = list(
+        SparkJobRun.objects.filter(jobflow_id__in=list(event_mapping))
+        .exclude(status__in=Cluster.FINAL_STATUS_LIST)
+        .select_related("spark_job")
+    )
+    known_jobflow_ids = {record.jobflow_id for record in clusters + spark_job_runs}
+    jobflow_ids = [
+        jobflow_id for jobflow_id in event_mapping if jobflow_id in known_jobflow_ids
+    ]
+    try:
+        cluster_mapping = ClusterProvisioner().bulk_info(jobflow_ids)
+    except ClientError:
+        logger.exception("Describing the clusters of EMR events failed")
+        cluster_mapping = OrderedDict()
+    for jobflow_id in jobflow_ids:
+        event_info = event_mapping[jobflow_id]
+        # final states are left to polling, which gets the end date/time
+        # that isn't part of the events but needed for the metrics
+        if event_info["state"] not in Cluster.FINAL_STATUS_LIST:
+            cluster_mapping.setdefault(jobflow_id, event_info)
+
+    result = {
+        "clusters": sync_clusters(clusters, cluster_mapping),
+        "spark_job_runs": sync_spark_job_runs(spark_job_runs, cluster_mapping),
+    }
+    queue.ack(handle for handle, event in received if handle is not None)
+
+    event_datetimes = [
+        info["event_datetime"]
+        for info in event_mapping.values()
+        if "event_datetime" in info
+    ]
+    Metric.record(
+        "emr-events-ingested",
+        len(received),
+        data={"clusters": len(event_mapping), "matched": len(jobflow_ids)},
+    )
+    if event_datetimes:
+        latency = timezone.now() - min(event_datetimes)
+        Metric.record("emr-events-latency", int(latency.total_seconds() * 1000))
+    return result
+
+
+@celery.task(ignore_result=True)
+@singleton()
+def tick():
+    """
+    A Celery task that runs every minute and runs the housekeeping tasks
+    of :data:`TICK_STEPS` that are due in the current process, instead of
+    sending each of them as a separate periodic task.
+
+    A failed step doesn't stop the remaining ones. The duration of each
+    step is recorded with the ``tick-duration`` metric.
+    """
+    minute = int(timezone.now().timestamp() // 60)
+    durations = OrderedDict()
+    failed = []
+    for task_name, every in TICK_STEPS.items():
+        if minute % every:
+            continue
+        started_at = time.time()
+        try:
+            celery.tasks[task_name]()
+        except SoftTimeLimitExceeded:
+            raise
+        except Exception:
+            logger.exception("The tick step %s failed", task_name)
+            failed.append(task_name)
+        durations[task_name] = int((time.time() - started_at) * 1000)
+    Metric.record(
+        "tick-duration",
+        sum(durations.values()),
+        data={"steps": durations, "failed": failed},
+    )
+    return durations
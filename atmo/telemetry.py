@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compact telemetry of Celery task runs, stored in a capped Redis list per
+task name instead of a result row per run in the database.
+
+Every run of a task is recorded with its runtime, outcome, retry count and
+the size of its JSON serialized return value, and only the most recent
+``TASK_TELEMETRY_SIZE`` runs are kept. The recent runs and their runtime
+percentiles are shown on the :class:`~atmo.views.TaskTelemetryView` admin
+page.
+"""
+
+import json
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+#: The key of the set of the names of the recorded tasks.
+TASK_NAMES_KEY = "task-telemetry"
+
+#: The start times of the tasks currently running in this process by task ID.
+_started = {}
+
+
+def runs_key(task_name):
+    return "task-telemetry:%s" % task_name
+
+
+def payload_size(retval):
+    """
+    Return the size of the JSON serialized given return value of a task,
+    or ``None`` if it can't be serialized.
+    """
+    try:
+        return len(json.dumps(retval, cls=DjangoJSONEncoder))
+    except (TypeError, ValueError):
+        return None
+
+
+def record(task_name, run):
+    """Add the given run to the recent runs of the task with the given name."""
+    try:
+        pipeline = get_redis_connection().pipeline()
+        pipeline.lpush(runs_key(task_name), json.dumps(run, cls=DjangoJSONEncoder))
+        pipeline.ltrim(runs_key(task_name), 0, settings.TASK_TELEMETRY_SIZE - 1)
+        pipeline.sadd(TASK_NAMES_KEY, task_name)
+        pipeline.execute()
+    except RedisError:
+        logger.exception("Recording a run of %s failed", task_name)
+
+
+def recent_runs(task_name, count=-1):
+    """
+    Return a list of up to the given number of recent runs of the task with
+    the given name, the most recent first.
+    """
+    end = count - 1 if count > 0 else -1
+    return [
+        json.loads(run.decode("utf-8"))
+        for run in get_redis_connection().lrange(runs_key(task_name), 0, end)
+    ]
+
+
+def task_names():
+    """Return the sorted list of the names of the recorded tasks."""
+    return sorted(
+        name.decode("utf-8") for name in get_redis_connection().smembers(TASK_NAMES_KEY)
+    )
+
+
+def percentile(values, percent):
+    """
+    Return the given percentile of the given values with the nearest-rank
+    method, or ``None`` if there are no values.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(percent / 100 * len(values))))
+    return values[rank - 1]
+
+
+def summarize(runs):
+    """Return the outcome counts and runtime percentiles of the given runs."""
+    runtimes = [run["runtime"] for run in runs]
+    return {
+        "count": len(runs),
+        "failures": sum(1 for run in runs if run["outcome"] == "FAILURE"),
+        "retries": sum(1 for run in runs if run["outcome"] == "RETRY"),
+        "p50": percentile(runtimes, 50),
+        "p90": percentile(runtimes, 90),
+        "p99": percentile(runtimes, 99),
+        "max": max(runtimes) if runtimes else None,
+    }
+
+
+def task_prerun_handler(task_id, task, **kwargs):
+    _started[task_id] = (timezone.now(), time.time())
+
+
+def task_postrun_handler(task_id, task, retval, state, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is None:
+        return
+    started_at, started_time = started
+    record(
+        task.name,
+        {
+            "task_id": task_id,
+            "started_at": started_at,
+            "runtime": round(time.time() - started_time, 3),
+            "outcome": state,
+            "retries": task.request.retries or 0,
+            "size": payload_size(retval) if state == "SUCCESS" else None,
+        },
+    )
@@ -16,6 +16,11 @@ admin.site.login = login_required(admin.site.login)
 
 urlpatterns = [
     url(r"^$", views.DashboardView.as_view(), name="dashboard"),
+    url(
+        r"^admin/tasks/$",
+        admin.site.admin_view(views.TaskTelemetryView.as_view()),
+        name="task-telemetry",
+    ),
     url(r"^admin/", include(admin.site.urls)),
     url(r"clusters/", include("atmo.clusters.urls")),
     url(r"jobs/", include("atmo.jobs.urls")),
@@ -23,6 +28,7 @@ urlpatterns = [
     url(r"news/", include("atmo.news.urls")),
     url(r"users/", include("atmo.users.urls")),
     url(r"oidc/", include("mozilla_django_oidc.urls")),
+    url(r"^__metrics__$", views.metrics, name="metrics"),
     # contribute.json url
     url(
         r"^(?P<path>contribute\.json)$",
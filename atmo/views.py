@@ -2,17 +2,23 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 from django import http
+from django.conf import settings
+from django.contrib import admin
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import Group
+from django.core.exceptions import PermissionDenied
 from django.shortcuts import redirect
 from django.template import TemplateDoesNotExist, loader
+from django.utils.crypto import constant_time_compare
 from django.utils.decorators import method_decorator
 from django.utils.encoding import force_text
 from django.views.decorators.csrf import requires_csrf_token
 from django.views.defaults import ERROR_500_TEMPLATE_NAME, ERROR_403_TEMPLATE_NAME
 from django.views.generic.base import TemplateView
 from guardian.shortcuts import get_objects_for_group, get_objects_for_user
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
+from . import monitoring, telemetry
 from .clusters.models import Cluster
 from .decorators import modified_date
 from .jobs.models import SparkJob
@@ -120,6 +126,58 @@ class DashboardView(TemplateView):
         return context
 
 
+class TaskTelemetryView(TemplateView):
+    """
+    The admin view that shows the recent runs of the Celery tasks and
+    their runtime percentiles, see :mod:`atmo.telemetry`.
+    """
+
+    #: Template name
+    template_name = "atmo/task_telemetry.html"
+    http_method_names = ["get", "head"]
+    #: The number of recent runs shown of the selected task
+    shown_runs = 50
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(admin.site.each_context(self.request))
+        tasks = [
+            dict(telemetry.summarize(telemetry.recent_runs(task_name)), name=task_name)
+            for task_name in telemetry.task_names()
+        ]
+        selected = self.request.GET.get("task")
+        context.update(
+            {
+                "title": "Task telemetry",
+                "tasks": tasks,
+                "selected": selected,
+                "runs": (
+                    telemetry.recent_runs(selected, self.shown_runs) if selected else []
+                ),
+            }
+        )
+        return context
+
+
+def metrics(request):
+    """
+    The Prometheus metrics, see :mod:`atmo.monitoring`.
+
+    Only shown to staff users and to requests with the bearer token of the
+    ``PROMETHEUS_METRICS_TOKEN`` setting, since they include e.g. the names
+    of the views and tasks and the AWS error codes.
+    """
+    token = settings.PROMETHEUS_METRICS_TOKEN
+    authorization = request.META.get("HTTP_AUTHORIZATION", "")
+    if not request.user.is_staff and not (
+        token and constant_time_compare(authorization, "Bearer %s" % token)
+    ):
+        raise PermissionDenied
+    return http.HttpResponse(
+        generate_latest(monitoring.registry()), content_type=CONTENT_TYPE_LATEST
+    )
+
+
 @requires_csrf_token
 def server_error(request, template_name=ERROR_500_TEMPLATE_NAME):
     """
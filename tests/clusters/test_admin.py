@@ -6,7 +6,19 @@ from atmo.clusters.models import Cluster
 
 
 def test_deactivate_action(mocker, cluster_factory):
-    deactivate_method = mocker.patch("atmo.clusters.models.Cluster.deactivate")
-    cluster_factory.create_batch(5)
+    bulk_stop_method = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.bulk_stop"
+    )
+    mocker.patch("atmo.clusters.provisioners.ClusterProvisioner.list", return_value=[])
+    mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.bulk_info", return_value={}
+    )
+    bulk_sync_method = mocker.patch("atmo.clusters.models.Cluster.bulk_sync")
+    clusters = cluster_factory.create_batch(5)
     deactivate_action(None, None, Cluster.objects.all())
-    assert deactivate_method.call_count == 5
+    assert bulk_stop_method.call_count == 1
+    assert sorted(bulk_stop_method.call_args[0][0]) == sorted(
+        cluster.jobflow_id for cluster in clusters
+    )
+    assert bulk_sync_method.call_count == 1
+    assert len(bulk_sync_method.call_args[0][0]) == 5
@@ -5,6 +5,7 @@ from datetime import timedelta
 
 import pytest
 from django.utils import timezone
+from django_redis import get_redis_connection
 
 from atmo.clusters import models
 from atmo.stats.models import Metric
@@ -115,3 +116,145 @@ def test_natural_sorting(emr_release_factory):
     )
     assert versions.ordered
     assert list(versions) == expected
+
+
+def test_bulk_sync(mocker, now, cluster_factory):
+    cluster1 = cluster_factory(most_recent_status=models.Cluster.STATUS_WAITING)
+    cluster2 = cluster_factory(most_recent_status=models.Cluster.STATUS_WAITING)
+    bulk_info = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.bulk_info",
+        return_value={
+            cluster1.jobflow_id: {
+                "state": models.Cluster.STATUS_TERMINATING,
+                "creation_datetime": now,
+            }
+        },
+    )
+    synced_clusters = models.Cluster.bulk_sync([cluster1, cluster2])
+    assert list(bulk_info.call_args[0][0]) == [cluster1.jobflow_id, cluster2.jobflow_id]
+    assert synced_clusters == [cluster1]
+    cluster1.refresh_from_db()
+    assert cluster1.most_recent_status == models.Cluster.STATUS_TERMINATING
+    cluster2.refresh_from_db()
+    assert cluster2.most_recent_status == models.Cluster.STATUS_WAITING
+
+
+def test_bulk_sync_infos(mocker, now, cluster_factory):
+    cluster1 = cluster_factory(most_recent_status=models.Cluster.STATUS_STARTING)
+    cluster2 = cluster_factory(most_recent_status=models.Cluster.STATUS_WAITING)
+    bulk_info = mocker.patch("atmo.clusters.provisioners.ClusterProvisioner.bulk_info")
+    # not part of the cluster info and therefore not written
+    cluster2.identifier = "changed-in-memory"
+    infos = {
+        cluster1.jobflow_id: {
+            "state": models.Cluster.STATUS_WAITING,
+            "creation_datetime": now - timedelta(minutes=10),
+            "ready_datetime": now,
+        },
+        cluster2.jobflow_id: {"state": models.Cluster.STATUS_TERMINATED},
+    }
+    synced_clusters = models.Cluster.bulk_sync([cluster1, cluster2], infos)
+    assert not bulk_info.called
+    assert synced_clusters == [cluster1, cluster2]
+
+    cluster1.refresh_from_db()
+    assert cluster1.most_recent_status == models.Cluster.STATUS_WAITING
+    assert cluster1.started_at == now - timedelta(minutes=10)
+    assert cluster1.ready_at == now
+    cluster2.refresh_from_db()
+    assert cluster2.most_recent_status == models.Cluster.STATUS_TERMINATED
+    assert cluster2.identifier != "changed-in-memory"
+    # the terminated cluster doesn't expire anymore
+    redis = get_redis_connection()
+    assert redis.zscore(models.expiration_deadlines.key, cluster1.pk) is not None
+    assert redis.zscore(models.expiration_deadlines.key, cluster2.pk) is None
+
+    assert Metric.objects.get(key="cluster-time-to-ready").value == 600
+    assert Metric.objects.get(key="cluster-ready").data["jobflow_id"] == (
+        cluster1.jobflow_id
+    )
+
+
+def test_bulk_deactivate(mocker, cluster_factory):
+    cluster1 = cluster_factory(most_recent_status=models.Cluster.STATUS_WAITING)
+    cluster2 = cluster_factory(most_recent_status=models.Cluster.STATUS_WAITING)
+    cluster3 = cluster_factory(most_recent_status=models.Cluster.STATUS_WAITING)
+    bulk_stop = mocker.patch("atmo.clusters.provisioners.ClusterProvisioner.bulk_stop")
+    cluster_list = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.list",
+        return_value=[
+            {
+                "jobflow_id": cluster.jobflow_id,
+                "state": models.Cluster.STATUS_TERMINATING,
+                "creation_datetime": cluster.created_at,
+            }
+            for cluster in [cluster1, cluster2]
+        ]
+        + [{"jobflow_id": "j-other", "state": models.Cluster.STATUS_TERMINATED}],
+    )
+    # the cluster that wasn't listed is described
+    bulk_info = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.bulk_info",
+        return_value={
+            cluster3.jobflow_id: {"state": models.Cluster.STATUS_TERMINATING}
+        },
+    )
+    deactivated_clusters = models.Cluster.bulk_deactivate(
+        models.Cluster.objects.order_by("pk")
+    )
+    assert list(bulk_stop.call_args[0][0]) == [
+        cluster1.jobflow_id,
+        cluster2.jobflow_id,
+        cluster3.jobflow_id,
+    ]
+    # a single list pass after terminating
+    cluster_list.assert_called_once_with(
+        created_after=cluster1.created_at - timedelta(minutes=1),
+        states=(
+            models.Cluster.STATUS_TERMINATING,
+            models.Cluster.STATUS_TERMINATED,
+            models.Cluster.STATUS_TERMINATED_WITH_ERRORS,
+        ),
+    )
+    bulk_info.assert_called_once_with([cluster3.jobflow_id])
+    assert deactivated_clusters == [cluster1, cluster2, cluster3]
+    assert set(models.Cluster.objects.values_list("most_recent_status", flat=True)) == {
+        models.Cluster.STATUS_TERMINATING
+    }
+
+
+def test_poll_interval(settings, now, cluster_factory):
+    settings.AWS_CONFIG = dict(
+        settings.AWS_CONFIG,
+        CLUSTER_POLL_INTERVALS={"BOOTSTRAPPING": 60, "WAITING": 300},
+        CLUSTER_POLL_MAX_INTERVAL=900,
+    )
+    cluster = cluster_factory(
+        most_recent_status=models.Cluster.STATUS_BOOTSTRAPPING,
+        expires_at=now + timedelta(hours=8),
+    )
+    assert cluster.poll_interval(now) == timedelta(minutes=1)
+
+    # stable clusters are polled less often the longer they are ready
+    cluster.most_recent_status = models.Cluster.STATUS_WAITING
+    cluster.ready_at = now - timedelta(minutes=30)
+    assert cluster.poll_interval(now) == timedelta(minutes=5)
+    cluster.ready_at = now - timedelta(minutes=90)
+    assert cluster.poll_interval(now) == timedelta(minutes=10)
+    cluster.ready_at = now - timedelta(days=100)
+    assert cluster.poll_interval(now) == timedelta(minutes=15)
+
+    # and more often again when they are about to expire
+    cluster.expires_at = now + timedelta(minutes=10)
+    assert cluster.poll_interval(now) == timedelta(minutes=5)
+    cluster.expires_at = now - timedelta(minutes=10)
+    assert cluster.poll_interval(now) == timedelta(minutes=1)
+
+
+def test_schedule_poll(now, cluster_factory):
+    cluster = cluster_factory(most_recent_status=models.Cluster.STATUS_STARTING)
+    cluster.schedule_poll(now)
+    assert cluster.next_poll_at == now + cluster.poll_interval(now)
+    cluster.most_recent_status = models.Cluster.STATUS_TERMINATED
+    cluster.schedule_poll(now)
+    assert cluster.next_poll_at is None
@@ -1,23 +1,103 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import threading
 from datetime import datetime
 
 import constance
+import requests
+from botocore.exceptions import ClientError, EndpointConnectionError
 from botocore.stub import ANY, Stubber
 from freezegun import freeze_time
 
-from atmo.provisioners import Provisioner
+from atmo.provisioners import ClientRegistry, Provisioner
+
+
+def test_provisioner_shared_clients():
+    provisioner1 = Provisioner()
+    provisioner2 = Provisioner()
+    assert provisioner1.emr is provisioner2.emr
+    assert provisioner1.s3 is provisioner2.s3
+    assert provisioner1.session is provisioner2.session
+
+
+def test_client_registry_counters(mocker):
+    client = mocker.patch("atmo.provisioners.boto3.client")
+    registry = ClientRegistry()
+    emr = registry.client("emr", region_name="us-west-2")
+    assert registry.client("emr", region_name="us-west-2") is emr
+    registry.client("emr", region_name="eu-central-1")
+    assert client.call_count == 2
+    assert registry.stats() == {"hits": 1, "misses": 2, "size": 2}
+
+
+def test_client_registry_fork_safety(mocker):
+    registry = ClientRegistry()
+    session = registry.session()
+    assert registry.session() is session
+    # pretend we're in a forked child process
+    mocker.patch("atmo.provisioners.os.getpid", return_value=registry.pid + 1)
+    assert registry.session() is not session
+    assert registry.stats() == {"hits": 1, "misses": 2, "size": 1}
 
 
 def test_spark_emr_configuration(mocker):
     provisioner = Provisioner()
     mocker.stopall()
-    mock_get = mocker.patch.object(provisioner.session, "get")
-    provisioner.spark_emr_configuration()
+    mock_get = mocker.patch.object(
+        provisioner.session,
+        "get",
+        return_value=mocker.Mock(
+            status_code=200, headers={"ETag": '"v1"'}, json=lambda: [{"v": 1}]
+        ),
+    )
+    assert provisioner.spark_emr_configuration() == [{"v": 1}]
     mock_get.assert_called_with(provisioner.spark_emr_configuration_url)
 
 
+def test_spark_emr_configuration_cached(mocker, settings):
+    settings.AWS_CONFIG = dict(settings.AWS_CONFIG, SPARK_EMR_CONFIGURATION_TTL=60)
+    provisioner = Provisioner()
+    mocker.stopall()
+    mock_get = mocker.patch.object(
+        provisioner.session,
+        "get",
+        return_value=mocker.Mock(
+            status_code=200, headers={"ETag": '"v1"'}, json=lambda: [{"v": 1}]
+        ),
+    )
+    with freeze_time("2017-02-03 13:48:09"):
+        assert provisioner.spark_emr_configuration() == [{"v": 1}]
+        assert provisioner.spark_emr_configuration() == [{"v": 1}]
+    assert mock_get.call_count == 1
+
+    # after the TTL the cached copy is revalidated using the ETag
+    mock_get.return_value = mocker.Mock(status_code=304)
+    with freeze_time("2017-02-03 13:49:10"):
+        assert provisioner.spark_emr_configuration() == [{"v": 1}]
+    assert mock_get.call_count == 2
+    mock_get.assert_called_with(
+        provisioner.spark_emr_configuration_url, headers={"If-None-Match": '"v1"'}
+    )
+
+
+def test_spark_emr_configuration_stale(mocker, settings):
+    settings.AWS_CONFIG = dict(settings.AWS_CONFIG, SPARK_EMR_CONFIGURATION_TTL=0)
+    provisioner = Provisioner()
+    mocker.stopall()
+    mock_get = mocker.patch.object(
+        provisioner.session,
+        "get",
+        return_value=mocker.Mock(status_code=200, headers={}, json=lambda: [{"v": 1}]),
+    )
+    assert provisioner.spark_emr_configuration() == [{"v": 1}]
+
+    # failing to fetch the document returns the stale copy
+    mock_get.side_effect = requests.ConnectionError
+    assert provisioner.spark_emr_configuration() == [{"v": 1}]
+    assert mock_get.call_count == 2
+
+
 @freeze_time("2017-02-03 13:48:09")
 def test_cluster_start(mocker, cluster_provisioner, ssh_key, user):
     identifier = "test-flow"
@@ -128,7 +208,7 @@ def test_list_cluster(mocker, cluster_provisioner):
         },
     )
 
-    cluster_list = cluster_provisioner.list(today)
+    cluster_list = list(cluster_provisioner.list(today))
     assert list_cluster.call_count == 1
     assert cluster_list == [
         {
@@ -173,6 +253,9 @@ def test_list_cluster_pagination(mocker, cluster_provisioner):
     )
 
     cluster_list = cluster_provisioner.list(today)
+    # the pages are fetched lazily
+    assert list_cluster.call_count == 0
+    cluster_list = list(cluster_list)
     assert list_cluster.call_count == 2
 
     cluster = {
@@ -198,6 +281,44 @@ def test_stop_cluster(cluster_provisioner):
         cluster_provisioner.stop(jobflow_id="12345")
 
 
+def test_bulk_stop_clusters(cluster_provisioner):
+    cluster_provisioner.config = dict(
+        cluster_provisioner.config, TERMINATE_JOB_FLOWS_BATCH_SIZE=2
+    )
+    stubber = Stubber(cluster_provisioner.emr)
+    stubber.add_response("terminate_job_flows", {}, {"JobFlowIds": ["1", "2"]})
+    stubber.add_response("terminate_job_flows", {}, {"JobFlowIds": ["3"]})
+
+    with stubber:
+        cluster_provisioner.bulk_stop(["1", "2", "1", "3"])
+    stubber.assert_no_pending_responses()
+
+
+def test_bulk_stop_clusters_invalid_id(cluster_provisioner):
+    cluster_provisioner.config = dict(
+        cluster_provisioner.config, TERMINATE_JOB_FLOWS_BATCH_SIZE=3
+    )
+    stubber = Stubber(cluster_provisioner.emr)
+    stubber.add_client_error(
+        "terminate_job_flows",
+        service_error_code="ValidationException",
+        expected_params={"JobFlowIds": ["1", "invalid", "2"]},
+    )
+    # the clusters of the failed batch are stopped one by one
+    stubber.add_response("terminate_job_flows", {}, {"JobFlowIds": ["1"]})
+    stubber.add_client_error(
+        "terminate_job_flows",
+        service_error_code="ValidationException",
+        expected_params={"JobFlowIds": ["invalid"]},
+    )
+    stubber.add_response("terminate_job_flows", {}, {"JobFlowIds": ["2"]})
+    stubber.add_response("terminate_job_flows", {}, {"JobFlowIds": ["3"]})
+
+    with stubber:
+        cluster_provisioner.bulk_stop(["1", "invalid", "2", "3"])
+    stubber.assert_no_pending_responses()
+
+
 def test_create_cluster_valid_parameters(cluster_provisioner):
     """Test that the parameters passed down to run_job_flow are valid"""
 
@@ -255,6 +376,76 @@ def test_cluster_info(cluster_provisioner):
         }
 
 
+def test_cluster_bulk_info(mocker, cluster_provisioner):
+    def info(jobflow_id):
+        if jobflow_id == "j-failing":
+            raise ClientError(
+                {"Error": {"Code": "InvalidRequestException"}}, "DescribeCluster"
+            )
+        return {"state": "RUNNING", "jobflow_id": jobflow_id}
+
+    mocker.patch.object(cluster_provisioner, "info", side_effect=info)
+    infos = cluster_provisioner.bulk_info(["j-1", "j-failing", "j-2", "j-1"])
+    # the failing cluster is left out, the duplicate is only described once
+    assert list(infos.keys()) == ["j-1", "j-2"]
+    assert infos["j-2"] == {"state": "RUNNING", "jobflow_id": "j-2"}
+    assert cluster_provisioner.info.call_count == 3
+    assert cluster_provisioner.bulk_info([]) == {}
+
+
+def test_cluster_bulk_info_closes_connections(mocker, cluster_provisioner):
+    mocker.patch.object(cluster_provisioner, "info", return_value={"state": "RUNNING"})
+    connection = mocker.patch("atmo.clusters.provisioners.connection")
+    cluster_provisioner.bulk_info(["j-1", "j-2"])
+    # the connections of the worker threads are closed after every call
+    assert connection.close.call_count == 2
+
+
+def test_cluster_bulk_info_botocore_error(mocker, cluster_provisioner):
+    def info(jobflow_id):
+        if jobflow_id == "j-failing":
+            raise EndpointConnectionError(endpoint_url="https://example.com")
+        return {"state": "RUNNING"}
+
+    mocker.patch.object(cluster_provisioner, "info", side_effect=info)
+    infos = cluster_provisioner.bulk_info(["j-1", "j-failing", "j-2"])
+    assert list(infos.keys()) == ["j-1", "j-2"]
+
+
+def test_cluster_bulk_info_timeout(mocker, settings, cluster_provisioner):
+    settings.AWS_CONFIG = dict(settings.AWS_CONFIG, DESCRIBE_CLUSTER_TIMEOUT=0.01)
+    cluster_provisioner.config = settings.AWS_CONFIG
+    event = threading.Event()
+
+    def info(jobflow_id):
+        if jobflow_id == "j-slow":
+            event.wait(1)
+        return {"state": "RUNNING"}
+
+    mocker.patch.object(cluster_provisioner, "info", side_effect=info)
+    infos = cluster_provisioner.bulk_info(["j-slow", "j-fast"])
+    event.set()
+    assert list(infos.keys()) == ["j-fast"]
+
+
+def test_cluster_bulk_info_shared_timeout(mocker, settings, cluster_provisioner):
+    settings.AWS_CONFIG = dict(
+        settings.AWS_CONFIG, DESCRIBE_CLUSTER_WORKERS=1, DESCRIBE_CLUSTER_TIMEOUT=0.15
+    )
+    cluster_provisioner.config = settings.AWS_CONFIG
+    event = threading.Event()
+
+    def info(jobflow_id):
+        event.wait(0.1)
+        return {"state": "RUNNING"}
+
+    mocker.patch.object(cluster_provisioner, "info", side_effect=info)
+    # the timeout applies to all calls together, not to each one
+    infos = cluster_provisioner.bulk_info(["j-1", "j-2", "j-3"])
+    event.set()
+    assert list(infos.keys()) == ["j-1"]
+
+
 def test_cluster_list(cluster_provisioner):
     created_after = datetime(1970, 1, 1)
     created_before = datetime(2020, 1, 1)
@@ -318,7 +509,7 @@ def test_cluster_list(cluster_provisioner):
     stubber.add_response("list_clusters", response, expected_params)
     with stubber:
 
-        info = cluster_provisioner.list(created_after)
+        info = list(cluster_provisioner.list(created_after))
         assert info == expected_result
 
     # with created_before
@@ -326,5 +517,18 @@ def test_cluster_list(cluster_provisioner):
     stubber.add_response("list_clusters", response, expected_params)
 
     with stubber:
-        info = cluster_provisioner.list(created_after, created_before=created_before)
+        info = list(
+            cluster_provisioner.list(created_after, created_before=created_before)
+        )
         assert info == expected_result
+
+    # with cluster states
+    expected_params = {
+        "CreatedAfter": created_after,
+        "ClusterStates": ["STARTING", "RUNNING"],
+    }
+    stubber.add_response("list_clusters", response, expected_params)
+
+    with stubber:
+        info = cluster_provisioner.list(created_after, states=("STARTING", "RUNNING"))
+        assert list(info) == expected_result
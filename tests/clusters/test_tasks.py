@@ -4,17 +4,19 @@
 from datetime import timedelta
 
 from django.conf import settings
+from freezegun import freeze_time
 
 from atmo.clusters import models, tasks
+from atmo.tasks import update_emr_statuses
 
 
 def test_deactivate_clusters(mocker, one_hour_ago, cluster_factory):
     cluster = cluster_factory(
         expires_at=one_hour_ago, most_recent_status=models.Cluster.STATUS_WAITING
     )
-    deactivate = mocker.patch("atmo.clusters.models.Cluster.deactivate")
+    bulk_deactivate = mocker.patch("atmo.clusters.models.Cluster.bulk_deactivate")
     result = tasks.deactivate_clusters()
-    assert deactivate.call_count == 1
+    bulk_deactivate.assert_called_once_with([cluster])
     assert result == [[cluster.identifier, cluster.pk]]
 
 
@@ -22,20 +24,36 @@ def test_dont_deactivate_clusters(mocker, one_hour_ahead, cluster_factory):
     cluster_factory(
         expires_at=one_hour_ahead, most_recent_status=models.Cluster.STATUS_WAITING
     )
-    deactivate = mocker.patch("atmo.clusters.models.Cluster.deactivate")
+    stop = mocker.patch("atmo.clusters.provisioners.ClusterProvisioner.bulk_stop")
     result = tasks.deactivate_clusters()
-    assert deactivate.call_count == 0
+    assert stop.call_count == 0
     assert result == []
 
 
+def test_deactivate_clusters_arms_next_expiration(mocker, now, cluster_factory):
+    cluster = cluster_factory(
+        expires_at=now + timedelta(hours=1),
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+    # the index was lost
+    mocker.patch("atmo.clusters.models.expiration_deadlines.add")
+    send_task = mocker.patch("atmo.celery.celery.send_task")
+    with freeze_time(now + timedelta(minutes=50)):
+        assert tasks.deactivate_clusters() == []
+    send_task.assert_called_once_with(
+        "atmo.clusters.tasks.deactivate_clusters",
+        eta=cluster.expires_at + timedelta(seconds=1),
+    )
+
+
 def test_extended_cluster_does_not_deactiveate(mocker, one_hour_ago, cluster_factory):
     cluster = cluster_factory(
         expires_at=one_hour_ago, most_recent_status=models.Cluster.STATUS_WAITING
     )
     cluster.extend(2)
-    deactivate = mocker.patch("atmo.clusters.models.Cluster.deactivate")
+    stop = mocker.patch("atmo.clusters.provisioners.ClusterProvisioner.bulk_stop")
     result = tasks.deactivate_clusters()
-    assert deactivate.call_count == 0
+    assert stop.call_count == 0
     assert result == []
 
 
@@ -94,11 +112,17 @@ def test_update_master_address_empty(cluster, mocker):
     assert result is None
 
 
-def test_update_clusters_empty():
-    assert tasks.update_clusters() == []
+def test_update_clusters(mocker):
+    emr_statuses = mocker.patch(
+        "atmo.tasks.update_emr_statuses",
+        return_value={"clusters": ["cluster"], "spark_job_runs": []},
+    )
+    # kept for the already queued messages
+    assert tasks.update_clusters() == ["cluster"]
+    emr_statuses.assert_called_once_with()
 
 
-def test_update_clusters(mocker, now, user, cluster_factory):
+def test_update_emr_statuses_clusters(mocker, now, user, cluster_factory):
     cluster1 = cluster_factory(
         created_by=user,
         created_at=now - timedelta(days=1),
@@ -158,42 +182,240 @@ def test_update_clusters(mocker, now, user, cluster_factory):
     )
     cluster_save = mocker.patch("atmo.clusters.models.Cluster.save")
     metric_record = mocker.patch("atmo.stats.models.Metric.record")
+    metric_bulk_record = mocker.patch("atmo.stats.models.Metric.bulk_record")
 
-    result = tasks.update_clusters()
+    result = update_emr_statuses()["clusters"]
     cluster_provisioner_list.assert_called_once_with(
-        created_after=(now - timedelta(days=3)).replace(hour=0, minute=0, second=0)
+        created_after=(now - timedelta(days=3)).replace(hour=0, minute=0, second=0),
+        states=models.Cluster.ACTIVE_STATUS_LIST,
     )
-    assert cluster_save.call_count == 3
     assert result == [cluster1.identifier, cluster2.identifier, cluster3.identifier]
 
+    # the changes are written in bulk instead of saving each cluster
+    assert cluster_save.call_count == 0
+    cluster2.refresh_from_db()
+    assert cluster2.ready_at == now - timedelta(hours=6)
+    assert cluster2.finished_at is None
+    cluster3.refresh_from_db()
+    assert cluster3.most_recent_status == models.Cluster.STATUS_WAITING
+    assert cluster3.finished_at == now - timedelta(hours=2)
+    assert cluster3.modified_at >= now
+
     assert metric_record.call_args_list == [
+        mocker.call("cluster-poll-pages", 0, data={"task": "update_emr_statuses"}),
         mocker.call(
-            "cluster-ready",
-            data={
-                "identifier": cluster2.identifier,
-                "jobflow_id": cluster2.jobflow_id,
-                "size": cluster2.size,
-            },
+            "cluster-poll-formatted",
+            4,
+            data={"task": "update_emr_statuses", "described": 0},
         ),
-        mocker.call(
-            "cluster-time-to-ready",
-            64800,
-            data={
-                "identifier": cluster2.identifier,
-                "jobflow_id": cluster2.jobflow_id,
-                "size": cluster2.size,
+    ]
+    metric_bulk_record.assert_called_once_with(
+        [
+            {
+                "key": "cluster-ready",
+                "data": {
+                    "identifier": cluster2.identifier,
+                    "jobflow_id": cluster2.jobflow_id,
+                    "size": cluster2.size,
+                },
             },
-        ),
-        mocker.call(
-            "cluster-normalized-instance-hours",
-            110,
-            data={
-                "identifier": cluster3.identifier,
-                "jobflow_id": cluster3.jobflow_id,
-                "size": cluster3.size,
+            {
+                "key": "cluster-time-to-ready",
+                "value": 64800,
+                "data": {
+                    "identifier": cluster2.identifier,
+                    "jobflow_id": cluster2.jobflow_id,
+                    "size": cluster2.size,
+                },
             },
+            {
+                "key": "cluster-normalized-instance-hours",
+                "value": 110,
+                "data": {
+                    "identifier": cluster3.identifier,
+                    "jobflow_id": cluster3.jobflow_id,
+                    "size": cluster3.size,
+                },
+            },
+        ]
+    )
+
+
+def test_update_emr_statuses_high_water_mark(mocker, now, user, cluster_factory):
+    cluster1 = cluster_factory(
+        created_by=user,
+        created_at=now - timedelta(days=2),
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+    cluster2 = cluster_factory(
+        created_by=user,
+        created_at=now - timedelta(days=1),
+        most_recent_status=models.Cluster.STATUS_WAITING,
+    )
+    info = {
+        "state": models.Cluster.STATUS_WAITING,
+        "ready_datetime": None,
+        "end_datetime": None,
+        "state_change_reason_code": "",
+        "state_change_reason_message": "",
+    }
+    cluster_provisioner_list = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.list",
+        return_value=[
+            dict(info, jobflow_id=cluster2.jobflow_id, creation_datetime=now)
+        ],
+    )
+    # the first cluster isn't listed as active anymore, so it's described
+    cluster_provisioner_info = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.info",
+        return_value=dict(
+            info,
+            state=models.Cluster.STATUS_TERMINATED,
+            creation_datetime=now - timedelta(days=2),
+            end_datetime=now,
         ),
+    )
+    mocker.patch("atmo.clusters.models.Cluster.save")
+    mocker.patch("atmo.stats.models.Metric.record")
+
+    result = update_emr_statuses()["clusters"]
+    assert sorted(result) == sorted([cluster1.identifier, cluster2.identifier])
+    cluster_provisioner_info.assert_called_once_with(cluster1.jobflow_id)
+
+    # the next poll starts at the oldest cluster that was still active
+    models.Cluster.objects.update(next_poll_at=None)
+    update_emr_statuses()
+    assert cluster_provisioner_list.call_args == mocker.call(
+        created_after=now - timedelta(minutes=1),
+        states=models.Cluster.ACTIVE_STATUS_LIST,
+    )
+
+
+def test_update_emr_statuses_due(mocker, now, user, cluster_factory):
+    due_cluster = cluster_factory(
+        created_by=user,
+        created_at=now - timedelta(hours=1),
+        most_recent_status=models.Cluster.STATUS_BOOTSTRAPPING,
+        next_poll_at=now - timedelta(seconds=1),
+    )
+    cluster_factory(
+        created_by=user,
+        created_at=now - timedelta(hours=1),
+        most_recent_status=models.Cluster.STATUS_WAITING,
+        next_poll_at=now + timedelta(minutes=10),
+    )
+    cluster_provisioner_list = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.list",
+        return_value=[
+            {
+                "jobflow_id": due_cluster.jobflow_id,
+                "state": models.Cluster.STATUS_BOOTSTRAPPING,
+                "creation_datetime": due_cluster.created_at,
+            }
+        ],
+    )
+    cluster_provisioner_info = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.info"
+    )
+    # only the due cluster is updated and scheduled again
+    with freeze_time(now):
+        assert update_emr_statuses()["clusters"] == [due_cluster.identifier]
+    assert cluster_provisioner_list.call_count == 1
+    assert not cluster_provisioner_info.called
+    due_cluster.refresh_from_db()
+    assert due_cluster.next_poll_at == now + timedelta(minutes=1)
+
+    # nothing is due anymore
+    assert update_emr_statuses()["clusters"] == []
+    assert cluster_provisioner_list.call_count == 1
+
+
+def test_update_emr_statuses_high_water_mark_covers_all(mocker, now, cluster_factory):
+    due_cluster = cluster_factory(
+        created_at=now - timedelta(hours=1),
+        most_recent_status=models.Cluster.STATUS_BOOTSTRAPPING,
+        next_poll_at=now - timedelta(seconds=1),
+    )
+    other_cluster = cluster_factory(
+        created_at=now - timedelta(days=2),
+        most_recent_status=models.Cluster.STATUS_WAITING,
+        next_poll_at=now + timedelta(minutes=10),
+    )
+    mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.list",
+        return_value=[
+            {
+                "jobflow_id": cluster.jobflow_id,
+                "state": cluster.most_recent_status,
+                "creation_datetime": cluster.created_at,
+            }
+            for cluster in [due_cluster, other_cluster]
+        ],
+    )
+    with freeze_time(now):
+        assert update_emr_statuses()["clusters"] == [due_cluster.identifier]
+    # the cluster that wasn't due stays within the listed time frame
+    assert tasks.cache.get(
+        tasks.HIGH_WATER_MARK_KEY % "update_emr_statuses"
+    ) == other_cluster.created_at - timedelta(minutes=1)
+
+
+def test_fan_out_sync_clusters(settings, mocker, now, cluster_factory):
+    settings.AWS_CONFIG = dict(
+        settings.AWS_CONFIG, CLUSTER_SYNC_FAN_OUT_THRESHOLD=2, CLUSTER_SYNC_SHARDS=2
+    )
+    clusters = [
+        cluster_factory(most_recent_status=models.Cluster.STATUS_BOOTSTRAPPING)
+        for i in range(4)
     ]
+    cluster_mapping = {
+        cluster.jobflow_id: {
+            "state": models.Cluster.STATUS_WAITING,
+            "creation_datetime": now,
+        }
+        for cluster in clusters
+    }
+    active_clusters = models.Cluster.objects.active()
+
+    # few clusters are synced right away
+    few_clusters = {clusters[0].jobflow_id: cluster_mapping[clusters[0].jobflow_id]}
+    assert tasks.fan_out_sync_clusters(
+        "update_clusters", active_clusters, few_clusters, 0
+    ) == [clusters[0].identifier]
+
+    chord = mocker.patch("atmo.clusters.tasks.chord")
+    sync_id = tasks.fan_out_sync_clusters(
+        "update_clusters", active_clusters, cluster_mapping, 0
+    )
+    header = list(chord.call_args[0][0])
+    shard_numbers = [signature.args[1] for signature in header]
+    assert all(signature.args[0] == sync_id for signature in header)
+    assert chord.return_value.call_args[0][0].args[:2] == ("update_clusters", sync_id)
+
+    # every cluster is in exactly one shard
+    results = [tasks.sync_cluster_shard(sync_id, number) for number in shard_numbers]
+    assert sorted(sum((result["clusters"] for result in results), [])) == sorted(
+        cluster.identifier for cluster in clusters
+    )
+    assert set(models.Cluster.objects.values_list("most_recent_status", flat=True)) == {
+        models.Cluster.STATUS_WAITING
+    }
+    # the shards are removed from the cache when done
+    assert tasks.sync_cluster_shard(sync_id, shard_numbers[0])["clusters"] == []
+
+    metric_record = mocker.patch("atmo.stats.models.Metric.record")
+    updated_clusters = tasks.report_cluster_sync(
+        results, "update_clusters", sync_id, 0, 1
+    )
+    assert sorted(updated_clusters) == sorted(
+        cluster.identifier for cluster in clusters
+    )
+    key, duration = metric_record.call_args[0]
+    assert key == "cluster-sync-duration"
+    data = metric_record.call_args[1]["data"]
+    assert data["shards"] == len(shard_numbers)
+    assert data["clusters"] == 4
+    assert data["listing"] == 1000
 
 
 def test_extended_cluster_resends_expiration_mail(mailoutbox, mocker, one_hour_ago, cluster_factory):
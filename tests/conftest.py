@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 import io
+import json
 from datetime import timedelta
 
 import pytest
@@ -11,6 +12,7 @@ from django.utils import timezone
 from django_redis import get_redis_connection
 from pytest_factoryboy import register as factory_register
 
+from atmo import events
 from atmo.clusters.factories import ClusterFactory, EMRReleaseFactory
 from atmo.clusters.models import Cluster
 from atmo.clusters.provisioners import ClusterProvisioner
@@ -178,3 +180,24 @@ def patch_spark_emr_configuration(mocker):
             }
         ],
     )
+
+
+@pytest.fixture
+def state_change_event():
+    """
+    Return a function that returns an EMR cluster state change event for
+    the given cluster ID, state and optional state change reason.
+    """
+
+    def maker(jobflow_id, state, reason=None):
+        detail = {"clusterId": jobflow_id, "state": state, "severity": "INFO"}
+        if reason is not None:
+            detail["stateChangeReason"] = json.dumps(reason)
+        return {
+            "source": "aws.emr",
+            "detail-type": events.CLUSTER_STATE_CHANGE,
+            "time": "2017-01-01T12:00:00Z",
+            "detail": detail,
+        }
+
+    return maker
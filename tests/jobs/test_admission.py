@@ -0,0 +1,160 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import pytest
+from django_redis import get_redis_connection
+
+from atmo import quotas
+from atmo.celery import celery
+from atmo.clusters.models import Cluster
+from atmo.jobs import admission, tasks
+from atmo.jobs.models import SparkJob
+from atmo.stats.models import Metric
+
+
+@pytest.fixture
+def limits(settings):
+    settings.AWS_CONFIG = dict(
+        settings.AWS_CONFIG,
+        PROVISIONING_MAX_LAUNCHES=2,
+        PROVISIONING_MAX_INSTANCES=10,
+        PROVISIONING_WINDOW=60,
+        PROVISIONING_WINDOW_LAUNCHES=1,
+        PROVISIONING_BURST=5,
+    )
+    return settings.AWS_CONFIG
+
+
+@pytest.fixture
+def send_task(mocker):
+    return mocker.patch.object(celery, "send_task")
+
+
+def queued():
+    return [int(pk) for pk in get_redis_connection().zrange(admission.QUEUE_KEY, 0, -1)]
+
+
+def test_priority(spark_job_factory):
+    daily = spark_job_factory(interval_in_hours=SparkJob.INTERVAL_DAILY)
+    monthly = spark_job_factory(interval_in_hours=SparkJob.INTERVAL_MONTHLY)
+    assert admission.priority(monthly, first_run=True) == admission.PRIORITY_FIRST_RUN
+    assert admission.priority(daily) == admission.PRIORITY_DAILY
+    assert admission.priority(monthly) == admission.PRIORITY_MONTHLY
+
+
+def test_usage(limits, spark_job_run_factory, cluster_factory):
+    spark_job_run_factory(size=3)  # not synced yet
+    spark_job_run_factory(size=2, status=Cluster.STATUS_RUNNING)
+    spark_job_run_factory(size=7, status=Cluster.STATUS_TERMINATED)
+    cluster_factory(size=4, most_recent_status=Cluster.STATUS_BOOTSTRAPPING)
+    assert admission.admission.usage() == (2, 9)
+
+    assert admission.admission.fits(1, 9, 1)
+    assert not admission.admission.fits(1, 9, 2)
+    assert not admission.admission.fits(2, 0, 1)
+    # clusters larger than the limit may be launched on their own
+    assert admission.admission.fits(0, 0, 20)
+
+
+def test_admit_and_queue(limits, spark_job_factory, spark_job_run_factory):
+    spark_job = spark_job_factory(size=8)
+    assert admission.admission.admit(spark_job)
+
+    spark_job_run_factory(size=8)
+    assert not admission.admission.admit(spark_job)
+    assert not admission.admission.admit(spark_job)
+    assert queued() == [spark_job.pk]
+
+    # later runs don't overtake the queued ones
+    small_job = spark_job_factory(size=1)
+    assert not admission.admission.admit(small_job, first_run=True)
+    assert queued() == [small_job.pk, spark_job.pk]
+
+
+def test_launches_are_smoothed(limits, spark_job_factory):
+    limits["PROVISIONING_BURST"] = 1
+    spark_job = spark_job_factory(size=1)
+    assert admission.admission.admit(spark_job)
+    assert not admission.admission.admit(spark_job)
+
+
+def test_drain(limits, send_task, spark_job_factory, spark_job_run_factory):
+    running = spark_job_run_factory(size=8, status=Cluster.STATUS_RUNNING)
+    weekly = spark_job_factory(size=4, interval_in_hours=SparkJob.INTERVAL_WEEKLY)
+    daily = spark_job_factory(size=1)
+    assert not admission.admission.admit(weekly)
+    assert not admission.admission.admit(daily)
+    assert queued() == [daily.pk, weekly.pk]
+
+    # the drain was armed once
+    send_task.assert_called_once_with(
+        "atmo.jobs.tasks.admit_queued_runs", countdown=admission.DRAIN_INTERVAL
+    )
+    send_task.reset_mock()
+
+    # the weekly job doesn't fit yet
+    assert tasks.admit_queued_runs() == [daily.pk]
+    send_task.assert_called_once_with(
+        "atmo.jobs.tasks.run_job",
+        args=(daily.pk,),
+        kwargs={"first_run": False, "admitted": True},
+    )
+    assert queued() == [weekly.pk]
+    assert Metric.objects.get(key="provisioning-queue-wait").data == {
+        "priority": admission.PRIORITY_DAILY
+    }
+    assert Metric.objects.get(key="provisioning-queue-depth").value == 1
+
+    running.status = Cluster.STATUS_TERMINATED
+    running.save()
+    assert tasks.admit_queued_runs() == [weekly.pk]
+    assert queued() == []
+
+
+def test_drain_rearms_while_queued(limits, send_task, spark_job_factory):
+    spark_job = spark_job_factory(size=1)
+    assert admission.admission.arm()
+    assert not admission.admission.arm()
+    send_task.reset_mock()
+    admission.admission.enqueue(spark_job)
+    assert not send_task.called
+
+    # the timer expired, e.g. after the drain was sent
+    get_redis_connection().delete(admission.TIMER_KEY)
+    limits["PROVISIONING_BURST"] = 0
+    assert tasks.admit_queued_runs() == []
+    send_task.assert_called_once_with(
+        "atmo.jobs.tasks.admit_queued_runs", countdown=admission.DRAIN_INTERVAL
+    )
+
+
+def test_run_job_queues(mocker, limits, spark_job_factory, spark_job_run_factory):
+    run = mocker.patch("atmo.jobs.models.SparkJob.run")
+    spark_job = spark_job_factory(size=1)
+    spark_job_run_factory.create_batch(2, size=1)
+
+    tasks.run_job(spark_job.pk)
+    assert run.call_count == 0
+    assert queued() == [spark_job.pk]
+
+    tasks.run_job(spark_job.pk, admitted=True)
+    assert run.call_count == 1
+
+
+def test_over_quota_runs_are_queued(
+    settings, limits, send_task, user, user2, spark_job_factory
+):
+    settings.USER_QUOTA = {"clusters": None, "runs": 1, "instances": None}
+    quotas.acquire(quotas.RUNS, 1, user, 1)
+    over_quota = spark_job_factory(size=1, created_by=user)
+    other = spark_job_factory(size=1, created_by=user2)
+    assert not admission.admission.admit(over_quota, first_run=True)
+    assert not admission.admission.admit(other)
+    assert queued() == [over_quota.pk, other.pk]
+
+    # the run of the other user isn't held up
+    assert tasks.admit_queued_runs() == [other.pk]
+    assert queued() == [over_quota.pk]
+
+    quotas.release(quotas.RUNS, [1])
+    assert tasks.admit_queued_runs() == [over_quota.pk]
@@ -254,6 +254,92 @@ def test_sync_terminated_with_errors(
     assert Metric.objects.filter(key="sparkjob-run-time").count() == 0
 
 
+@freeze_time("2016-04-05 13:25:47")
+@pytest.mark.usefixtures("transactional_db")
+def test_bulk_sync(mocker, sync_factory):
+    now, one_hour_ago, spark_job1 = sync_factory()
+    _, _, spark_job2 = sync_factory()
+    run1 = spark_job1.latest_run
+    run2 = spark_job2.latest_run
+    run_save = mocker.patch("atmo.jobs.models.SparkJobRun.save")
+    failed_info = {
+        "creation_datetime": one_hour_ago,
+        "ready_datetime": None,
+        "end_datetime": now,
+        "state": Cluster.STATUS_TERMINATED_WITH_ERRORS,
+        "state_change_reason_code": Cluster.STATE_CHANGE_REASON_BOOTSTRAP_FAILURE,
+        "state_change_reason_message": "Bootstrapping steps failed.",
+    }
+    infos = {
+        run1.jobflow_id: failed_info,
+        run2.jobflow_id: {
+            "creation_datetime": one_hour_ago,
+            "ready_datetime": now,
+            "end_datetime": None,
+            "state": Cluster.STATUS_WAITING,
+        },
+    }
+    # an alert for the same reason already exists
+    run1.alerts.create(
+        reason_code=failed_info["state_change_reason_code"],
+        reason_message=failed_info["state_change_reason_message"],
+    )
+
+    synced_runs = models.SparkJobRun.bulk_sync([run1, run2], infos)
+    assert synced_runs == [run1, run2]
+    assert run_save.call_count == 0
+
+    run1.refresh_from_db()
+    assert run1.status == Cluster.STATUS_TERMINATED_WITH_ERRORS
+    assert run1.finished_at == now
+    assert run1.alerts.count() == 1
+    run2.refresh_from_db()
+    assert run2.status == Cluster.STATUS_WAITING
+    assert run2.ready_at == now
+    assert not run2.alerts.exists()
+
+    assert Metric.objects.get(key="sparkjob-normalized-instance-hours").value == (
+        run1.size
+    )
+    assert Metric.objects.get(key="sparkjob-time-to-ready").data == {
+        "identifier": spark_job2.identifier,
+        "size": run2.size,
+        "jobflow_id": run2.jobflow_id,
+    }
+    assert not Metric.objects.filter(key="sparkjob-run-time").exists()
+
+
+@pytest.mark.usefixtures("transactional_db")
+def test_bulk_create_alerts_ignoring_conflicts(spark_job_with_run_factory):
+    run = spark_job_with_run_factory().latest_run
+    run.alerts.create(reason_code="code", reason_message="message")
+    models.SparkJobRunAlert.bulk_create_ignoring_conflicts(
+        [
+            models.SparkJobRunAlert(
+                run=run, reason_code="code", reason_message="message"
+            ),
+            models.SparkJobRunAlert(
+                run=run, reason_code="code", reason_message="other message"
+            ),
+        ]
+    )
+    assert sorted(run.alerts.values_list("reason_message", flat=True)) == [
+        "message",
+        "other message",
+    ]
+
+
+@pytest.mark.usefixtures("transactional_db")
+def test_bulk_create_alerts_without_reason_code(spark_job_with_run_factory):
+    run = spark_job_with_run_factory().latest_run
+    for _ in range(2):
+        models.SparkJobRunAlert.bulk_create_ignoring_conflicts(
+            [models.SparkJobRunAlert(run=run, reason_code=None, reason_message="")]
+        )
+    run.alert({"state_change_reason_code": None, "state_change_reason_message": ""})
+    assert list(run.alerts.values_list("reason_code", flat=True)) == [""]
+
+
 def test_first_run_without_run(mocker, spark_job):
     apply_async = mocker.patch("atmo.jobs.tasks.run_job.apply_async")
     spark_job.first_run()
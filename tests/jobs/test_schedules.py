@@ -2,10 +2,18 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 from datetime import timedelta
+from io import StringIO
 
-from redbeat.schedulers import RedBeatSchedulerEntry
+import pytest
+from django.core.management import call_command
+from django_redis import get_redis_connection
+from redbeat.schedulers import RedBeatSchedulerEntry, get_redis
 
-from atmo.jobs.schedules import SparkJobSchedule
+from atmo.celery import celery
+from atmo.jobs import schedules, tasks
+from atmo.jobs.models import SparkJob
+from atmo.jobs.schedules import DueJobSchedule, SparkJobSchedule
+from atmo.stats.models import Metric
 
 
 def test_init(spark_job):
@@ -46,3 +54,178 @@ def test_delete(spark_job):
     deleted = spark_job.schedule.delete()
     assert not deleted
     assert spark_job.schedule.get() is None
+
+
+def test_save_without_schedule_changes(mocker, now, spark_job):
+    spark_job.schedule.get().reschedule(last_run_at=now)
+    reset = mocker.spy(SparkJobSchedule, "reset")
+    spark_job.description = "changed"
+    spark_job.save()
+    assert reset.call_count == 0
+    # the last run wasn't lost
+    assert spark_job.schedule.get().last_run_at == now
+
+    # same for a job fetched from the database
+    spark_job = SparkJob.objects.get(pk=spark_job.pk)
+    spark_job.save()
+    assert reset.call_count == 0
+
+    spark_job.interval_in_hours = SparkJob.INTERVAL_WEEKLY
+    spark_job.save()
+    assert reset.call_count == 1
+    entry = spark_job.schedule.get()
+    assert entry.schedule.run_every == timedelta(hours=SparkJob.INTERVAL_WEEKLY)
+    assert entry.last_run_at != now
+
+
+def test_save_after_refresh(mocker, spark_job):
+    interval_in_hours = spark_job.interval_in_hours
+    # the schedule was changed by another process
+    SparkJob.objects.filter(pk=spark_job.pk).update(
+        interval_in_hours=SparkJob.INTERVAL_WEEKLY
+    )
+    spark_job.refresh_from_db()
+    reset = mocker.spy(SparkJobSchedule, "reset")
+
+    spark_job.interval_in_hours = interval_in_hours
+    spark_job.save()
+    assert reset.call_count == 1
+    entry = spark_job.schedule.get()
+    assert entry.schedule.run_every == timedelta(hours=interval_in_hours)
+
+
+def test_bulk_add_and_delete(spark_job_factory):
+    spark_jobs = spark_job_factory.create_batch(3)
+    assert SparkJobSchedule.bulk_delete(spark_jobs) == 3
+    assert all(spark_job.schedule.get() is None for spark_job in spark_jobs)
+    assert SparkJobSchedule.bulk_delete(spark_jobs) == 0
+
+    entries = SparkJobSchedule.bulk_add(spark_jobs[:2])
+    assert [repr(entry) for entry in entries] == [
+        repr(spark_job.schedule.get()) for spark_job in spark_jobs[:2]
+    ]
+    assert spark_jobs[2].schedule.get() is None
+
+
+def test_reconcile(one_hour_ago, spark_job_factory):
+    spark_jobs = spark_job_factory.create_batch(4)
+    assert schedules.reconcile() == {
+        "expected": 4,
+        "found": 4,
+        "missing": 0,
+        "orphaned": 0,
+        "stale": 0,
+    }
+    # missing
+    spark_jobs[0].schedule.delete()
+    # stale
+    stale_schedule = spark_jobs[1].schedule
+    stale_schedule.run_every = timedelta(hours=1)
+    stale_schedule.add()
+    redis = get_redis(celery)
+    redis.zrem(celery.redbeat_conf.schedule_key, spark_jobs[2].schedule.key)
+    # orphaned
+    SparkJob.objects.filter(pk=spark_jobs[3].pk).update(end_date=one_hour_ago)
+
+    drift = schedules.reconcile(repair=False)
+    assert (drift["missing"], drift["stale"], drift["orphaned"]) == (1, 2, 1)
+    assert schedules.reconcile() == drift
+    assert schedules.reconcile() == {
+        "expected": 3,
+        "found": 3,
+        "missing": 0,
+        "orphaned": 0,
+        "stale": 0,
+    }
+    assert spark_jobs[3].schedule.get() is None
+    entry = spark_jobs[1].schedule.get()
+    assert entry.schedule.run_every == timedelta(hours=SparkJob.INTERVAL_DAILY)
+
+
+def test_reconcile_schedules_task(spark_job):
+    spark_job.schedule.delete()
+    drift = tasks.reconcile_schedules()
+    assert drift["missing"] == 1
+    assert Metric.objects.get(key="spark-job-schedule-drift").value == 1
+    assert spark_job.schedule.get()
+
+
+@pytest.fixture
+def due_set(settings):
+    settings.SPARK_JOB_SCHEDULER = "due-set"
+
+
+def test_due_set_next_run_at(now, spark_job):
+    spark_job.start_date = now - timedelta(hours=36)
+    job_schedule = DueJobSchedule(spark_job)
+    assert job_schedule.next_run_at(now) == now + timedelta(hours=12)
+    # the first run at the start date is sent by SparkJob.first_run
+    spark_job.start_date = now + timedelta(hours=1)
+    job_schedule = DueJobSchedule(spark_job)
+    assert job_schedule.next_run_at(now) == now + timedelta(hours=25)
+
+
+def test_due_set_schedule(due_set, now, spark_job_factory):
+    spark_job = spark_job_factory(start_date=now - timedelta(hours=1))
+    assert isinstance(spark_job.schedule, DueJobSchedule)
+    # no RedBeat entry
+    assert SparkJobSchedule(spark_job).get() is None
+    entry = spark_job.schedule.get()
+    assert entry.due_at == now + timedelta(hours=23)
+    entry.reschedule(last_run_at=now)
+    assert spark_job.schedule.get().due_at == now + timedelta(hours=24)
+    assert spark_job.schedule.delete()
+    assert spark_job.schedule.get() is None
+
+
+def test_dispatch_due_jobs(due_set, mocker, now, spark_job_factory):
+    spark_jobs = spark_job_factory.create_batch(3, start_date=now - timedelta(days=1))
+    redis = get_redis_connection()
+    for spark_job in spark_jobs[:2]:
+        spark_job.schedule.get().reschedule(last_run_at=now - timedelta(days=1))
+    # deleted without removing the entry
+    redis.execute_command("ZADD", DueJobSchedule.key, 0, 12345)
+    send_task = mocker.patch.object(celery, "send_task")
+
+    dispatched = tasks.dispatch_due_jobs()
+
+    assert sorted(dispatched) == sorted(spark_job.pk for spark_job in spark_jobs[:2])
+    assert send_task.call_count == 2
+    send_task.assert_any_call("atmo.jobs.tasks.run_job", args=(spark_jobs[0].pk,))
+    assert redis.zscore(DueJobSchedule.key, 12345) is None
+    assert spark_jobs[0].schedule.get().due_at > now
+    assert tasks.dispatch_due_jobs() == []
+
+
+def test_dispatch_due_jobs_send_failure(due_set, mocker, now, spark_job_factory):
+    spark_jobs = spark_job_factory.create_batch(2, start_date=now - timedelta(days=1))
+    for spark_job in spark_jobs:
+        spark_job.schedule.get().reschedule(last_run_at=now - timedelta(days=1))
+    failing, sent = sorted(spark_jobs, key=lambda spark_job: spark_job.pk)
+
+    def send_task(name, args):
+        if args == (failing.pk,):
+            raise ConnectionError
+
+    mocker.patch.object(celery, "send_task", side_effect=send_task)
+    assert tasks.dispatch_due_jobs() == [sent.pk]
+    # the sent job is scheduled, the failed one is claimed until it's retried
+    assert sent.schedule.get().due_at > now + timedelta(hours=1)
+    assert now < failing.schedule.get().due_at < now + timedelta(minutes=6)
+
+
+def test_migrate_schedules(settings, now, spark_job_factory):
+    spark_job = spark_job_factory(start_date=now - timedelta(days=2))
+    spark_job.schedule.get().reschedule(last_run_at=now - timedelta(hours=1))
+
+    call_command("migrate_schedules", "due-set", stdout=StringIO())
+    assert spark_job.schedule.get() is None
+    settings.SPARK_JOB_SCHEDULER = "due-set"
+    assert spark_job.schedule.get().due_at == now + timedelta(hours=23)
+    assert schedules.reconcile()["orphaned"] == 0
+
+    call_command("migrate_schedules", "redbeat", stdout=StringIO())
+    settings.SPARK_JOB_SCHEDULER = "redbeat"
+    entry = spark_job.schedule.get()
+    assert entry.last_run_at == now - timedelta(hours=1)
+    assert not get_redis_connection().exists(DueJobSchedule.key)
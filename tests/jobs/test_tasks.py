@@ -11,7 +11,9 @@ from freezegun import freeze_time
 
 from atmo.clusters.models import Cluster
 from atmo.jobs import exceptions, schedules, tasks
+from atmo.jobs.models import SparkJobRun
 from atmo.stats.models import Metric
+from atmo.tasks import update_emr_statuses
 
 
 def test_run_job_not_exists():
@@ -182,9 +184,9 @@ def test_expire_jobs(mocker, one_hour_ago, spark_job_factory):
     spark_job.schedule.add()
     mocker.spy(schedules.SparkJobSchedule, "delete")
     result = tasks.expire_jobs()
-    # 2 since 1 is called as part of the expire call and one
-    # by the save call
-    assert spark_job.schedule.delete.call_count == 2
+    # only called as part of the expire call since the save call
+    # doesn't change the schedule fields
+    assert spark_job.schedule.delete.call_count == 1
     assert result == [[spark_job.identifier, spark_job.pk]]
 
 
@@ -206,9 +208,8 @@ def test_expire_and_no_schedule_delete(mocker, one_hour_ago, spark_job_factory):
 
     mocker.spy(schedules.SparkJobSchedule, "delete")
     result = tasks.expire_jobs()
-    # 4 since 1 is called as part of the expire call and one
-    # by the save call, x 2 jobs to expire
-    assert schedules.SparkJobSchedule.delete.call_count == 4
+    # 2 since 1 is called as part of the expire call, x 2 jobs to expire
+    assert schedules.SparkJobSchedule.delete.call_count == 2
     assert sorted(result) == sorted(
         [[spark_job1.identifier, spark_job1.pk], [spark_job2.identifier, spark_job2.pk]]
     )
@@ -247,12 +248,17 @@ def test_send_run_alert_mails(
     assert list(message.to) == [spark_job.created_by.email]
 
 
-def test_update_jobs_statuses_empty(mocker, now, user):
-    result = tasks.update_jobs_statuses()
-    assert result == []
+def test_update_jobs_statuses(mocker):
+    emr_statuses = mocker.patch(
+        "atmo.tasks.update_emr_statuses",
+        return_value={"clusters": [], "spark_job_runs": [["spark-job", 1]]},
+    )
+    # kept for the already queued messages
+    assert tasks.update_jobs_statuses() == [["spark-job", 1]]
+    emr_statuses.assert_called_once_with()
 
 
-def test_update_jobs_statuses_full(
+def test_update_emr_statuses_spark_job_runs(
     mocker, now, user, spark_job_factory, spark_job_run_factory
 ):
     spark_job1 = spark_job_factory.create(
@@ -340,15 +346,17 @@ def test_update_jobs_statuses_full(
             },
         ],
     )
-    spark_job_run_sync = mocker.patch("atmo.jobs.models.SparkJobRun.sync")
-    result = tasks.update_jobs_statuses()
+    spark_job_run_save = mocker.patch("atmo.jobs.models.SparkJobRun.save")
+    result = update_emr_statuses()["spark_job_runs"]
     cluster_provisioner_list.assert_called_once_with(
         created_after=(now - timedelta(days=3)).replace(
             hour=0, minute=0, second=0
-        )  # we test a "day" datetimes query
+        ),  # we test a "day" datetimes query
+        states=Cluster.ACTIVE_STATUS_LIST,
     )
-    # only four of five Spark job runs are updated
-    assert spark_job_run_sync.call_count == 4
+    # only four of five Spark job runs are updated, in bulk
+    assert spark_job_run_save.call_count == 0
+    assert SparkJobRun.objects.filter(started_at__isnull=False).count() == 4
     assert result == [
         [spark_job1.identifier, spark_job1_run.pk],
         [spark_job2.identifier, spark_job2_run.pk],
@@ -357,6 +365,64 @@ def test_update_jobs_statuses_full(
     ]
 
 
+def test_update_emr_statuses_stragglers(
+    mocker, now, settings, spark_job_factory, spark_job_run_factory
+):
+    settings.AWS_CONFIG = dict(settings.AWS_CONFIG, LIST_CLUSTERS_HORIZON=24 * 3)
+    spark_job = spark_job_factory.create(start_date=now - timedelta(days=30))
+    # a run that is stuck in an active state for weeks
+    straggler_run = spark_job_run_factory.create(
+        spark_job=spark_job, status=Cluster.STATUS_RUNNING
+    )
+    straggler_run.created_at = now - timedelta(days=21)
+    straggler_run.save()
+    recent_run = spark_job_run_factory.create(
+        spark_job=spark_job, status=Cluster.STATUS_RUNNING
+    )
+    recent_run.created_at = now - timedelta(hours=2)
+    recent_run.save()
+
+    info = {
+        "state": Cluster.STATUS_RUNNING,
+        "ready_datetime": None,
+        "end_datetime": None,
+        "state_change_reason_code": "",
+        "state_change_reason_message": "",
+    }
+    cluster_provisioner_list = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.list",
+        return_value=[
+            dict(
+                info,
+                jobflow_id=recent_run.jobflow_id,
+                creation_datetime=recent_run.created_at,
+            )
+        ],
+    )
+    cluster_provisioner_info = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.info",
+        return_value=dict(info, creation_datetime=straggler_run.created_at),
+    )
+    result = update_emr_statuses()["spark_job_runs"]
+    assert sorted(result) == sorted(
+        [
+            [spark_job.identifier, recent_run.pk],
+            [spark_job.identifier, straggler_run.pk],
+        ]
+    )
+    # only the recent window is listed
+    cluster_provisioner_list.assert_called_once_with(
+        created_after=(now - timedelta(hours=2)).replace(hour=0, minute=0, second=0),
+        states=Cluster.ACTIVE_STATUS_LIST,
+    )
+    # while the straggler is described
+    cluster_provisioner_info.assert_called_once_with(straggler_run.jobflow_id)
+
+    formatted = Metric.objects.get(key="cluster-poll-formatted")
+    assert formatted.value == 2
+    assert formatted.data == {"task": "update_emr_statuses", "described": 1}
+
+
 def test_send_expired_mails(mailoutbox, mocker, now, spark_job):
     spark_job.expired_date = now
     spark_job.save()
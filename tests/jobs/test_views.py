@@ -400,6 +400,22 @@ def test_run_with_client_error(client, messages, mocker, one_hour_ago, spark_job
     messages.assert_message_contains(response, "Spark job API error")
 
 
+def test_run_over_quota(settings, client, messages, mocker, spark_job):
+    settings.USER_QUOTA = {"clusters": None, "runs": 0, "instances": None}
+    run = mocker.patch("atmo.jobs.models.SparkJob.run")
+    enqueue = mocker.patch("atmo.jobs.admission.admission.enqueue")
+    mocker.patch(
+        "atmo.jobs.models.SparkJob.results",
+        new_callable=mocker.PropertyMock,
+        return_valurn=[],
+    )
+    response = client.post(spark_job.urls.run, follow=True)
+    assert run.call_count == 0
+    enqueue.assert_called_once_with(spark_job)
+    assert response.redirect_chain[-1] == (spark_job.urls.detail, 302)
+    messages.assert_message_contains(response, "Spark job run queued")
+
+
 def test_run_not_runnable(client, messages, mocker, now, spark_job):
     results = mocker.patch(
         "atmo.jobs.models.SparkJob.results",
@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import pytest
+from botocore.exceptions import ClientError
+from django_redis import get_redis_connection
+
+from atmo import circuitbreaker
+from atmo.celery import celery
+from atmo.middleware import CircuitBreakerMiddleware
+from atmo.simulator import SimulatedEMR, simulator
+from atmo.stats.models import Metric
+
+
+@pytest.fixture
+def breaker(settings):
+    settings.AWS_CONFIG = dict(
+        settings.AWS_CONFIG,
+        EMR_CIRCUIT_FAILURE_THRESHOLD=2,
+        EMR_CIRCUIT_FAILURE_WINDOW=60,
+        EMR_CIRCUIT_RESET_TIMEOUT=30,
+        EMR_CIRCUIT_PROBE_TIMEOUT=10,
+    )
+    return circuitbreaker.CircuitBreaker("emr")
+
+
+@pytest.fixture
+def emr_client(breaker):
+    simulator.reset()
+    yield breaker.install(SimulatedEMR(simulator))
+    simulator.reset()
+
+
+def fail_calls(settings, emr_client, count):
+    settings.AWS_SIMULATOR_CONFIG = dict(
+        settings.AWS_SIMULATOR_CONFIG, SERVER_ERROR_RATE=1
+    )
+    for i in range(count):
+        with pytest.raises(ClientError) as excinfo:
+            emr_client.list_clusters()
+        assert excinfo.value.response["Error"]["Code"] == "InternalServerError"
+    settings.AWS_SIMULATOR_CONFIG = dict(
+        settings.AWS_SIMULATOR_CONFIG, SERVER_ERROR_RATE=0
+    )
+
+
+def test_closed(breaker, emr_client):
+    assert breaker.state() == circuitbreaker.CLOSED
+    # client errors of a healthy API don't count
+    for i in range(3):
+        with pytest.raises(ClientError):
+            emr_client.describe_cluster(ClusterId="j-unknown")
+    assert breaker.state() == circuitbreaker.CLOSED
+    assert emr_client.list_clusters() == {"Clusters": []}
+
+
+def test_opens_after_failures(settings, breaker, emr_client):
+    fail_calls(settings, emr_client, 1)
+    assert breaker.state() == circuitbreaker.CLOSED
+    fail_calls(settings, emr_client, 1)
+    assert breaker.state() == circuitbreaker.OPEN
+    assert Metric.objects.filter(key="emr-circuit-opened").count() == 1
+
+    with pytest.raises(circuitbreaker.CircuitOpenError) as excinfo:
+        emr_client.list_clusters()
+    assert excinfo.value.response["Error"]["Code"] == "CircuitOpen"
+    assert 0 < excinfo.value.retry_after <= 30
+
+
+def test_throttling_counts_as_failure(settings, breaker, emr_client):
+    settings.AWS_SIMULATOR_CONFIG = dict(settings.AWS_SIMULATOR_CONFIG, THROTTLE_RATE=1)
+    for i in range(2):
+        with pytest.raises(ClientError):
+            emr_client.list_clusters()
+    assert breaker.state() == circuitbreaker.OPEN
+
+
+def test_successful_probe_closes(settings, breaker, emr_client):
+    fail_calls(settings, emr_client, 2)
+    # the reset timeout has passed
+    get_redis_connection().delete(breaker.key("open"))
+    assert breaker.state() == circuitbreaker.HALF_OPEN
+
+    assert emr_client.list_clusters() == {"Clusters": []}
+    assert breaker.state() == circuitbreaker.CLOSED
+    assert Metric.objects.filter(key="emr-circuit-closed").count() == 1
+
+
+def test_failed_probe_opens(settings, breaker, emr_client):
+    fail_calls(settings, emr_client, 2)
+    redis = get_redis_connection()
+    redis.delete(breaker.key("open"))
+    # another process is probing, the other calls fail fast meanwhile
+    redis.set(breaker.key("probe"), 1, ex=10)
+    with pytest.raises(circuitbreaker.CircuitOpenError) as excinfo:
+        emr_client.list_clusters()
+    assert excinfo.value.retry_after == 10
+
+    redis.delete(breaker.key("probe"))
+    fail_calls(settings, emr_client, 1)
+    assert breaker.state() == circuitbreaker.OPEN
+    assert Metric.objects.filter(key="emr-circuit-opened").count() == 2
+
+
+def test_retry_countdown(mocker):
+    backoff = mocker.patch.object(celery, "backoff", return_value=3)
+    assert celery.retry_countdown(ClientError({}, "ListClusters"), 2) == 3
+    backoff.assert_called_once_with(2, cap=60 * 60)
+    exc = circuitbreaker.CircuitOpenError("emr", "ListClusters", 25)
+    assert celery.retry_countdown(exc, 2) == 25
+
+
+def test_middleware(rf):
+    middleware = CircuitBreakerMiddleware(lambda request: None)
+    request = rf.get("/")
+    assert middleware.process_exception(request, ValueError()) is None
+    exc = circuitbreaker.CircuitOpenError("emr", "RunJobFlow", 25)
+    response = middleware.process_exception(request, exc)
+    assert response.status_code == 503
+    assert response["Retry-After"] == "25"
@@ -0,0 +1,96 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from datetime import timedelta
+
+import pytest
+from django_redis import get_redis_connection
+
+from atmo.celery import celery
+from atmo.clusters import models as cluster_models
+from atmo.deadlines import DeadlineIndex
+from atmo.jobs import models as job_models
+
+
+@pytest.fixture
+def send_task(mocker):
+    return mocker.patch.object(celery, "send_task")
+
+
+@pytest.fixture
+def index(settings):
+    settings.DEADLINE_TIMER_WINDOW = 20 * 60
+    return DeadlineIndex("test", "atmo.tasks.test")
+
+
+def deadlines(index):
+    return get_redis_connection().zrange(index.key, 0, -1)
+
+
+def test_add_and_remove(index, send_task, now):
+    index.add(1, now + timedelta(hours=1))
+    index.add(2, now + timedelta(minutes=10))
+    assert deadlines(index) == [b"2", b"1"]
+    # only the deadline within the window is armed
+    send_task.assert_called_once_with(
+        "atmo.tasks.test", eta=now + timedelta(minutes=10, seconds=1)
+    )
+    index.add(2, None)
+    index.remove(1)
+    assert deadlines(index) == []
+
+
+def test_arm_once(index, send_task, now):
+    deadline = now + timedelta(minutes=5)
+    assert index.arm([deadline, deadline], now) == 1
+    assert index.arm([deadline], now) == 0
+    assert index.arm([now - timedelta(minutes=1)], now) == 0
+    assert send_task.call_count == 1
+
+
+def test_sweep(index, send_task, now):
+    index.add(1, now - timedelta(minutes=1))
+    index.add(2, now + timedelta(hours=1))
+    assert index.sweep(now, rebuild=lambda: []) == 0
+    assert deadlines(index) == [b"2"]
+    # later, when the deadline has come within the window
+    assert index.sweep(now + timedelta(minutes=50), rebuild=lambda: []) == 1
+    send_task.assert_called_once_with(
+        "atmo.tasks.test", eta=now + timedelta(hours=1, seconds=1)
+    )
+
+
+def test_sweep_rebuilds(index, send_task, now):
+    rebuilt = [("3", now + timedelta(minutes=5)), ("4", now + timedelta(days=1))]
+    assert index.sweep(now, rebuild=lambda: rebuilt) == 1
+    assert deadlines(index) == [b"3", b"4"]
+    assert index.upcoming(now + timedelta(hours=1)) == [rebuilt[0]]
+
+
+def test_cluster_expiration(send_task, now, cluster_factory):
+    cluster = cluster_factory(
+        expires_at=now + timedelta(minutes=5),
+        most_recent_status=cluster_models.Cluster.STATUS_WAITING,
+    )
+    assert deadlines(cluster_models.expiration_deadlines) == [str(cluster.pk).encode()]
+    send_task.assert_called_once_with(
+        "atmo.clusters.tasks.deactivate_clusters",
+        eta=cluster.expires_at + timedelta(seconds=1),
+    )
+    cluster.extend(2)
+    score = get_redis_connection().zscore(
+        cluster_models.expiration_deadlines.key, cluster.pk
+    )
+    assert score == (now + timedelta(hours=2, minutes=5)).timestamp()
+
+    cluster.refresh_from_db()
+    cluster.most_recent_status = cluster.STATUS_TERMINATED
+    cluster.save()
+    assert deadlines(cluster_models.expiration_deadlines) == []
+
+
+def test_spark_job_lapse(send_task, now, spark_job_factory):
+    spark_job = spark_job_factory(end_date=now + timedelta(days=1))
+    assert deadlines(job_models.lapse_deadlines) == [str(spark_job.pk).encode()]
+    spark_job.expire()
+    assert deadlines(job_models.lapse_deadlines) == []
@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import json
+from datetime import datetime, timezone
+
+from atmo import events
+
+
+def test_parse_event(state_change_event):
+    event = state_change_event(
+        "j-1", "TERMINATED", {"code": "USER_REQUEST", "message": "Terminated"}
+    )
+    assert events.parse_event(event) == {
+        "jobflow_id": "j-1",
+        "state": "TERMINATED",
+        "state_change_reason_code": "USER_REQUEST",
+        "state_change_reason_message": "Terminated",
+        "event_datetime": datetime(2017, 1, 1, 12, tzinfo=timezone.utc),
+    }
+    assert events.parse_event(state_change_event("j-1", "STARTING"))["state"] == (
+        "STARTING"
+    )
+
+
+def test_parse_other_events(state_change_event):
+    assert events.parse_event({"detail-type": "EMR Step Status Change"}) is None
+    assert events.parse_event(state_change_event("", "STARTING")) is None
+
+
+def test_get_queue(settings):
+    settings.EMR_EVENTS_QUEUE = ""
+    assert events.get_queue() is None
+    settings.EMR_EVENTS_QUEUE = "memory"
+    assert isinstance(events.get_queue(), events.MemoryQueue)
+    settings.EMR_EVENTS_QUEUE = "redis"
+    assert isinstance(events.get_queue(), events.RedisListQueue)
+
+
+def test_memory_queue():
+    queue = events.MemoryQueue()
+    for i in range(3):
+        queue.put({"id": i})
+    assert queue.receive(2) == [(None, {"id": 0}), (None, {"id": 1})]
+    assert queue.receive(2) == [(None, {"id": 2})]
+    assert queue.receive(2) == []
+
+
+def test_redis_list_queue():
+    queue = events.RedisListQueue()
+    for i in range(3):
+        queue.put({"id": i})
+    assert queue.receive(2) == [(None, {"id": 0}), (None, {"id": 1})]
+    assert queue.receive(2) == [(None, {"id": 2})]
+    assert queue.receive(2) == []
+
+
+def test_sqs_queue(mocker):
+    sqs = mocker.Mock()
+    sqs.receive_message.side_effect = [
+        {
+            "Messages": [
+                {"ReceiptHandle": "handle-%s" % i, "Body": json.dumps({"id": i})}
+                for i in range(10)
+            ]
+        },
+        {"Messages": [{"ReceiptHandle": "handle-10", "Body": "invalid"}]},
+        {},
+    ]
+    mocker.patch("atmo.provisioners.clients.client", return_value=sqs)
+    queue = events.SQSQueue("https://sqs.example.com/queue")
+    received = queue.receive(20)
+    assert len(received) == 11
+    assert received[0] == ("handle-0", {"id": 0})
+    assert received[10] == ("handle-10", {})
+    assert sqs.receive_message.call_count == 3
+
+    queue.ack(handle for handle, event in received)
+    assert sqs.delete_message_batch.call_count == 2
+    assert sqs.delete_message_batch.call_args[1]["Entries"] == [
+        {"Id": "0", "ReceiptHandle": "handle-10"}
+    ]
@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import pytest
+from celery.exceptions import Retry
+from django_redis import get_redis_connection
+
+from atmo.locks import Lease, singleton
+from atmo.stats.models import Metric
+
+
+def test_lease():
+    lease = Lease("test", timeout=60)
+    assert lease.acquire()
+    assert not Lease("test", timeout=60).acquire()
+    assert lease.renew()
+    assert 0 < get_redis_connection().pttl(lease.key) <= 60000
+    lease.release()
+    assert not lease.lost
+    assert not get_redis_connection().exists(lease.key)
+
+    # released leases can be acquired again
+    other_lease = Lease("test", timeout=60)
+    assert other_lease.acquire()
+    other_lease.release()
+
+
+def test_lost_lease():
+    lease = Lease("test", timeout=60)
+    assert lease.acquire()
+    # the lease expired and was acquired by somebody else
+    get_redis_connection().set(lease.key, "other-token")
+    assert not lease.renew()
+    lease.release()
+    assert lease.lost
+    assert get_redis_connection().get(lease.key) == b"other-token"
+
+
+def test_singleton():
+    calls = []
+
+    @singleton(timeout=60)
+    def task(value):
+        calls.append(value)
+        # a second run while the first one is running is skipped
+        if value == 1:
+            assert task(2) is None
+        return value
+
+    assert task(1) == 1
+    assert calls == [1]
+    metric = Metric.objects.get(key="task-singleton-skipped")
+    assert metric.data == {"task": "tests.test_locks.task"}
+
+    # the lease is released after the run
+    assert task(3) == 3
+    assert calls == [1, 3]
+
+
+def test_singleton_retries_eta_runs(mocker):
+    @singleton(timeout=60, eta_countdown=30)
+    def task(self):
+        return "ran"
+
+    bound_task = mocker.Mock()
+    bound_task.retry.return_value = Retry()
+    bound_task.request.eta = "2018-01-01T00:00:01+00:00"
+    assert Lease("tests.test_locks.task", timeout=60).acquire()
+
+    # a run sent with an ETA, e.g. at a deadline, is retried shortly
+    with pytest.raises(Retry):
+        task(bound_task)
+    bound_task.retry.assert_called_once_with(countdown=30)
+    assert not Metric.objects.filter(key="task-singleton-skipped").exists()
+
+    # while periodic runs are skipped as usual
+    bound_task.request.eta = None
+    assert task(bound_task) is None
+    assert Metric.objects.filter(key="task-singleton-skipped").count() == 1
+
+
+def test_singleton_overlap():
+    @singleton(timeout=60)
+    def task():
+        get_redis_connection().set("lease:tests.test_locks.task", "other-token")
+
+    task()
+    assert Metric.objects.filter(key="task-singleton-overlap").count() == 1
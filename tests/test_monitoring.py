@@ -0,0 +1,71 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import pytest
+from botocore.exceptions import ClientError
+from django.core.urlresolvers import reverse
+from django_redis import get_redis_connection
+from prometheus_client import REGISTRY
+
+from atmo import monitoring
+from atmo.celery import celery
+from atmo.simulator import SimulatedEMR, simulator
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture
+def emr():
+    simulator.reset()
+    yield monitoring.CallMetrics().install(SimulatedEMR(simulator))
+    simulator.reset()
+
+
+def test_aws_calls(emr):
+    labels = {"service": "emr", "operation": "DescribeCluster"}
+    calls = sample("atmo_aws_call_seconds_count", **labels)
+    with pytest.raises(ClientError):
+        emr.describe_cluster(ClusterId="j-unknown")
+    assert sample("atmo_aws_call_seconds_count", **labels) == calls + 1
+    assert sample(
+        "atmo_aws_call_errors_total", code="InvalidRequestException", **labels
+    )
+
+
+def test_tasks():
+    labels = {"task": "atmo.tasks.cleanup_permissions"}
+    runs = sample("atmo_task_runtime_seconds_count", outcome="SUCCESS", **labels)
+    celery.tasks["atmo.tasks.cleanup_permissions"].apply()
+    assert (
+        sample("atmo_task_runtime_seconds_count", outcome="SUCCESS", **labels)
+        == runs + 1
+    )
+
+
+def test_round_trips():
+    round_trips = sample("atmo_redis_round_trips_total")
+    redis = get_redis_connection()
+    redis.get("foo")
+    pipeline = redis.pipeline()
+    pipeline.get("foo")
+    pipeline.get("bar")
+    pipeline.execute()
+    assert sample("atmo_redis_round_trips_total") == round_trips + 2
+    assert sample("atmo_db_round_trips_total", database="default")
+
+
+def test_metrics_view(settings, client, user):
+    settings.PROMETHEUS_METRICS_TOKEN = "secret"
+    assert client.get(reverse("metrics")).status_code == 403
+    response = client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong")
+    assert response.status_code == 403
+
+    response = client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+    assert response.status_code == 200
+    assert b"atmo_view_seconds" in response.content
+
+    user.is_staff = True
+    user.save()
+    assert client.get(reverse("metrics")).status_code == 200
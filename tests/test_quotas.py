@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import pytest
+from django_redis import get_redis_connection
+
+from atmo import quotas
+from atmo.clusters.forms import NewClusterForm
+from atmo.clusters.models import Cluster
+
+
+@pytest.fixture
+def limits(settings):
+    settings.USER_QUOTA = {"clusters": 2, "runs": 2, "instances": 10}
+    settings.GROUP_QUOTA = {"clusters": None, "runs": None, "instances": None}
+    settings.GROUP_QUOTAS = {"small": {"clusters": 1, "runs": 1, "instances": 3}}
+
+
+def usage(key):
+    return {
+        field.decode(): int(value)
+        for field, value in get_redis_connection().hgetall(key).items()
+    }
+
+
+def test_acquire_and_release(limits, user, group_factory):
+    group = group_factory(name="small")
+    user.groups.add(group)
+    quotas.acquire(quotas.CLUSTERS, 1, user, 2)
+    quotas.acquire(quotas.CLUSTERS, 1, user, 2)
+    quotas.acquire(quotas.RUNS, 1, user, 1)
+    user_key = "quota-usage:user:%s" % user.pk
+    group_key = "quota-usage:group:%s" % group.pk
+    assert usage(user_key) == {"clusters": 1, "runs": 1, "instances": 3}
+    assert usage(group_key) == usage(user_key)
+
+    assert quotas.exceeded(user, clusters=1, instances=1) == [
+        "This would exceed your group's quota of 1 active clusters (1 in use).",
+        "This would exceed your group's quota of 3 active instances (3 in use).",
+    ]
+
+    quotas.release(quotas.CLUSTERS, [1, 2])
+    quotas.release(quotas.CLUSTERS, [1])
+    assert usage(user_key) == {"clusters": 0, "runs": 1, "instances": 1}
+    assert usage(group_key) == usage(user_key)
+    assert quotas.exceeded(user, clusters=1, instances=2) == []
+
+
+def test_cluster_lifecycle(limits, user, cluster_provisioner_mocks, cluster_factory):
+    cluster = cluster_factory(jobflow_id=None, created_by=user, size=4)
+    assert quotas.exceeded(user, instances=7) == [
+        "This would exceed your quota of 10 active instances (4 in use)."
+    ]
+    cluster.sync(
+        {
+            "creation_datetime": cluster.created_at,
+            "ready_datetime": None,
+            "end_datetime": cluster.created_at,
+            "state": Cluster.STATUS_TERMINATED,
+            "public_dns": None,
+        }
+    )
+    assert quotas.exceeded(user, instances=7) == []
+
+
+def test_rebuild(limits, user, spark_job_run_factory, cluster_factory):
+    cluster_factory(created_by=user, size=3, most_recent_status=Cluster.STATUS_WAITING)
+    cluster_factory(created_by=user, most_recent_status=Cluster.STATUS_TERMINATED)
+    spark_job_run_factory(spark_job__created_by=user, size=2)
+    # a stale counter, e.g. of a deleted cluster
+    quotas.acquire(quotas.CLUSTERS, 1234, user, 5)
+
+    assert quotas.rebuild() == 2
+    assert usage("quota-usage:user:%s" % user.pk) == {
+        "clusters": 1,
+        "runs": 1,
+        "instances": 5,
+    }
+    assert quotas.exceeded(user, clusters=1, runs=2) == [
+        "This would exceed your quota of 2 running Spark jobs (1 in use)."
+    ]
+
+
+def test_rebuild_retries_concurrent_changes(mocker, limits, user, cluster_factory):
+    cluster_factory(created_by=user, size=3, most_recent_status=Cluster.STATUS_WAITING)
+    count_usage = quotas.count_usage
+
+    def counted_while_acquiring():
+        usage = count_usage()
+        if count.call_count == 1:
+            # a cluster is launched after the database was counted
+            quotas.acquire(quotas.CLUSTERS, 1234, user, 2)
+        return usage
+
+    count = mocker.patch("atmo.quotas.count_usage", side_effect=counted_while_acquiring)
+    assert quotas.rebuild() == 1
+    assert count.call_count == 2
+
+
+def test_reserve_and_claim(limits, user):
+    reservation = quotas.reserve(quotas.CLUSTERS, user, 6)
+    assert reservation is not None
+    user_key = "quota-usage:user:%s" % user.pk
+    assert usage(user_key) == {"clusters": 1, "instances": 6}
+    # the reservation is checked and counted atomically
+    assert quotas.reserve(quotas.CLUSTERS, user, 5) is None
+    assert usage(user_key) == {"clusters": 1, "instances": 6}
+
+    quotas.claim(quotas.CLUSTERS, reservation, 1, user, 6)
+    assert usage(user_key) == {"clusters": 1, "instances": 6}
+    quotas.release(quotas.CLUSTERS, [1])
+    assert usage(user_key) == {"clusters": 0, "instances": 0}
+
+    # without a reservation the resource is acquired
+    quotas.claim(quotas.CLUSTERS, None, 2, user, 4)
+    assert usage(user_key) == {"clusters": 1, "instances": 4}
+
+
+def test_failed_launch_releases_reservation(
+    limits, user, cluster_provisioner_mocks, cluster_factory
+):
+    cluster = cluster_factory.build(jobflow_id=None, created_by=user, size=4)
+    cluster.quota_reservation = quotas.reserve(quotas.CLUSTERS, user, 4)
+    cluster_provisioner_mocks["start"].side_effect = ValueError
+    with pytest.raises(ValueError):
+        cluster.save()
+    assert usage("quota-usage:user:%s" % user.pk) == {"clusters": 0, "instances": 0}
+
+
+def test_new_cluster_form(limits, user, ssh_key, emr_release):
+    quotas.acquire(quotas.CLUSTERS, 1, user, 8)
+    data = {
+        "new-identifier": "test-cluster",
+        "new-size": 3,
+        "new-lifetime": 8,
+        "new-ssh_key": ssh_key.id,
+        "new-emr_release": emr_release.version,
+    }
+    form = NewClusterForm(user, data=data)
+    assert not form.is_valid()
+    assert form.non_field_errors() == [
+        "This would exceed your quota of 10 active instances (8 in use)."
+    ]
+
+    data["new-size"] = 2
+    form = NewClusterForm(user, data=data)
+    assert form.is_valid()
+    # validating the form doesn't reserve anything
+    assert form.instance.quota_reservation is None
+    assert quotas.exceeded(user, instances=2) == []
+
+    # the quota of the new cluster is reserved right before it's launched
+    assert form.reserve_quota()
+    assert form.instance.quota_reservation is not None
+    assert quotas.exceeded(user, instances=1) == [
+        "This would exceed your quota of 10 active instances (10 in use)."
+    ]
+
+    # unless another cluster took the rest of the quota in the meantime
+    other_form = NewClusterForm(user, data=data)
+    assert not other_form.is_valid()
+    quotas.release(quotas.CLUSTERS, [form.instance.quota_reservation])
+    other_form = NewClusterForm(user, data=data)
+    assert other_form.is_valid()
+    quotas.acquire(quotas.CLUSTERS, 2, user, 1)
+    assert not other_form.reserve_quota()
+    assert other_form.non_field_errors() == [
+        "This would exceed your quota of 2 active clusters (2 in use).",
+        "This would exceed your quota of 10 active instances (9 in use).",
+    ]
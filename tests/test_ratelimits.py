@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import pytest
+from botocore.exceptions import ClientError
+
+from atmo import ratelimits
+from atmo.simulator import SimulatedEMR, simulator
+from atmo.stats.models import Metric
+
+
+@pytest.fixture
+def clock(mocker):
+    "A fake clock that advances when sleeping."
+    now = [1000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    return mocker.patch(
+        "atmo.ratelimits.time",
+        time=lambda: now[0],
+        sleep=mocker.Mock(side_effect=sleep),
+    )
+
+
+@pytest.fixture
+def limiter(settings):
+    settings.AWS_CONFIG = dict(
+        settings.AWS_CONFIG,
+        EMR_RATE_LIMITS={"DescribeCluster": {"rate": 1, "capacity": 4}},
+        EMR_RATE_LIMIT_RESERVE=0.5,
+        EMR_RATE_LIMIT_MAX_WAIT=10,
+    )
+    return ratelimits.RateLimiter("emr")
+
+
+def test_acquire_within_capacity(clock, limiter):
+    for i in range(4):
+        assert limiter.acquire("DescribeCluster") == 0
+    assert not clock.sleep.called
+    assert not Metric.objects.exists()
+
+
+def test_acquire_waits_for_refill(clock, limiter):
+    for i in range(4):
+        limiter.acquire("DescribeCluster")
+    assert limiter.acquire("DescribeCluster") == 1
+    clock.sleep.assert_called_once_with(1)
+    metric = Metric.objects.get(key="emr-rate-limit-wait")
+    assert metric.value == 1000
+    assert metric.data == {"operation": "DescribeCluster", "lane": "interactive"}
+
+
+def test_unlimited_operation(clock, limiter):
+    for i in range(10):
+        assert limiter.acquire("ListClusters") == 0
+
+
+def test_background_lane_keeps_reserve(clock, limiter):
+    with ratelimits.lane(ratelimits.BACKGROUND):
+        assert ratelimits.current_lane() == ratelimits.BACKGROUND
+        assert limiter.acquire("DescribeCluster") == 0
+        assert limiter.acquire("DescribeCluster") == 0
+        # half of the capacity is reserved for the interactive lane
+        assert limiter.acquire("DescribeCluster") == 1
+    assert ratelimits.current_lane() == ratelimits.INTERACTIVE
+    assert limiter.acquire("DescribeCluster") == 0
+    assert Metric.objects.get(key="emr-rate-limit-wait").data["lane"] == "background"
+
+
+def test_max_wait_exceeded(settings, clock, limiter):
+    settings.AWS_CONFIG = dict(settings.AWS_CONFIG, EMR_RATE_LIMIT_MAX_WAIT=0.5)
+    for i in range(4):
+        limiter.acquire("DescribeCluster")
+    with pytest.raises(ClientError) as excinfo:
+        limiter.acquire("DescribeCluster")
+    assert excinfo.value.response["Error"]["Code"] == "ThrottlingException"
+    assert Metric.objects.filter(key="emr-rate-limit-exceeded").count() == 1
+
+
+def test_install(mocker, limiter):
+    acquire = mocker.patch.object(limiter, "acquire")
+    client = limiter.install(SimulatedEMR(simulator))
+    with pytest.raises(ClientError):
+        client.describe_cluster(ClusterId="j-unknown")
+    acquire.assert_called_once_with("DescribeCluster")
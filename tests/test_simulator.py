@@ -0,0 +1,145 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+import io
+from datetime import timedelta
+
+import pytest
+from botocore.exceptions import ClientError
+from freezegun import freeze_time
+
+from atmo.clusters.provisioners import ClusterProvisioner
+from atmo.jobs.provisioners import SparkJobProvisioner
+from atmo.simulator import simulator
+
+
+@pytest.fixture(autouse=True)
+def simulated(settings):
+    settings.AWS_CLIENT_BACKEND = "simulator"
+    settings.AWS_SIMULATOR_CONFIG = dict(
+        settings.AWS_SIMULATOR_CONFIG,
+        STATE_DURATIONS={
+            "STARTING": 60,
+            "BOOTSTRAPPING": 60,
+            "STEP": 600,
+            "TERMINATING": 60,
+        },
+    )
+    simulator.reset()
+    yield
+    simulator.reset()
+
+
+def start_cluster():
+    return ClusterProvisioner().start(
+        user_username="user",
+        user_email="user@example.com",
+        identifier="cluster",
+        emr_release="5.0.0",
+        size=3,
+        public_key="ssh-rsa AAAAB3",
+    )
+
+
+def test_cluster_lifecycle():
+    with freeze_time("2017-01-01 12:00:00") as frozen_time:
+        provisioner = ClusterProvisioner()
+        jobflow_id = start_cluster()
+        assert provisioner.info(jobflow_id)["state"] == "STARTING"
+        frozen_time.tick(timedelta(seconds=60))
+        assert provisioner.info(jobflow_id)["state"] == "BOOTSTRAPPING"
+        frozen_time.tick(timedelta(seconds=60))
+        # the setup-zeppelin step
+        info = provisioner.info(jobflow_id)
+        assert info["state"] == "RUNNING"
+        assert info["ready_datetime"] is not None
+        assert info["public_dns"]
+        frozen_time.tick(timedelta(seconds=600))
+        assert provisioner.info(jobflow_id)["state"] == "WAITING"
+
+        provisioner.stop(jobflow_id)
+        info = provisioner.info(jobflow_id)
+        assert info["state"] == "TERMINATING"
+        assert info["state_change_reason_code"] == "USER_REQUEST"
+        frozen_time.tick(timedelta(seconds=60))
+        info = provisioner.info(jobflow_id)
+        assert info["state"] == "TERMINATED"
+        assert info["end_datetime"] is not None
+
+
+def test_job_terminates_after_steps():
+    with freeze_time("2017-01-01 12:00:00") as frozen_time:
+        jobflow_id = SparkJobProvisioner().run(
+            user_username="user",
+            user_email="user@example.com",
+            identifier="job",
+            emr_release="5.0.0",
+            size=3,
+            notebook_key="jobs/job/notebook.ipynb",
+            is_public=False,
+            job_timeout=1,
+        )
+        # two steps and the terminating state
+        frozen_time.tick(timedelta(seconds=60 + 60 + 2 * 600 + 60))
+        info = ClusterProvisioner().info(jobflow_id)
+        assert info["state"] == "TERMINATED"
+        assert info["state_change_reason_code"] == "ALL_STEPS_COMPLETED"
+
+
+def test_bootstrap_failure(settings):
+    settings.AWS_SIMULATOR_CONFIG = dict(settings.AWS_SIMULATOR_CONFIG, FAILURE_RATE=1)
+    with freeze_time("2017-01-01 12:00:00") as frozen_time:
+        jobflow_id = start_cluster()
+        frozen_time.tick(timedelta(seconds=60 + 60 + 60))
+        info = ClusterProvisioner().info(jobflow_id)
+        assert info["state"] == "TERMINATED_WITH_ERRORS"
+        assert info["state_change_reason_code"] == "BOOTSTRAP_FAILURE"
+        assert info["ready_datetime"] is None
+
+
+def test_list_clusters_pagination(settings, now):
+    settings.AWS_SIMULATOR_CONFIG = dict(
+        settings.AWS_SIMULATOR_CONFIG, LIST_CLUSTERS_PAGE_SIZE=2
+    )
+    jobflow_ids = [start_cluster() for i in range(5)]
+    provisioner = ClusterProvisioner()
+    infos = list(
+        provisioner.list(created_after=now - timedelta(minutes=1), states=["STARTING"])
+    )
+    assert sorted(info["jobflow_id"] for info in infos) == jobflow_ids
+    assert provisioner.list_pages_fetched == 3
+    assert list(provisioner.list(created_after=now, states=["WAITING"])) == []
+
+
+def test_throttling(settings):
+    settings.AWS_SIMULATOR_CONFIG = dict(settings.AWS_SIMULATOR_CONFIG, THROTTLE_RATE=1)
+    with pytest.raises(ClientError) as excinfo:
+        start_cluster()
+    assert excinfo.value.response["Error"]["Code"] == "ThrottlingException"
+
+
+def test_unknown_cluster():
+    with pytest.raises(ClientError):
+        ClusterProvisioner().info("j-unknown")
+
+
+def test_s3_objects(settings):
+    settings.AWS_SIMULATOR_CONFIG = dict(
+        settings.AWS_SIMULATOR_CONFIG, LIST_OBJECTS_PAGE_SIZE=1
+    )
+    provisioner = SparkJobProvisioner()
+    notebook = io.BytesIO(b"notebook")
+    notebook.name = "notebook.ipynb"
+    key = provisioner.add("job", notebook)
+    assert provisioner.get(key)["Body"].read() == b"notebook"
+    provisioner.remove(key)
+    with pytest.raises(ClientError):
+        provisioner.get(key)
+
+    bucket = settings.AWS_CONFIG["PRIVATE_DATA_BUCKET"]
+    for key in ["job/logs/log.txt", "job/data/a.csv", "job/data/b.csv"]:
+        provisioner.s3.put_object(Bucket=bucket, Key=key, Body="content")
+    assert provisioner.results("job", is_public=False) == {
+        "data": ["job/data/a.csv", "job/data/b.csv"],
+        "logs": ["job/logs/log.txt"],
+    }
@@ -29,3 +29,25 @@ def test_metrics_record(now, one_hour_ago):
     assert m.value == 1
     assert m.created_at.replace(microsecond=0) == one_hour_ago
     assert m.data == {"other-value-2": 100}
+
+
+def test_metrics_bulk_record(now, one_hour_ago):
+    Metric.bulk_record(
+        [
+            {"key": "metric-key-1"},
+            {"key": "metric-key-2", "value": 500, "data": {"other-value": "test"}},
+            {"key": "metric-key-3", "created_at": one_hour_ago},
+        ]
+    )
+
+    m = Metric.objects.get(key="metric-key-1")
+    assert m.value == 1
+    assert m.created_at.replace(microsecond=0) >= now
+    assert m.data is None
+
+    m = Metric.objects.get(key="metric-key-2")
+    assert m.value == 500
+    assert m.data == {"other-value": "test"}
+
+    m = Metric.objects.get(key="metric-key-3")
+    assert m.created_at == one_hour_ago
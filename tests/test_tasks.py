@@ -0,0 +1,198 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from datetime import timedelta
+
+import pytest
+from freezegun import freeze_time
+
+from atmo import events, tasks
+from atmo.clusters.models import Cluster
+from atmo.stats.models import Metric
+
+
+def test_update_emr_statuses_empty():
+    assert tasks.update_emr_statuses() == {"clusters": [], "spark_job_runs": []}
+
+
+def test_update_emr_statuses(
+    mocker, now, user, cluster_factory, spark_job_factory, spark_job_run_factory
+):
+    cluster = cluster_factory(
+        created_by=user,
+        created_at=now - timedelta(days=1),
+        most_recent_status=Cluster.STATUS_RUNNING,
+        master_address="",
+    )
+    spark_job = spark_job_factory(start_date=now - timedelta(days=2), created_by=user)
+    spark_job_run = spark_job_run_factory(
+        spark_job=spark_job, status=Cluster.STATUS_RUNNING
+    )
+    spark_job_run.created_at = now - timedelta(days=2)
+    spark_job_run.save()
+
+    info = {
+        "state": Cluster.STATUS_RUNNING,
+        "ready_datetime": None,
+        "end_datetime": None,
+        "state_change_reason_code": "",
+        "state_change_reason_message": "",
+    }
+    cluster_provisioner_list = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.list",
+        return_value=[
+            dict(
+                info,
+                jobflow_id=cluster.jobflow_id,
+                creation_datetime=cluster.created_at,
+            ),
+            dict(
+                info,
+                jobflow_id=spark_job_run.jobflow_id,
+                creation_datetime=spark_job_run.created_at,
+            ),
+            # the cluster that should be ignored
+            dict(
+                info,
+                jobflow_id="j-some-other-id",
+                creation_datetime=now - timedelta(days=10),
+            ),
+        ],
+    )
+    cluster_provisioner_info = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.info"
+    )
+
+    result = tasks.update_emr_statuses()
+    assert result == {
+        "clusters": [cluster.identifier],
+        "spark_job_runs": [[spark_job.identifier, spark_job_run.pk]],
+    }
+    # a single list call covering both the cluster and the Spark job run
+    cluster_provisioner_list.assert_called_once_with(
+        created_after=(now - timedelta(days=2)).replace(hour=0, minute=0, second=0),
+        states=Cluster.ACTIVE_STATUS_LIST,
+    )
+    assert not cluster_provisioner_info.called
+    cluster.refresh_from_db()
+    assert cluster.started_at == cluster.created_at
+    spark_job_run.refresh_from_db()
+    assert spark_job_run.started_at == spark_job_run.created_at
+
+    # the Spark job runs aren't due again yet, the cluster is
+    cluster.next_poll_at = None
+    cluster.save()
+    result = tasks.update_emr_statuses()
+    assert result == {"clusters": [cluster.identifier], "spark_job_runs": []}
+
+
+@pytest.fixture
+def event_queue(settings):
+    settings.EMR_EVENTS_QUEUE = "memory"
+    queue = events.get_queue()
+    yield queue
+    queue.receive(1000)
+
+
+def test_ingest_emr_events_disabled(settings):
+    settings.EMR_EVENTS_QUEUE = ""
+    assert tasks.ingest_emr_events() is None
+
+
+def test_ingest_emr_events(
+    mocker,
+    now,
+    user,
+    event_queue,
+    state_change_event,
+    cluster_factory,
+    spark_job_with_run_factory,
+):
+    cluster = cluster_factory(
+        created_by=user, most_recent_status=Cluster.STATUS_BOOTSTRAPPING
+    )
+    spark_job = spark_job_with_run_factory(
+        start_date=now - timedelta(days=1),
+        created_by=user,
+        run__status=Cluster.STATUS_RUNNING,
+    )
+    spark_job_run = spark_job.latest_run
+    starting_spark_job = spark_job_with_run_factory(
+        start_date=now - timedelta(days=1),
+        created_by=user,
+        run__status=Cluster.STATUS_STARTING,
+    )
+    starting_run = starting_spark_job.latest_run
+    event_queue.put(state_change_event(cluster.jobflow_id, "RUNNING"))
+    event_queue.put(state_change_event(cluster.jobflow_id, "WAITING"))
+    event_queue.put(state_change_event("j-not-launched-by-atmo", "WAITING"))
+    event_queue.put({"detail-type": "EMR Step Status Change"})
+    event_queue.put(
+        state_change_event(
+            spark_job_run.jobflow_id,
+            "TERMINATED",
+            {"code": "ALL_STEPS_COMPLETED", "message": "Steps completed"},
+        )
+    )
+    event_queue.put(state_change_event(starting_run.jobflow_id, "BOOTSTRAPPING"))
+    bulk_info = mocker.patch(
+        "atmo.clusters.provisioners.ClusterProvisioner.bulk_info",
+        return_value={
+            cluster.jobflow_id: {
+                "state": Cluster.STATUS_WAITING,
+                "creation_datetime": now - timedelta(minutes=10),
+                "ready_datetime": now,
+                "public_dns": "master.example.com",
+            }
+        },
+    )
+
+    result = tasks.ingest_emr_events()
+    assert result == {
+        "clusters": [cluster.identifier],
+        "spark_job_runs": [[starting_spark_job.identifier, starting_run.pk]],
+    }
+    assert bulk_info.call_args == mocker.call(
+        [cluster.jobflow_id, spark_job_run.jobflow_id, starting_run.jobflow_id]
+    )
+    cluster.refresh_from_db()
+    assert cluster.most_recent_status == Cluster.STATUS_WAITING
+    assert cluster.ready_at == now
+    # the runs that couldn't be described are updated with the event's
+    # state, unless it's final and needs the end date/time from polling
+    starting_run.refresh_from_db()
+    assert starting_run.status == Cluster.STATUS_BOOTSTRAPPING
+    spark_job_run.refresh_from_db()
+    assert spark_job_run.status == Cluster.STATUS_RUNNING
+    assert event_queue.receive(10) == []
+
+
+def test_cluster_poll_interval_with_events(settings, now, cluster_factory):
+    cluster = cluster_factory(
+        most_recent_status=Cluster.STATUS_BOOTSTRAPPING,
+        expires_at=now + timedelta(hours=8),
+    )
+    assert cluster.poll_interval(now) == timedelta(minutes=1)
+    settings.EMR_EVENTS_QUEUE = "memory"
+    assert cluster.poll_interval(now) == timedelta(minutes=15)
+
+
+def test_tick(mocker, now):
+    runs = {
+        task_name: mocker.patch.object(tasks.celery.tasks[task_name], "run")
+        for task_name in tasks.TICK_STEPS
+    }
+    runs["atmo.jobs.tasks.expire_jobs"].side_effect = ValueError
+    with freeze_time(now.replace(hour=12, minute=15)):
+        durations = tasks.tick()
+    # a failed step doesn't stop the others
+    assert list(durations) == list(tasks.TICK_STEPS)
+    for run in runs.values():
+        run.assert_called_once_with()
+    metric = Metric.objects.get(key="tick-duration")
+    assert metric.data["failed"] == ["atmo.jobs.tasks.expire_jobs"]
+
+    with freeze_time(now.replace(hour=12, minute=16)):
+        assert list(tasks.tick()) == ["atmo.jobs.tasks.send_run_alert_mails"]
+    assert runs["atmo.jobs.tasks.expire_jobs"].call_count == 1
+    assert runs["atmo.jobs.tasks.send_run_alert_mails"].call_count == 2
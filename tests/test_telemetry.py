@@ -0,0 +1,55 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+from django.core.urlresolvers import reverse
+
+from atmo import telemetry
+from atmo.celery import celery
+
+
+def run(runtime, outcome="SUCCESS"):
+    return {
+        "task_id": "1",
+        "started_at": None,
+        "runtime": runtime,
+        "outcome": outcome,
+        "retries": 0,
+        "size": 2,
+    }
+
+
+def test_record_is_capped(settings):
+    settings.TASK_TELEMETRY_SIZE = 3
+    for runtime in range(5):
+        telemetry.record("atmo.tasks.test", run(runtime))
+    runs = telemetry.recent_runs("atmo.tasks.test")
+    assert [recorded["runtime"] for recorded in runs] == [4, 3, 2]
+    assert len(telemetry.recent_runs("atmo.tasks.test", 2)) == 2
+    assert telemetry.task_names() == ["atmo.tasks.test"]
+
+
+def test_summarize():
+    runs = [run(runtime) for runtime in range(1, 101)] + [run(200, "FAILURE")]
+    summary = telemetry.summarize(runs)
+    assert summary["count"] == 101
+    assert summary["failures"] == 1
+    assert summary["p50"] == 51
+    assert summary["p99"] == 100
+    assert summary["max"] == 200
+    assert telemetry.summarize([])["p50"] is None
+
+
+def test_signals_record_runs():
+    celery.tasks["atmo.tasks.cleanup_permissions"].apply()
+    (recorded,) = telemetry.recent_runs("atmo.tasks.cleanup_permissions")
+    assert recorded["outcome"] == "SUCCESS"
+    assert recorded["retries"] == 0
+    assert recorded["size"] == len("null")
+
+
+def test_admin_page(admin_client):
+    telemetry.record("atmo.tasks.test", run(1.5))
+    response = admin_client.get(reverse("task-telemetry"), {"task": "atmo.tasks.test"})
+    assert response.status_code == 200
+    assert response.context["tasks"][0]["p50"] == 1.5
+    assert len(response.context["runs"]) == 1